@@ -1,4 +1,5 @@
 import logging
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, Request, status
 from fastapi.exceptions import RequestValidationError
@@ -8,11 +9,35 @@ from fastapi.responses import JSONResponse
 from .routers.chat import router as chat_router
 from .routers.delete import router as delete_router
 from .routers.ingest import router as ingest_router
+from .routers.metrics import router as metrics_router
+from .utils.chat import get_retriever
+from .utils.clients import clients
+from .utils.jobs import job_queue
+from .utils.parsers import parser_pool, parser_pool_warm
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # pooled OpenAI/Pinecone clients shared by every router
+    clients.start()
+    # other namespaces are loaded on their first request
+    get_retriever()
+    # parser processes import the document loaders before the first upload
+    if parser_pool_warm:
+        parser_pool.start()
+    # resumes ingestion jobs interrupted by a restart
+    job_queue.start()
+    yield
+    job_queue.shutdown()
+    parser_pool.close()
+    await clients.aclose()
+
 
 app = FastAPI(
     title="Chat with your Docs",
     version="1.0",
     description="A simple api server to Chat with your Docs",
+    lifespan=lifespan,
 )
 
 ALLOWED_HOSTS = ["*"]
@@ -23,11 +48,15 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # lets browser clients read the ID of a server-side conversation
+    expose_headers=["X-Conversation-Id"],
 )
 
 app.include_router(chat_router, prefix="/api", tags=["chat"])
 app.include_router(ingest_router, prefix="/api", tags=["ingest"])
 app.include_router(delete_router, prefix="/api", tags=["delete"])
+# Prometheus scrapes /metrics at the root
+app.include_router(metrics_router, tags=["metrics"])
 
 
 @app.exception_handler(RequestValidationError)
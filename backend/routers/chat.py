@@ -1,40 +1,309 @@
+import asyncio
 import json
-from typing import Iterator
+import time
+import uuid
+from collections import Counter
+from typing import Dict, List, Optional
 
 import humps
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, HTTPException, Request
 from fastapi.responses import StreamingResponse
+from langchain.schema import AIMessage, HumanMessage
+from starlette.concurrency import run_in_threadpool
 
-from ..utils.chat import _inputs, chain
+from ..utils.answer_cache import answer_cache
+from ..utils.bm25 import hybrid_stats
+from ..utils.chat import (_question_inputs, chain, chat_coalesce,
+                          chat_coalesce_max_lag, chat_max_concurrency,
+                          context_window, embeddings, get_chat_history_window,
+                          get_retriever, merge_documents, question_overlap,
+                          retrievers, speculative_keep_threshold,
+                          speculative_retrieval, target_source_docs,
+                          to_chat_messages)
+from ..utils.coalesce import Flight, FlightLagged, SingleFlight, coalesce_key
+from ..utils.condense_cache import condense_cache
+from ..utils.embedding_cache import CachedEmbeddings
+from ..utils.metrics import (Trace, metrics, server_timing_header, span,
+                             start_trace)
+from ..utils.namespaces import request_namespace
+from ..utils.sessions import chat_sessions
+from ..utils.token_budget import prompt_packer
 
 router = APIRouter()
 
+# bounds the number of chat pipelines in flight on this worker
+chat_semaphore = asyncio.Semaphore(chat_max_concurrency)
+
+# concurrent identical questions attach to one upstream generation
+chat_flights = SingleFlight(chat_coalesce, chat_coalesce_max_lag)
+
+# how the context of each request was retrieved
+retrieval_paths = Counter()
+
+# size of the pieces a cached answer is replayed in
+REPLAY_CHUNK_SIZE = 32
+# stands for an unset default namespace in chat session keys
+_DEFAULT_SESSION_NAMESPACE = "*"
+
+# cache and token stats are exported as gauges on /metrics
+metrics.register_collector("answer_cache", answer_cache.stats)
+metrics.register_collector("condense", condense_cache.stats)
+metrics.register_collector("hybrid", lambda: dict(hybrid_stats))
+metrics.register_collector("prompt_tokens", prompt_packer.stats)
+metrics.register_collector("sessions", chat_sessions.stats)
+metrics.register_collector("retrievers", retrievers.stats)
+metrics.register_collector("coalesce", chat_flights.stats)
+if isinstance(embeddings, CachedEmbeddings):
+    metrics.register_collector("embedding_cache", embeddings.stats)
+
+
+async def replay_answer(answer: str, camelized_source_documents: str):
+    """Streams a cached answer in the same format as a generated one"""
+    for i in range(0, len(answer), REPLAY_CHUNK_SIZE):
+        yield answer[i : i + REPLAY_CHUNK_SIZE]
+    yield f"##SOURCE_DOCUMENTS##{camelized_source_documents}"
+
+
+def _namespace(request: Request) -> Optional[str]:
+    try:
+        return request_namespace(request.headers, request.query_params)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def _session_key(conversation_id: Optional[str], namespace: Optional[str]) -> str:
+    # conversations are only visible in the namespace they started in;
+    # namespace names never contain ':' nor '*', so keys of different
+    # namespaces cannot collide whatever the conversation ID
+    return f"{namespace or _DEFAULT_SESSION_NAMESPACE}:{conversation_id}"
+
+
+def _response_headers(
+    retrieval_path: str, trace: Optional[Trace], conversation_id: Optional[str]
+) -> Dict[str, str]:
+    retrieval_paths[retrieval_path] += 1
+    metrics.inc("chat_requests_total", path=retrieval_path)
+    headers = {"X-Retrieval-Path": retrieval_path}
+    if conversation_id is not None:
+        headers["X-Conversation-Id"] = conversation_id
+    if trace is not None and server_timing_header:
+        # stages up to the first byte, the streamed ones are only on /metrics
+        headers["Server-Timing"] = trace.server_timing()
+    return headers
+
+
+async def _answer(
+    flight: Flight,
+    namespace: Optional[str],
+    current_question: str,
+    chat_history: List,
+    trace: Optional[Trace],
+):
+    """
+    Condenses, retrieves and generates the answer of a flight, publishing
+    the streamed chunks and then the source documents
+    """
+    # a cold namespace loads its indexes off the event loop
+    retriever = retrievers.cached(namespace) or await run_in_threadpool(
+        get_retriever, namespace
+    )
+    await chat_semaphore.acquire()
+    speculative = None
+    start = first_token = None
+    try:
+        if speculative_retrieval and chat_history:
+            # start retrieving with the raw follow-up while it is being condensed
+            speculative = asyncio.create_task(retriever.ainvoke(current_question))
+        with span("condense"):
+            retrieved_data = await _question_inputs.ainvoke(
+                {"question": current_question, "chat_history": chat_history}
+            )
+        standalone_question = retrieved_data["standalone_question"]
+        if answer_cache.enabled:
+            with span("answer_cache"):
+                question_embedding = await embeddings.aembed_query(standalone_question)
+                cached, corpus_version = answer_cache.lookup(
+                    question_embedding, namespace
+                )
+            if cached is not None:
+                flight.answer = cached[0]
+                flight.mark_ready("answer_cache")
+                async for chunk in replay_answer(*cached):
+                    await flight.publish(chunk)
+                return
+
+        with span("retrieve"):
+            if speculative is None:
+                retrieval_path = "direct"
+                context = await retriever.ainvoke(standalone_question)
+            elif (
+                question_overlap(current_question, standalone_question)
+                >= speculative_keep_threshold
+            ):
+                # the condensed question barely changed, keep the early results
+                retrieval_path = "speculative"
+                context = await speculative
+            else:
+                retrieval_path = "merged"
+                context = merge_documents(
+                    await retriever.ainvoke(standalone_question),
+                    await speculative,
+                    target_source_docs,
+                )
+        with span("prompt"):
+            # only the chunks that fit in the context budget are sent and cited
+            retrieved_data["context"] = prompt_packer.pack_context(context)
+            source_documents = [
+                doc.to_json()["kwargs"] for doc in retrieved_data["context"]
+            ]
+            camelized_source_documents = json.dumps(
+                humps.camelize(source_documents)
+            )  # Convert dicts to json camel case
+        flight.mark_ready(retrieval_path)
+
+        answer = []
+        start = time.perf_counter()
+        async for chunk in chain.astream(retrieved_data):
+            if first_token is None:
+                first_token = time.perf_counter()
+            answer.append(chunk)
+            await flight.publish(chunk)
+        flight.answer = "".join(answer)
+        await flight.publish(f"##SOURCE_DOCUMENTS##{camelized_source_documents}")
+        if answer_cache.enabled:
+            answer_cache.store(
+                question_embedding,
+                flight.answer,
+                camelized_source_documents,
+                corpus_version,
+                namespace,
+            )
+    finally:
+        if speculative is not None:
+            speculative.cancel()
+        chat_semaphore.release()
+        if trace is not None:
+            end = time.perf_counter()
+            if first_token is not None:
+                trace.record("ttft", first_token - start)
+                trace.record("stream", end - first_token)
+            trace.finish("chat_stage_seconds")
+
 
 @router.post("/chat")
 async def process_chat_request(request: Request):
+    namespace = _namespace(request)
     request_body = await request.body()
     request_data = json.loads(request_body)
-    messages = request_data["messages"]
-    current_question = messages[-1]["content"]
-    chat_history = [] if len(messages) == 1 else messages[:-1]
+    messages = request_data.get("messages", [])
+    message = request_data.get("message")
+    if message is None:
+        message, messages = messages[-1], messages[:-1]
+    current_question = message["content"]
+
+    # with a conversation ID (or a lone new message) the history is kept on
+    # the server; without one the client sends it with every turn
+    conversation_id = request_data.get("conversationId")
+    if conversation_id is None and "message" in request_data:
+        conversation_id = uuid.uuid4().hex
+    chat_history = messages
+    session_key = _session_key(conversation_id, namespace)
+    if conversation_id is not None:
+        # sessions may be read from and written to SQLite, off the event loop
+        session_history = await run_in_threadpool(chat_sessions.get, session_key)
+        if session_history is not None:
+            chat_history = session_history
+
+    async def remember(answer: str):
+        if conversation_id is not None:
+            await run_in_threadpool(
+                chat_sessions.save,
+                session_key,
+                get_chat_history_window(
+                    to_chat_messages(chat_history)
+                    + [
+                        HumanMessage(content=current_question),
+                        AIMessage(content=answer),
+                    ],
+                    context_window,
+                ),
+            )
+
+    # None unless this request is sampled for stage timings
+    trace: Optional[Trace] = None
 
-    retrieved_data = _inputs.invoke(
-        {"question": current_question, "chat_history": chat_history}
+    def produce(new_flight: Flight):
+        nonlocal trace
+        # only the request starting the flight is traced, in the flight's
+        # task, which finishes the trace; coalesced requests time nothing
+        trace = start_trace()
+        return _answer(new_flight, namespace, current_question, chat_history, trace)
+
+    # identical questions in flight share one condense, retrieval and
+    # generation
+    flight, coalesced = chat_flights.join(
+        coalesce_key(
+            namespace,
+            current_question,
+            get_chat_history_window(to_chat_messages(chat_history), context_window),
+        ),
+        produce,
     )
-    source_documents = [doc.to_json()["kwargs"] for doc in retrieved_data["context"]]
-    camelized_source_documents = json.dumps(
-        humps.camelize(source_documents)
-    )  # Convert dicts to json camel case
+    if coalesced:
+        metrics.inc("chat_coalesced_total")
+    try:
+        await flight.ready.wait()
+        if flight.error is not None:
+            raise flight.error
+    except BaseException:
+        chat_flights.leave(flight)
+        raise
 
-    def process_output(output_iterator: Iterator[str]):
+    async def stream_answer():
         """Yields (stream) the LLM response and the source documents"""
-        for chunk in output_iterator:
-            yield chunk
-        yield f"##SOURCE_DOCUMENTS##{camelized_source_documents}"
-
-    stream_chain = chain | process_output
+        try:
+            async for chunk in flight.stream():
+                yield chunk
+            await remember(flight.answer)
+        except FlightLagged:
+            # the client reads slower than the answer is generated, the
+            # response is cut off rather than buffered without bound
+            metrics.inc("chat_coalesce_lagged_total")
+            raise
+        finally:
+            chat_flights.leave(flight)
 
-    # return a StreamingResponse object with the generator and the media type
+    # return a StreamingResponse object with the async generator and the media type
     return StreamingResponse(
-        stream_chain.stream(retrieved_data), media_type="text/plain"
+        stream_answer(),
+        media_type="text/plain",
+        headers=_response_headers(
+            "coalesced" if coalesced else flight.retrieval_path,
+            # the stage timings belong to the request that started the flight
+            None if coalesced else trace,
+            conversation_id,
+        ),
     )
+
+
+@router.get("/chat/cache-stats")
+def chat_cache_stats():
+    return humps.camelize(
+        {
+            "answer_cache": answer_cache.stats(),
+            "condense": condense_cache.stats(),
+            "retrieval_paths": dict(retrieval_paths),
+            "hybrid": dict(hybrid_stats),
+            "prompt_tokens": prompt_packer.stats(),
+            "sessions": chat_sessions.stats(),
+            "retrievers": retrievers.stats(),
+            "coalesce": chat_flights.stats(),
+        }
+    )
+
+
+@router.delete("/chat/sessions/{conversation_id}")
+def delete_chat_session(conversation_id: str, request: Request):
+    namespace = _namespace(request)
+    chat_sessions.delete(_session_key(conversation_id, namespace))
+    return {"message": "Conversation deleted"}
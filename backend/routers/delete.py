@@ -1,12 +1,54 @@
-from fastapi import APIRouter, Request
+import json
+from typing import Optional
 
-from ..utils.delete import delete_all
+from fastapi import APIRouter, HTTPException, Request
+from starlette.concurrency import run_in_threadpool
+
+from ..utils.delete import delete_all, delete_documents
+from ..utils.namespaces import request_namespace
+from ..utils.sources import get_source_index
 
 router = APIRouter()
 
 
+def _namespace(request: Request) -> Optional[str]:
+    try:
+        return request_namespace(request.headers, request.query_params)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
 @router.post("/delete-documents")
-def delete(request: Request):
-    # initialize pinecone if not already initialized
-    response = delete_all()
+async def delete(request: Request):
+    namespace = _namespace(request)
+    body = await request.body()
+    data = json.loads(body) if body else {}
+    # delete_documents argument -> JSON key
+    keys = {"sources": "sources", "prefixes": "prefixes", "batch_ids": "batchIds"}
+    selectors = {name: data.get(key) or [] for name, key in keys.items()}
+    for name, values in selectors.items():
+        if not isinstance(values, list) or not all(
+            isinstance(value, str) for value in values
+        ):
+            raise HTTPException(
+                status_code=422, detail=f"'{keys[name]}' must be a list of strings"
+            )
+    if "" in selectors["prefixes"]:
+        raise HTTPException(
+            status_code=422, detail="Send an empty body to delete every document"
+        )
+
+    # without selectors, everything is deleted
+    if not any(selectors.values()):
+        response = await run_in_threadpool(delete_all, namespace)
+    else:
+        response = await run_in_threadpool(
+            delete_documents, **selectors, namespace=namespace
+        )
     return {"message": response}
+
+
+@router.get("/sources")
+def list_sources(request: Request):
+    # sources ingested since the source index was added, with their chunk counts
+    return {"sources": get_source_index(_namespace(request)).sources()}
@@ -1,48 +1,165 @@
 import json
 import os
-from typing import List
+import shutil
+from typing import List, Optional
 
-from fastapi import APIRouter, File, Request, UploadFile
+import humps
+from fastapi import APIRouter, HTTPException, Request
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import UploadFile
 
-from ..utils.ingest import load_and_ingest_documents, load_and_ingest_url
+from ..utils.ingest import LOADER_MAPPING
+from ..utils.jobs import job_queue
+from ..utils.namespaces import request_namespace
 
 router = APIRouter()
 
+# size of the blocks copied from the upload to disk
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# 0 disables the limit
+ingest_max_file_bytes = int(os.getenv("INGEST_MAX_FILE_BYTES", str(100 * 1024**2)))
+ingest_max_upload_bytes = int(os.getenv("INGEST_MAX_UPLOAD_BYTES", str(500 * 1024**2)))
 
-@router.post("/ingest")
-async def ingest(files: List[UploadFile] = File(...)):
-    # Create a temporary directory to store the uploaded files
-    temp_dir = "temp_uploads"
-    os.makedirs(temp_dir, exist_ok=True)
 
+def _exceeds(size: int, limit: int) -> bool:
+    return bool(limit) and size > limit
+
+
+def _check_content_length(request: Request):
+    """
+    Rejects an upload declared larger than INGEST_MAX_UPLOAD_BYTES before its
+    body is read, the form parser would otherwise spool all of it first
+    """
+    if not ingest_max_upload_bytes:
+        return
+    content_length = request.headers.get("content-length")
+    if content_length is None:
+        raise HTTPException(status_code=411, detail="Content-Length required")
+    if not content_length.isdigit():
+        raise HTTPException(status_code=400, detail="Invalid Content-Length")
+    if _exceeds(int(content_length), ingest_max_upload_bytes):
+        raise HTTPException(
+            status_code=413, detail=f"Upload exceeds {ingest_max_upload_bytes} bytes"
+        )
+
+
+def _save_upload(file: UploadFile, file_path: str, uploaded_bytes: int) -> int:
+    """
+    Copies an upload to disk in fixed-size blocks, enforcing the size limits.
+    Returns the number of bytes written.
+    """
+    written = 0
+    with open(file_path, "wb") as f:
+        while chunk := file.file.read(UPLOAD_CHUNK_SIZE):
+            written += len(chunk)
+            if _exceeds(written, ingest_max_file_bytes):
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"'{file.filename}' exceeds {ingest_max_file_bytes} bytes",
+                )
+            if _exceeds(uploaded_bytes + written, ingest_max_upload_bytes):
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"Upload exceeds {ingest_max_upload_bytes} bytes",
+                )
+            f.write(chunk)
+    return written
+
+
+def _namespace(request: Request) -> Optional[str]:
     try:
-        # Save the uploaded files to the temporary directory
-        saved_files = []
-        for file in files:
-            file_path = os.path.join(temp_dir, file.filename)
-            with open(file_path, "wb") as f:
-                f.write(file.file.read())
-            saved_files.append(file_path)
+        return request_namespace(request.headers, request.query_params)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-        # Load and ingest documents from the temporary directory
-        load_and_ingest_documents(temp_dir, ignored_files=[])
 
-        # For now, we'll just return a success message
-        result = {"message": "Documents loaded and ingested successfully"}
+# the form is parsed by the handler, after the Content-Length check
+_UPLOAD_BODY = {
+    "required": True,
+    "content": {
+        "multipart/form-data": {
+            "schema": {
+                "type": "object",
+                "required": ["files"],
+                "properties": {
+                    "files": {
+                        "type": "array",
+                        "items": {"type": "string", "format": "binary"},
+                    }
+                },
+            }
+        }
+    },
+}
 
-        return result
 
+@router.post("/ingest", openapi_extra={"requestBody": _UPLOAD_BODY})
+async def ingest(request: Request):
+    namespace = _namespace(request)
+    _check_content_length(request)
+    form = await request.form()
+    try:
+        return await _ingest_files(
+            [file for file in form.getlist("files") if isinstance(file, UploadFile)],
+            namespace,
+        )
     finally:
-        # Clean up: Delete the temporary directory and its contents
-        for file_path in saved_files:
-            os.remove(file_path)
-        os.rmdir(temp_dir)
+        await form.close()
+
+
+async def _ingest_files(files: List[UploadFile], namespace: Optional[str]):
+    if not files:
+        raise HTTPException(status_code=422, detail="No files uploaded in 'files'")
+    # Reject unsupported files before anything is written to disk
+    for file in files:
+        ext = os.path.splitext(file.filename or "")[1]
+        if ext not in LOADER_MAPPING:
+            raise HTTPException(
+                status_code=415, detail=f"Unsupported file extension '{ext}'"
+            )
+
+    # Each job gets its own directory, removed once the job has finished
+    job_id, job_dir = job_queue.new_upload_dir()
+
+    try:
+        # Stream the uploaded files to the job directory
+        uploaded_bytes = 0
+        for index, file in enumerate(files):
+            file_name = os.path.basename(file.filename)
+            if os.path.exists(os.path.join(job_dir, file_name)):
+                file_name = f"{index}_{file_name}"
+            uploaded_bytes += await run_in_threadpool(
+                _save_upload, file, os.path.join(job_dir, file_name), uploaded_bytes
+            )
+    except BaseException:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        raise
+
+    # Parsing, embedding and upserting run in the background job queue
+    job_queue.submit(
+        "documents", {"source_dir": job_dir, "namespace": namespace}, job_id=job_id
+    )
+    return {"message": "Documents queued for ingestion", "jobId": job_id}
 
 
 @router.post("/ingest-url")
 async def ingest_url(request: Request):
+    namespace = _namespace(request)
     body = await request.body()
     data = json.loads(body)
-    load_and_ingest_url(data["url"])
-    result = {"message": "Documents loaded and ingested successfully"}
-    return result
+    payload = {"url": data["url"], "namespace": namespace}
+    # crawl the site from `url` instead of ingesting only that page
+    if data.get("crawl"):
+        payload.update(
+            crawl=True, max_depth=data.get("maxDepth"), max_pages=data.get("maxPages")
+        )
+    job_id = job_queue.submit("url", payload)
+    return {"message": "URL queued for ingestion", "jobId": job_id}
+
+
+@router.get("/ingest/jobs/{job_id}")
+def ingest_job_status(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job '{job_id}'")
+    return humps.camelize(job)
@@ -0,0 +1,175 @@
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+from .namespaces import NamespaceLRU
+
+# load your credentials from .env file
+load_dotenv()
+
+pinecone_namespace = os.getenv("PINECONE_NAMESPACE")
+
+# minimum cosine similarity between two standalone questions to reuse an answer
+answer_cache_threshold = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.97"))
+# seconds an answer stays valid
+answer_cache_ttl = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+# maximum number of cached answers, 0 disables the cache
+answer_cache_max_entries = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+# touched whenever ingestion or deletion changes the corpus of a namespace,
+# shared by all workers
+corpus_version_path = os.getenv(
+    "CORPUS_VERSION_PATH", os.path.join(".cache", "corpus_version")
+)
+
+
+def _corpus_version_path(namespace: Optional[str]) -> str:
+    return f"{corpus_version_path}-{namespace or 'default'}"
+
+
+def corpus_version(namespace: Optional[str] = pinecone_namespace) -> int:
+    try:
+        return os.stat(_corpus_version_path(namespace)).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def mark_corpus_changed(namespace: Optional[str] = pinecone_namespace):
+    """
+    Invalidates the cached answers of a namespace in every worker, call after
+    the vector store contents changed
+    """
+    path = _corpus_version_path(namespace)
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(str(time.time_ns()))
+
+
+class _Partition:
+    """Cached answers of one namespace"""
+
+    def __init__(self, namespace: Optional[str]):
+        self.namespace = namespace
+        self.version = corpus_version(namespace)
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        # (answer, camelized source documents json, created_at)
+        self.entries: List[Tuple[str, str, float]] = []
+
+    def check_version(self):
+        version = corpus_version(self.namespace)
+        if version != self.version:
+            self.version = version
+            self.vectors = np.zeros((0, 0), dtype=np.float32)
+            self.entries = []
+
+
+class SemanticAnswerCache:
+    """
+    In-process cache of finished answers keyed by the embedding of the
+    standalone question, partitioned by namespace so tenants never see each
+    other's answers.
+
+    A lookup is a single matrix-vector product over the normalised question
+    embeddings of the namespace; the best match is a hit when its cosine
+    similarity reaches `threshold` and it is younger than `ttl`. Entries of
+    a namespace are dropped as soon as its corpus version changes, and an
+    answer is only stored if the corpus did not change since its lookup.
+    """
+
+    def __init__(self, threshold: float, ttl: float, max_entries: int):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._partitions = NamespaceLRU()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def _partition(self, namespace: Optional[str]) -> _Partition:
+        partition = self._partitions.get(namespace, lambda: _Partition(namespace))
+        partition.check_version()
+        return partition
+
+    def lookup(
+        self, embedding: List[float], namespace: Optional[str] = pinecone_namespace
+    ) -> Tuple[Optional[Tuple[str, str]], int]:
+        """
+        Returns (answer, source documents json) of the closest question, or
+        None, and the corpus version to pass to `store`
+        """
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= max(np.linalg.norm(query), 1e-12)
+        with self._lock:
+            partition = self._partition(namespace)
+            version = partition.version
+            if partition.entries:
+                scores = partition.vectors @ query
+                best = int(np.argmax(scores))
+                answer, source_documents, created_at = partition.entries[best]
+                if (
+                    scores[best] >= self.threshold
+                    and time.time() - created_at < self.ttl
+                ):
+                    self.hits += 1
+                    return (answer, source_documents), version
+            self.misses += 1
+            return None, version
+
+    def store(
+        self,
+        embedding: List[float],
+        answer: str,
+        source_documents: str,
+        version: int,
+        namespace: Optional[str] = pinecone_namespace,
+    ):
+        """
+        Caches an answer unless the corpus changed since the lookup that
+        returned `version`, the answer may then rest on deleted chunks
+        """
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector /= max(np.linalg.norm(vector), 1e-12)
+        now = time.time()
+        with self._lock:
+            partition = self._partition(namespace)
+            if partition.version != version:
+                return
+            # drop expired entries, then the oldest ones beyond max_entries
+            live = [
+                i
+                for i, (_, _, created_at) in enumerate(partition.entries)
+                if now - created_at < self.ttl
+            ]
+            live = live[max(len(live) - self.max_entries + 1, 0) :]
+            partition.entries = [partition.entries[i] for i in live]
+            partition.entries.append((answer, source_documents, now))
+            partition.vectors = (
+                np.vstack([partition.vectors[live], vector[None, :]])
+                if live
+                else vector[None, :]
+            )
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "entries": sum(
+                len(partition.entries) for partition in self._partitions.values()
+            ),
+            "namespaces": len(self._partitions.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+answer_cache = SemanticAnswerCache(
+    answer_cache_threshold, answer_cache_ttl, answer_cache_max_entries
+)
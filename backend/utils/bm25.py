@@ -0,0 +1,537 @@
+import asyncio
+import math
+import os
+import re
+import shutil
+import threading
+import time
+import weakref
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain.docstore.document import Document
+from langchain.schema import BaseRetriever
+
+from .doclog import (
+    DocumentLog,
+    file_lock,
+    file_stamp,
+    read_json,
+    truncate_file,
+    write_json,
+)
+from .metrics import span
+from .vectorstore import vector_store_backend
+
+# load your credentials from .env file
+load_dotenv()
+
+pinecone_namespace = os.getenv("PINECONE_NAMESPACE")
+
+# maintain the lexical index during ingestion
+bm25_index_enabled = os.getenv("BM25_INDEX", "true").lower() == "true"
+bm25_index_dir = os.getenv("BM25_INDEX_DIR", os.path.join(".cache", "bm25"))
+# fuse lexical and dense results in the chat retriever
+hybrid_retrieval = os.getenv("HYBRID_RETRIEVAL", "true").lower() == "true"
+# seconds to wait for the vector store before answering from the lexical index
+dense_retrieval_timeout = float(os.getenv("DENSE_RETRIEVAL_TIMEOUT", "1.5"))
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+# segments are merged into one once there are more than this many
+BM25_MAX_SEGMENTS = 8
+# buffered postings are flushed to a new segment past this size
+BM25_SEGMENT_POSTINGS = 4_000_000
+# query terms present in more than this fraction of chunks are skipped
+MAX_TERM_DOC_FRACTION = 0.5
+# tokens longer than this are hashes or base64 noise
+MAX_TOKEN_LENGTH = 64
+RRF_K = 60
+
+# words, plus identifiers joined by - . / : # so part numbers and error codes
+# such as "AB-1234" or "E0x80070005" stay searchable as one term
+_TOKEN = re.compile(r"\w+(?:[-./:#]\w+)*")
+_TOKEN_SEPARATOR = re.compile(r"[-./:#]")
+# fmt: off
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "do", "does", "for",
+    "from", "has", "have", "how", "i", "in", "is", "it", "its", "of", "on",
+    "or", "that", "the", "this", "to", "was", "what", "when", "where",
+    "which", "who", "why", "will", "with", "you", "your",
+}
+# fmt: on
+
+# lexical retrievals, fused ones and answers served without the vector store
+hybrid_stats: Counter = Counter()
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercased terms of `text`. Compound identifiers are kept whole and also
+    split into their parts, so "AB-1234" matches both "ab-1234" and "1234".
+    """
+    tokens = []
+    for token in _TOKEN.findall(text.lower()):
+        if len(token) > MAX_TOKEN_LENGTH:
+            continue
+        if token not in STOPWORDS:
+            tokens.append(token)
+        parts = _TOKEN_SEPARATOR.split(token)
+        if len(parts) > 1:
+            tokens.extend(part for part in parts if part and part not in STOPWORDS)
+    return tokens
+
+
+class _Segment:
+    """Immutable postings of one commit: term -> (start, length) into two arrays"""
+
+    def __init__(self, directory: str):
+        self.terms: Dict[str, List[int]] = read_json(
+            os.path.join(directory, "terms.json")
+        )
+        size = sum(length for _, length in self.terms.values())
+        self.rows = self.tfs = None
+        if size:
+            self.rows = np.memmap(
+                os.path.join(directory, "rows.bin"),
+                dtype=np.int32,
+                mode="r",
+                shape=(size,),
+            )
+            self.tfs = np.memmap(
+                os.path.join(directory, "tfs.bin"),
+                dtype=np.uint16,
+                mode="r",
+                shape=(size,),
+            )
+
+
+class BM25Index:
+    """
+    On-disk BM25 inverted index over the ingested chunks.
+
+    Chunks are buffered in memory by `add` and written by `commit` as an
+    immutable segment: a term -> (offset, length) table and memory-mapped
+    row and term frequency arrays. Document lengths are a memory-mapped int32
+    array and texts share the `DocumentLog` format of the local vector store.
+    A query only touches the postings of its own terms, which are scored and
+    accumulated with numpy. Segments are merged once there are more than
+    `max_segments`, dropping the postings of deleted rows.
+
+    Buffered chunks stay in memory until `commit`, which holds an exclusive
+    file lock and appends after the rows committed on disk, so several
+    processes can write to one index. Every call first reloads the segments
+    and tombstones if another process changed them.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        k1: float = BM25_K1,
+        b: float = BM25_B,
+        max_segments: int = BM25_MAX_SEGMENTS,
+    ):
+        self._dir = directory
+        self.k1 = k1
+        self.b = b
+        self.max_segments = max_segments
+        self._lock = threading.RLock()
+        self._lock_path = os.path.normpath(self._dir) + ".lock"
+        os.makedirs(self._dir, exist_ok=True)
+
+        self._docs = DocumentLog(self._dir)
+        self._segments: Dict[str, _Segment] = {}
+        self._reset_pending()
+        with file_lock(self._lock_path, shared=True):
+            self._load_info()
+            self._remap()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self._dir, name)
+
+    def _reset_pending(self):
+        # postings use rows relative to the first buffered chunk, the rows
+        # are only assigned when the segment is committed
+        self._pending: Dict[str, Tuple[List[int], List[int]]] = {}
+        self._pending_lens: List[int] = []
+        self._pending_postings = 0
+        self._pending_docs: List[Tuple[str, str, dict]] = []
+        self._pending_ids: Dict[str, int] = {}
+        self._pending_deleted: Set[int] = set()
+
+    def _load_info(self):
+        self._info_stamp = file_stamp(self._path("info.json"))
+        info = read_json(self._path("info.json")) or {}
+        self._count = info.get("count", 0)
+        self._total_len = info.get("total_len", 0)
+        self._segment_names: List[str] = info.get("segments", [])
+        self._next_segment = info.get("next_segment", 0)
+
+    def _write_info(self):
+        write_json(
+            self._path("info.json"),
+            {
+                "count": self._count,
+                "total_len": self._total_len,
+                "segments": self._segment_names,
+                "next_segment": self._next_segment,
+            },
+        )
+        self._info_stamp = file_stamp(self._path("info.json"))
+
+    def _refresh(self):
+        """
+        Pick up segments and tombstones written by other processes, called
+        holding the file lock
+        """
+        deleted_changed = self._docs.refresh()
+        if file_stamp(self._path("info.json")) != self._info_stamp:
+            self._load_info()
+            self._docs.invalidate()
+            self._remap()
+        elif deleted_changed:
+            self._deleted_rows()
+
+    def _remap(self):
+        """Memory-map the committed segments and document lengths"""
+        self._docs.remap(self._count)
+        self._segments = {
+            name: self._segments.get(name) or _Segment(self._path(name))
+            for name in self._segment_names
+        }
+        self._doclens = (
+            np.memmap(
+                self._path("doclens.bin"),
+                dtype=np.int32,
+                mode="r",
+                shape=(self._count,),
+            )
+            if self._count
+            else None
+        )
+        self._deleted_rows()
+
+    def _deleted_rows(self):
+        deleted = np.fromiter(self._docs.deleted, dtype=np.int64)
+        self._deleted = deleted[deleted < self._count]
+
+    def __len__(self) -> int:
+        return self._count - len(self._docs.deleted)
+
+    def add(self, chunks: List[Document], ids: List[str]):
+        """Buffer chunks for the next segment, searchable after `commit`"""
+        with self._lock:
+            for chunk, id_ in zip(chunks, ids):
+                row = len(self._pending_lens)
+                self._pending_ids[id_] = row
+                self._pending_docs.append((id_, chunk.page_content, chunk.metadata))
+                terms = Counter(tokenize(chunk.page_content))
+                self._pending_lens.append(sum(terms.values()))
+                for term, tf in terms.items():
+                    rows, tfs = self._pending.setdefault(term, ([], []))
+                    rows.append(row)
+                    tfs.append(tf)
+                self._pending_postings += len(terms)
+            full = self._pending_postings >= BM25_SEGMENT_POSTINGS
+        if full:
+            self.commit()
+
+    def commit(self):
+        """Write the buffered chunks as a new segment and make them searchable"""
+        with file_lock(self._lock_path), self._lock:
+            if not self._pending_lens:
+                return
+            # other processes may have committed since this one last looked
+            self._refresh()
+            start_row = self._count
+            ids, texts, metadatas = zip(*self._pending_docs)
+            self._docs.append(start_row, ids, texts, metadatas)
+            name = f"segment-{self._next_segment:06d}"
+            self._write_segment(
+                name,
+                (
+                    (term, np.asarray(rows) + start_row, np.asarray(tfs))
+                    for term, (rows, tfs) in self._pending.items()
+                ),
+            )
+            truncate_file(self._path("doclens.bin"), self._count * 4)
+            with open(self._path("doclens.bin"), "ab") as f:
+                f.write(np.asarray(self._pending_lens, dtype=np.int32).tobytes())
+            # chunks deleted while they were buffered
+            if self._pending_deleted:
+                self._docs.delete_rows(start_row + row for row in self._pending_deleted)
+
+            self._count += len(self._pending_lens)
+            self._total_len += sum(self._pending_lens)
+            self._segment_names.append(name)
+            self._next_segment += 1
+            self._reset_pending()
+            self._write_info()
+            self._remap()
+            if len(self._segment_names) > self.max_segments:
+                self._merge_segments()
+
+    def _write_segment(self, name: str, postings):
+        directory = self._path(name)
+        os.makedirs(directory, exist_ok=True)
+        terms = {}
+        offset = 0
+        with open(os.path.join(directory, "rows.bin"), "wb") as rows_file, open(
+            os.path.join(directory, "tfs.bin"), "wb"
+        ) as tfs_file:
+            for term, rows, tfs in postings:
+                if not len(rows):
+                    continue
+                rows_file.write(rows.astype(np.int32).tobytes())
+                tfs_file.write(np.minimum(tfs, 65535).astype(np.uint16).tobytes())
+                terms[term] = [offset, len(rows)]
+                offset += len(rows)
+        write_json(os.path.join(directory, "terms.json"), terms)
+
+    def _merge_segments(self):
+        """Stream every segment into a single one, one term at a time"""
+        segments = [self._segments[name] for name in self._segment_names]
+        vocabulary = set()
+        for segment in segments:
+            vocabulary.update(segment.terms)
+        deleted = self._deleted
+
+        def postings():
+            for term in vocabulary:
+                rows, tfs = [], []
+                for segment in segments:
+                    if term in segment.terms:
+                        start, length = segment.terms[term]
+                        rows.append(segment.rows[start : start + length])
+                        tfs.append(segment.tfs[start : start + length])
+                rows, tfs = np.concatenate(rows), np.concatenate(tfs)
+                if len(deleted):
+                    live = ~np.isin(rows, deleted)
+                    rows, tfs = rows[live], tfs[live]
+                yield term, rows, tfs
+
+        name = f"segment-{self._next_segment:06d}"
+        print(f"Merging {len(segments)} BM25 segments...")
+        self._write_segment(name, postings())
+        merged = self._segment_names
+        self._segment_names = [name]
+        self._next_segment += 1
+        self._write_info()
+        self._remap()
+        for old_name in merged:
+            shutil.rmtree(self._path(old_name), ignore_errors=True)
+
+    def delete(self, ids: List[str]):
+        with file_lock(self._lock_path), self._lock:
+            self._pending_deleted.update(
+                self._pending_ids[id_] for id_ in ids if id_ in self._pending_ids
+            )
+            self._refresh()
+            if self._count:
+                self._docs.delete(ids)
+                self._deleted_rows()
+
+    def clear(self):
+        with file_lock(self._lock_path), self._lock:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            os.makedirs(self._dir, exist_ok=True)
+            self._load_info()
+            self._reset_pending()
+            self._docs.reset()
+            self._remap()
+
+    def search(self, query: str, k: int = 4) -> List[Tuple[Document, float]]:
+        """Top `k` committed chunks by BM25 score"""
+        terms = set(tokenize(query))
+        # shared, so no other process rewrites the files while rows are read
+        with file_lock(self._lock_path, shared=True):
+            with self._lock:
+                self._refresh()
+                count, total_len = self._count, self._total_len
+                segments = list(self._segments.values())
+                doclens, deleted = self._doclens, self._deleted
+            if not terms or not count:
+                return []
+            avgdl = max(total_len / count, 1.0)
+            matches = []
+            for term in terms:
+                ranges = [
+                    (segment, *segment.terms[term])
+                    for segment in segments
+                    if term in segment.terms
+                ]
+                df = sum(length for _, _, length in ranges)
+                if df:
+                    matches.append((df, ranges))
+            # terms found in most chunks add almost nothing to the score but
+            # dominate the cost, skip them unless nothing else matched
+            common = count * MAX_TERM_DOC_FRACTION
+            if any(df <= common for df, _ in matches):
+                matches = [(df, ranges) for df, ranges in matches if df <= common]
+
+            row_parts, score_parts = [], []
+            for df, ranges in matches:
+                idf = math.log(1.0 + (count - df + 0.5) / (df + 0.5))
+                for segment, start, length in ranges:
+                    rows = segment.rows[start : start + length]
+                    tfs = segment.tfs[start : start + length].astype(np.float32)
+                    norm = self.k1 * (1.0 - self.b + self.b * doclens[rows] / avgdl)
+                    row_parts.append(rows)
+                    score_parts.append(idf * tfs * (self.k1 + 1.0) / (tfs + norm))
+            if not row_parts:
+                return []
+
+            rows = np.concatenate(row_parts)
+            scores = np.concatenate(score_parts)
+            if len(rows) * 16 < count:
+                # few postings: accumulate over the matched rows only
+                rows, inverse = np.unique(rows, return_inverse=True)
+                scores = np.bincount(inverse, weights=scores)
+                if len(deleted):
+                    scores[np.isin(rows, deleted)] = 0.0
+            else:
+                # many postings: accumulate into a dense score per row
+                scores = np.bincount(rows, weights=scores, minlength=count)
+                scores[deleted] = 0.0
+                rows = np.arange(count)
+
+            k = min(k, int(np.count_nonzero(scores)))
+            if not k:
+                return []
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [(self._docs.read(int(rows[i]))[1], float(scores[i])) for i in top]
+
+
+# weak, an index is released once no retriever or ingestion uses it anymore
+_indexes: "weakref.WeakValueDictionary[str, BM25Index]" = weakref.WeakValueDictionary()
+_indexes_lock = threading.Lock()
+
+
+def get_bm25_index(
+    namespace: Optional[str] = pinecone_namespace,
+) -> Optional[BM25Index]:
+    """
+    Shared lexical index of a vector store namespace, None when BM25_INDEX is
+    disabled
+    """
+    if not bm25_index_enabled:
+        return None
+    directory = os.path.join(
+        bm25_index_dir, f"{vector_store_backend}-{namespace or 'default'}"
+    )
+    with _indexes_lock:
+        index = _indexes.get(directory)
+        if index is None:
+            index = _indexes[directory] = BM25Index(directory)
+        return index
+
+
+def _document_key(doc: Document) -> tuple:
+    return doc.page_content, doc.metadata.get("source"), doc.metadata.get("page")
+
+
+def reciprocal_rank_fusion(
+    ranked_lists: List[List[Document]], weights: List[float], k: int
+) -> List[Document]:
+    """Weighted reciprocal rank fusion of several rankings of the same corpus"""
+    scores: Dict[tuple, float] = {}
+    documents: Dict[tuple, Document] = {}
+    for docs, weight in zip(ranked_lists, weights):
+        for rank, doc in enumerate(docs):
+            key = _document_key(doc)
+            documents.setdefault(key, doc)
+            scores[key] = scores.get(key, 0.0) + weight / (RRF_K + rank + 1)
+    best = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [documents[key] for key in best]
+
+
+# runs the dense half of synchronous hybrid retrievals
+_dense_executor = ThreadPoolExecutor(thread_name_prefix="dense-retrieval")
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Fuses the dense retriever with the BM25 index by reciprocal rank fusion.
+
+    The lexical lookup runs while the vector store is queried. If the vector
+    store has not answered within `dense_timeout` seconds the lexical results
+    are served on their own; with no lexical match the dense query is awaited
+    anyway.
+    """
+
+    dense: BaseRetriever
+    index: BM25Index
+    k: int = 4
+    dense_timeout: float = 1.5
+    dense_weight: float = 1.0
+    lexical_weight: float = 1.0
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _fuse(
+        self, dense: List[Document], lexical: List[Tuple[Document, float]]
+    ) -> List[Document]:
+        hybrid_stats["fused"] += 1
+        return reciprocal_rank_fusion(
+            [dense, [doc for doc, _ in lexical]],
+            [self.dense_weight, self.lexical_weight],
+            self.k,
+        )
+
+    def _lexical_only(self, lexical: List[Tuple[Document, float]]) -> List[Document]:
+        hybrid_stats["lexical_fallback"] += 1
+        print("Vector store exceeded its latency budget, serving lexical results")
+        return [doc for doc, _ in lexical[: self.k]]
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        deadline = time.monotonic() + self.dense_timeout
+        dense_future = _dense_executor.submit(
+            self.dense.get_relevant_documents,
+            query,
+            callbacks=run_manager.get_child(),
+        )
+        lexical = self.index.search(query, self.k * 2)
+        try:
+            dense = dense_future.result(timeout=max(deadline - time.monotonic(), 0))
+        except FutureTimeoutError:
+            if lexical:
+                return self._lexical_only(lexical)
+            hybrid_stats["dense_waited"] += 1
+            dense = dense_future.result()
+        return self._fuse(dense, lexical)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        deadline = time.monotonic() + self.dense_timeout
+        dense_task = asyncio.ensure_future(
+            self.dense.aget_relevant_documents(query, callbacks=run_manager.get_child())
+        )
+        with span("lexical_search"):
+            lexical = await asyncio.get_running_loop().run_in_executor(
+                None, self.index.search, query, self.k * 2
+            )
+        try:
+            dense = await asyncio.wait_for(
+                asyncio.shield(dense_task),
+                timeout=max(deadline - time.monotonic(), 0),
+            )
+        except asyncio.TimeoutError:
+            if lexical:
+                dense_task.cancel()
+                return self._lexical_only(lexical)
+            hybrid_stats["dense_waited"] += 1
+            dense = await dense_task
+        return self._fuse(dense, lexical)
@@ -1,20 +1,27 @@
 import os
+from itertools import zip_longest
 from operator import itemgetter
 from typing import Dict, List, Optional
 
-import pinecone
 from dotenv import load_dotenv
-from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
-from langchain.chat_models import ChatOpenAI
-from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.schema import AIMessage, HumanMessage
+from langchain.docstore.document import Document
+from langchain.schema import (AIMessage, BaseMessage, BaseRetriever,
+                              HumanMessage)
 from langchain.schema.output_parser import StrOutputParser
 from langchain.schema.runnable import (RunnableBranch, RunnableLambda,
                                        RunnableMap, RunnablePassthrough)
-from langchain.vectorstores import Pinecone
 from pydantic import BaseModel
 
+from .bm25 import (HybridRetriever, dense_retrieval_timeout, get_bm25_index,
+                   hybrid_retrieval)
+from .clients import clients
+from .condense_cache import (condense_cache, condense_key,
+                             condense_skip_self_contained, is_self_contained)
+from .embedding_cache import get_embeddings
+from .namespaces import NamespaceLRU
 from .prompts import CONDENSE_QUESTION_PROMPT, QA_PROMPT
+from .token_budget import format_documents, prompt_packer
+from .vectorstore import AsyncVectorStoreRetriever, get_vectorstore
 
 # load your credentials from .env file
 load_dotenv()
@@ -27,6 +34,17 @@ pinecone_namespace = os.getenv("PINECONE_NAMESPACE")
 # Set the number of documents to retrieve from Pinecone
 target_source_docs = 4
 context_window = 10
+# maximum number of /api/chat requests served concurrently per worker
+chat_max_concurrency = int(os.getenv("CHAT_MAX_CONCURRENCY", "64"))
+# concurrent requests with the same question and history share one answer
+chat_coalesce = os.getenv("CHAT_COALESCE", "true").lower() == "true"
+# chunks a coalesced answer keeps for subscribers behind the producer, those
+# further behind are disconnected
+chat_coalesce_max_lag = int(os.getenv("CHAT_COALESCE_MAX_LAG", "2048"))
+# retrieve with the raw follow-up while the question is being condensed
+speculative_retrieval = os.getenv("SPECULATIVE_RETRIEVAL", "false").lower() == "true"
+# word overlap above which the speculative results are kept as they are
+speculative_keep_threshold = float(os.getenv("SPECULATIVE_KEEP_THRESHOLD", "0.8"))
 
 env_vars = [
     "OPENAI_API_KEY",
@@ -35,13 +53,8 @@ env_vars = [
     "PINECONE_INDEX_NAME",
 ]
 
-# initialize Pinecone with credentials
-pinecone.init(api_key=pinecone_api_key, environment=pinecone_environment)
-
-# initialize OpenAIEmbeddings and chat models with credentials
-embeddings = OpenAIEmbeddings(
-    model="text-embedding-ada-002", openai_api_key=openai_api_key
-)
+# initialize the (cached) OpenAIEmbeddings shared with ingestion
+embeddings = get_embeddings()
 
 
 def convert_source_documents(source_list: List):
@@ -68,47 +81,98 @@ def convert_source_documents(source_list: List):
     return src_docs
 
 
-# change model to gpt-4 if you have access to the api
-llm = ChatOpenAI(
-    model_name="gpt-3.5-turbo",
-    temperature=0,
-    openai_api_key=openai_api_key,
-    verbose=True,
-    streaming=True,
-    callbacks=[StreamingStdOutCallbackHandler()],
-)
-
-# initialize retrieval chain
-if os.getenv("PINECONE_NAMESPACE"):
-    vectorstore = Pinecone.from_existing_index(
-        index_name=pinecone_index,
-        embedding=embeddings,
-        text_key="text",
-        namespace=pinecone_namespace,
+def build_retriever(namespace: Optional[str] = pinecone_namespace) -> BaseRetriever:
+    """
+    Retrieval over a namespace (Pinecone or local, see VECTOR_STORE), fused
+    with its lexical index when HYBRID_RETRIEVAL is on
+    """
+    vectorstore = get_vectorstore(embeddings, namespace)
+    bm25_index = get_bm25_index(namespace)
+    if hybrid_retrieval and bm25_index is not None:
+        # dense candidates are fused with the lexical ones down to target_source_docs
+        return HybridRetriever(
+            dense=AsyncVectorStoreRetriever(
+                vectorstore=vectorstore, search_kwargs={"k": target_source_docs * 2}
+            ),
+            index=bm25_index,
+            k=target_source_docs,
+            dense_timeout=dense_retrieval_timeout,
+        )
+    return AsyncVectorStoreRetriever(
+        vectorstore=vectorstore, search_kwargs={"k": target_source_docs}
     )
-else:
-    vectorstore = Pinecone.from_existing_index(pinecone_index, embeddings)
 
-retriever = vectorstore.as_retriever(search_kwargs={"k": 4})
+
+# warm retrievers of the most recently used namespaces, their vector stores
+# and lexical indexes are released once evicted
+retrievers = NamespaceLRU()
+
+
+def get_retriever(namespace: Optional[str] = pinecone_namespace) -> BaseRetriever:
+    return retrievers.get(namespace, lambda: build_retriever(namespace))
+
+
+def question_overlap(question: str, standalone_question: str) -> float:
+    """Jaccard similarity of the lower-cased words of two questions"""
+    words = set(question.lower().split())
+    standalone_words = set(standalone_question.lower().split())
+    if not words or not standalone_words:
+        return 0.0
+    return len(words & standalone_words) / len(words | standalone_words)
+
+
+def merge_documents(
+    primary: List[Document], secondary: List[Document], k: int
+) -> List[Document]:
+    """Interleaves two result lists, dropping duplicates, keeping the top k"""
+    merged = []
+    seen = set()
+    for pair in zip_longest(primary, secondary):
+        for doc in pair:
+            if doc is None:
+                continue
+            key = (
+                doc.page_content,
+                doc.metadata.get("source"),
+                doc.metadata.get("page"),
+            )
+            if key not in seen:
+                seen.add(key)
+                merged.append(doc)
+    return merged[:k]
 
 
 def get_chat_history_window(chat_history: List, context_window=4) -> List:
     return chat_history[-(context_window * 2) :]
 
 
-def _format_chat_history(
-    chat_history: List,
-) -> List:
+def to_chat_messages(chat_history: List) -> List[BaseMessage]:
+    """
+    Chat messages from the request format, without the source documents
+    appended to the answers. Messages of a server-side session pass through.
+    """
     buffer = []
     for msg in chat_history:
-        if msg["role"] == "user":
+        if isinstance(msg, BaseMessage):
+            buffer.append(msg)
+        elif msg["role"] == "user":
             buffer.append(HumanMessage(content=msg["content"]))
         else:
             buffer.append(
                 AIMessage(content=msg["content"].split("##SOURCE_DOCUMENTS##")[0])
             )
+    return buffer
 
-    return get_chat_history_window(buffer, context_window)
+
+def _format_chat_history(chat_history: List, record: bool = False) -> List:
+    """
+    Chat messages of the history window, trimmed to the newest ones that fit
+    in HISTORY_TOKEN_BUDGET
+    """
+    return prompt_packer.pack_history(
+        get_chat_history_window(to_chat_messages(chat_history), context_window),
+        record=record,
+    )
 
 
 # User input
@@ -117,29 +181,70 @@ class ChatHistory(BaseModel):
     chat_history: Optional[List[Dict[str, str]]]
 
 
+_condense_question_chain = (
+    CONDENSE_QUESTION_PROMPT
+    | clients.deferred_chat_model(temperature=0)
+    | StrOutputParser()
+)
+
+
+def _condense_inputs(x: Dict) -> tuple:
+    """Returns (memo key, condense prompt inputs, standalone question if known)"""
+    chat_history = _format_chat_history(x["chat_history"])
+    if condense_skip_self_contained and is_self_contained(x["question"]):
+        condense_cache.skip()
+        return None, None, x["question"]
+    key = condense_key(chat_history, x["question"])
+    inputs = {"question": x["question"], "chat_history": chat_history}
+    return key, inputs, condense_cache.get(key)
+
+
+def _condense_question(x: Dict) -> str:
+    key, inputs, standalone_question = _condense_inputs(x)
+    if standalone_question is None:
+        standalone_question = _condense_question_chain.invoke(inputs)
+        condense_cache.put(key, standalone_question)
+    return standalone_question
+
+
+async def _acondense_question(x: Dict) -> str:
+    key, inputs, standalone_question = _condense_inputs(x)
+    if standalone_question is None:
+        standalone_question = await _condense_question_chain.ainvoke(inputs)
+        condense_cache.put(key, standalone_question)
+    return standalone_question
+
+
 _search_query = RunnableBranch(
     # If input includes chat_history, we condense it with the follow-up question
     (
         RunnableLambda(lambda x: bool(x.get("chat_history"))).with_config(
             run_name="HasChatHistoryCheck"
-        ),  # Condense follow-up question and chat into a standalone_question
-        RunnablePassthrough.assign(
-            chat_history=lambda x: _format_chat_history(x["chat_history"])
-        )
-        | CONDENSE_QUESTION_PROMPT
-        | ChatOpenAI(temperature=0)
-        | StrOutputParser(),
+        ),  # Condense follow-up question and chat into a standalone_question,
+        # unless it is memoized or already self-contained
+        RunnableLambda(_condense_question, afunc=_acondense_question).with_config(
+            run_name="CondenseQuestion"
+        ),
     ),
     # Else, we have no chat history, so just pass through the question
     RunnableLambda(itemgetter("question")),
 )
 
-_inputs = RunnableMap(
+# question, formatted chat history and the standalone question used for retrieval
+_question_inputs = RunnableMap(
     {
         "question": lambda x: x["question"],
-        "chat_history": lambda x: _format_chat_history(x["chat_history"]),
-        "context": _search_query | retriever,
+        # the condense step formats the same history, saved tokens are recorded once
+        "chat_history": lambda x: _format_chat_history(x["chat_history"], record=True),
+        "standalone_question": _search_query,
     }
 ).with_types(input_type=ChatHistory)
 
-chain = QA_PROMPT | ChatOpenAI() | StrOutputParser()
+# expects context already packed with prompt_packer.pack_context
+chain = (
+    RunnablePassthrough.assign(context=lambda x: format_documents(x["context"]))
+    | QA_PROMPT
+    # change model to gpt-4 if you have access to the api
+    | clients.deferred_chat_model(model_name="gpt-3.5-turbo")
+    | StrOutputParser()
+)
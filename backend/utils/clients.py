@@ -0,0 +1,291 @@
+import os
+import threading
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional
+
+from dotenv import load_dotenv
+from langchain.schema.embeddings import Embeddings
+from langchain.schema.runnable import Runnable, RunnableConfig
+
+# openai, httpx, pinecone and the langchain model classes are imported on first
+# use, they account for most of the import time of the app
+
+# load your credentials from .env file
+load_dotenv()
+
+openai_api_key = os.getenv("OPENAI_API_KEY")
+# same variable langchain reads, e.g. for a proxy or a compatible server
+openai_api_base = os.getenv("OPENAI_API_BASE")
+pinecone_api_key = os.getenv("PINECONE_API_KEY")
+pinecone_environment = os.getenv("PINECONE_ENVIRONMENT")
+# index endpoint, e.g. a local emulator; derived from the index name when unset
+pinecone_index_host = os.getenv("PINECONE_INDEX_HOST")
+
+# connections each worker keeps to the OpenAI API, size it to CHAT_MAX_CONCURRENCY
+openai_max_connections = int(os.getenv("OPENAI_MAX_CONNECTIONS", "64"))
+openai_max_keepalive_connections = int(
+    os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "32")
+)
+# seconds an idle keep-alive connection stays open
+openai_keepalive_expiry = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))
+# threads (and pooled connections) per Pinecone index client
+pinecone_pool_threads = int(os.getenv("PINECONE_POOL_THREADS", "4"))
+
+# seconds, (read, connect)
+OPENAI_TIMEOUT = (600.0, 10.0)
+# handed to langchain models in place of the http client they would otherwise
+# open per instance; their requests go through the registry pools instead
+_DEFERRED_HTTP_CLIENT = object()
+
+
+class _PooledResource:
+    """
+    Stands in for an OpenAI API resource such as `chat.completions` and
+    resolves it on the current pooled client at every call, so objects built
+    once keep working after the registry reopens its clients
+    """
+
+    def __init__(self, resolve: Callable[[], Any]):
+        self._resolve = resolve
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._resolve(), name)
+
+
+class DeferredRunnable(Runnable):
+    """
+    Runnable built by `factory` on its first call, so chains can be composed
+    at import time without importing or constructing the model behind them
+    """
+
+    def __init__(self, factory: Callable[[], Runnable]):
+        self._factory = factory
+        self._runnable: Optional[Runnable] = None
+        self._lock = threading.Lock()
+
+    def _resolve(self) -> Runnable:
+        with self._lock:
+            if self._runnable is None:
+                self._runnable = self._factory()
+            return self._runnable
+
+    def invoke(
+        self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> Any:
+        return self._resolve().invoke(input, config, **kwargs)
+
+    async def ainvoke(
+        self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> Any:
+        return await self._resolve().ainvoke(input, config, **kwargs)
+
+    def stream(
+        self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> Iterator[Any]:
+        yield from self._resolve().stream(input, config, **kwargs)
+
+    async def astream(
+        self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> AsyncIterator[Any]:
+        async for chunk in self._resolve().astream(input, config, **kwargs):
+            yield chunk
+
+    def transform(
+        self,
+        input: Iterator[Any],
+        config: Optional[RunnableConfig] = None,
+        **kwargs: Any,
+    ) -> Iterator[Any]:
+        yield from self._resolve().transform(input, config, **kwargs)
+
+    async def atransform(
+        self,
+        input: AsyncIterator[Any],
+        config: Optional[RunnableConfig] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[Any]:
+        async for chunk in self._resolve().atransform(input, config, **kwargs):
+            yield chunk
+
+
+class DeferredEmbeddings(Embeddings):
+    """Embeddings built by `factory` on the first embedding request"""
+
+    def __init__(self, factory: Callable[[], Embeddings]):
+        self._factory = factory
+        self._embeddings: Optional[Embeddings] = None
+        self._lock = threading.Lock()
+
+    def _resolve(self) -> Embeddings:
+        with self._lock:
+            if self._embeddings is None:
+                self._embeddings = self._factory()
+            return self._embeddings
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._resolve().embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._resolve().embed_query(text)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self._resolve().aembed_documents(texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await self._resolve().aembed_query(text)
+
+
+class ClientRegistry:
+    """
+    Process wide OpenAI and Pinecone clients.
+
+    One sync and one async OpenAI client share keep-alive connection pools
+    for every chat model and embeddings object of the worker, and Pinecone is
+    initialised once with one pooled client per index. Clients are created on
+    first use or at lifespan startup, and the OpenAI pools are closed at
+    lifespan shutdown.
+    """
+
+    def __init__(
+        self,
+        max_connections: int,
+        max_keepalive_connections: int,
+        keepalive_expiry: float,
+        pool_threads: int,
+    ):
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.pool_threads = pool_threads
+        self._lock = threading.Lock()
+        self._openai = None
+        self._async_openai = None
+        self._pinecone_ready = False
+        self._pinecone_indexes: Dict[str, Any] = {}
+
+    def _http_client_args(self) -> Dict[str, Any]:
+        import httpx
+
+        read_timeout, connect_timeout = OPENAI_TIMEOUT
+        return {
+            "limits": httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+            "timeout": httpx.Timeout(read_timeout, connect=connect_timeout),
+        }
+
+    def openai_client(self) -> Any:
+        with self._lock:
+            if self._openai is None:
+                import httpx
+                import openai
+
+                self._openai = openai.OpenAI(
+                    api_key=openai_api_key,
+                    base_url=openai_api_base,
+                    http_client=httpx.Client(**self._http_client_args()),
+                )
+            return self._openai
+
+    def async_openai_client(self) -> Any:
+        with self._lock:
+            if self._async_openai is None:
+                import httpx
+                import openai
+
+                self._async_openai = openai.AsyncOpenAI(
+                    api_key=openai_api_key,
+                    base_url=openai_api_base,
+                    http_client=httpx.AsyncClient(**self._http_client_args()),
+                )
+            return self._async_openai
+
+    def use_pool(self, model: Any, resource: str) -> Any:
+        """
+        Point a langchain OpenAI model at the pooled clients, `resource` is
+        the API path such as "chat.completions" or "embeddings"
+        """
+
+        def resolver(client: Callable[[], Any]) -> Callable[[], Any]:
+            def resolve():
+                target = client()
+                for name in resource.split("."):
+                    target = getattr(target, name)
+                return target
+
+            return resolve
+
+        model.client = _PooledResource(resolver(self.openai_client))
+        model.async_client = _PooledResource(resolver(self.async_openai_client))
+        return model
+
+    def chat_model(self, **kwargs: Any) -> Any:
+        """ChatOpenAI on the pooled clients"""
+        from langchain.chat_models import ChatOpenAI
+
+        return self.use_pool(
+            ChatOpenAI(
+                openai_api_key=openai_api_key,
+                http_client=_DEFERRED_HTTP_CLIENT,
+                **kwargs,
+            ),
+            "chat.completions",
+        )
+
+    def embeddings(self, **kwargs: Any) -> Embeddings:
+        """OpenAIEmbeddings on the pooled clients"""
+        from langchain.embeddings import OpenAIEmbeddings
+
+        return self.use_pool(
+            OpenAIEmbeddings(
+                openai_api_key=openai_api_key,
+                http_client=_DEFERRED_HTTP_CLIENT,
+                **kwargs,
+            ),
+            "embeddings",
+        )
+
+    def deferred_chat_model(self, **kwargs: Any) -> Runnable:
+        return DeferredRunnable(lambda: self.chat_model(**kwargs))
+
+    def deferred_embeddings(self, **kwargs: Any) -> Embeddings:
+        return DeferredEmbeddings(lambda: self.embeddings(**kwargs))
+
+    def pinecone_index(self, index_name: str) -> Any:
+        import pinecone
+
+        with self._lock:
+            if not self._pinecone_ready:
+                pinecone.init(
+                    api_key=pinecone_api_key, environment=pinecone_environment
+                )
+                self._pinecone_ready = True
+            if index_name not in self._pinecone_indexes:
+                index = pinecone.Index(index_name, pool_threads=self.pool_threads)
+                if pinecone_index_host:
+                    index.configuration.host = pinecone_index_host
+                self._pinecone_indexes[index_name] = index
+            return self._pinecone_indexes[index_name]
+
+    def start(self):
+        """Open the OpenAI connection pools ahead of the first request"""
+        self.openai_client()
+        self.async_openai_client()
+
+    async def aclose(self):
+        with self._lock:
+            sync_client, self._openai = self._openai, None
+            async_client, self._async_openai = self._async_openai, None
+        if sync_client is not None:
+            sync_client.close()
+        if async_client is not None:
+            await async_client.close()
+
+
+clients = ClientRegistry(
+    openai_max_connections,
+    openai_max_keepalive_connections,
+    openai_keepalive_expiry,
+    pinecone_pool_threads,
+)
@@ -0,0 +1,174 @@
+import asyncio
+import hashlib
+import json
+from collections import deque
+from typing import (AsyncIterator, Awaitable, Callable, Dict, Hashable, List,
+                    Optional, Tuple)
+
+from langchain.schema import BaseMessage
+
+
+def coalesce_key(
+    namespace: Optional[str], question: str, chat_history: List[BaseMessage]
+) -> Tuple[Optional[str], str, str]:
+    """
+    Requests with the same key get the same answer: the namespace, the
+    question with case and whitespace normalized, and a hash of the history
+    """
+    history = json.dumps([[message.type, message.content] for message in chat_history])
+    return (
+        namespace,
+        " ".join(question.lower().split()),
+        hashlib.sha256(history.encode("utf8")).hexdigest(),
+    )
+
+
+class FlightLagged(Exception):
+    """A subscriber fell further behind the producer than the flight keeps"""
+
+
+class Flight:
+    """
+    One upstream chat generation and the requests subscribed to it.
+
+    The producer appends chunks to the flight's log and never waits for its
+    subscribers. Each subscriber reads the log through its own cursor, so a
+    slow client only delays its own response. The log keeps the last
+    `max_lag` chunks: a subscriber further behind is disconnected with
+    FlightLagged. Subscribers joining late replay the log from the start, as
+    long as none of it was dropped.
+    """
+
+    def __init__(self, key: Hashable, max_lag: int = 2048):
+        self.key = key
+        # set once retrieval is done (or failed), before anything is streamed
+        self.ready = asyncio.Event()
+        self.retrieval_path: Optional[str] = None
+        self.answer = ""
+        self.error: Optional[BaseException] = None
+        self.done = False
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._chunks: deque = deque(maxlen=max_lag)
+        # chunks published so far, including those dropped from the log
+        self._published = 0
+        self._changed = asyncio.Condition()
+
+    def mark_ready(self, retrieval_path: str):
+        self.retrieval_path = retrieval_path
+        self.ready.set()
+
+    @property
+    def replayable(self) -> bool:
+        """Whether the log still starts with the first chunk"""
+        return self._published == len(self._chunks)
+
+    async def publish(self, chunk: str):
+        self._chunks.append(chunk)
+        self._published += 1
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def finish(self, error: Optional[BaseException] = None):
+        self.error = error
+        self.done = True
+        self.ready.set()
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def stream(self) -> AsyncIterator[str]:
+        """
+        Yields the chunks of the flight, raises if the producer failed or
+        with FlightLagged if this subscriber fell too far behind
+        """
+        position = 0
+        while True:
+            while position < self._published:
+                dropped = self._published - len(self._chunks)
+                if position < dropped:
+                    raise FlightLagged(
+                        f"Subscriber fell more than {self._chunks.maxlen} "
+                        "chunks behind"
+                    )
+                position += 1
+                yield self._chunks[position - 1 - dropped]
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            async with self._changed:
+                await self._changed.wait_for(
+                    lambda: self.done or position < self._published
+                )
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent requests with the same key onto one flight. A flight
+    runs as its own task, so it keeps serving its other subscribers when the
+    request that started it goes away, and is cancelled once none are left.
+    Flights keep at most `max_lag` chunks (see Flight).
+    """
+
+    def __init__(self, enabled: bool = True, max_lag: int = 2048):
+        self.enabled = enabled
+        self.max_lag = max_lag
+        self.flights = 0
+        self.coalesced = 0
+        self._flights: Dict[Hashable, Flight] = {}
+
+    def join(
+        self, key: Hashable, produce: Callable[[Flight], Awaitable[None]]
+    ) -> Tuple[Flight, bool]:
+        """
+        Subscribes to the flight of `key`, starting one with `produce` when
+        none is in flight. Returns (flight, whether it was already in flight).
+        Call `leave` once done with the flight.
+        """
+        flight = self._flights.get(key) if self.enabled else None
+        # a flight that dropped the start of its log can't be replayed, a
+        # new one replaces it for the requests arriving from now on
+        coalesced = flight is not None and flight.replayable
+        if coalesced:
+            self.coalesced += 1
+        else:
+            self.flights += 1
+            flight = Flight(key, self.max_lag)
+            if self.enabled:
+                self._flights[key] = flight
+            flight.task = asyncio.create_task(self._run(flight, produce))
+        flight.subscribers += 1
+        return flight, coalesced
+
+    def leave(self, flight: Flight):
+        flight.subscribers -= 1
+        if not flight.subscribers and not flight.done:
+            # every client went away, stop generating for nobody
+            self._forget(flight)
+            flight.task.cancel()
+
+    def _forget(self, flight: Flight):
+        # requests arriving from now on start a new flight (or hit the
+        # answer cache)
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    async def _run(self, flight: Flight, produce: Callable[[Flight], Awaitable[None]]):
+        try:
+            await produce(flight)
+            await flight.finish()
+        except BaseException as e:
+            await flight.finish(e)
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            self._forget(flight)
+
+    def stats(self) -> Dict[str, float]:
+        total = self.flights + self.coalesced
+        return {
+            "in_flight": len(self._flights),
+            "flights": self.flights,
+            "coalesced": self.coalesced,
+            "coalesced_rate": self.coalesced / total if total else 0.0,
+        }
@@ -0,0 +1,104 @@
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+from langchain.schema import BaseMessage
+
+# load your credentials from .env file
+load_dotenv()
+
+# maximum number of memoized standalone questions, 0 disables the memo
+condense_cache_max_entries = int(os.getenv("CONDENSE_CACHE_MAX_ENTRIES", "2048"))
+# skip the condense LLM call for follow-ups that already stand on their own
+condense_skip_self_contained = (
+    os.getenv("CONDENSE_SKIP_SELF_CONTAINED", "true").lower() == "true"
+)
+# shorter follow-ups are always condensed
+SELF_CONTAINED_MIN_WORDS = 5
+
+# words that point back into the conversation
+# fmt: off
+_REFERENCE_WORDS = {
+    "it", "its", "it's", "they", "them", "their", "theirs", "this", "that",
+    "these", "those", "he", "him", "his", "she", "her", "hers", "there",
+    "above", "previous", "earlier", "former", "latter", "same", "else",
+    "another", "other", "more", "again", "one", "ones",
+}
+# fmt: on
+_FOLLOW_UP_PREFIXES = ("and ", "but ", "also ", "so ", "what about", "how about")
+_WORD = re.compile(r"[a-z']+")
+
+
+def is_self_contained(question: str) -> bool:
+    """
+    Cheap check that a follow-up can be used for retrieval as is: long
+    enough and free of pronouns or phrases that refer to earlier turns
+    """
+    text = question.strip().lower()
+    words = _WORD.findall(text)
+    if len(words) < SELF_CONTAINED_MIN_WORDS or text.startswith(_FOLLOW_UP_PREFIXES):
+        return False
+    return not _REFERENCE_WORDS.intersection(words)
+
+
+def condense_key(chat_history: List[BaseMessage], question: str) -> str:
+    digest = hashlib.sha256()
+    for message in chat_history:
+        digest.update(f"{message.type}:{message.content}\x00".encode("utf8"))
+    digest.update(question.encode("utf8"))
+    return digest.hexdigest()
+
+
+class CondenseCache:
+    """
+    LRU memo of standalone questions keyed by a hash of the windowed chat
+    history and the follow-up, with counters for how often the condense
+    LLM call was avoided
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.llm_calls = 0
+        self.memo_hits = 0
+        self.self_contained = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            standalone_question = self._entries.get(key)
+            if standalone_question is not None:
+                self._entries.move_to_end(key)
+                self.memo_hits += 1
+            return standalone_question
+
+    def put(self, key: str, standalone_question: str):
+        with self._lock:
+            self.llm_calls += 1
+            if not self.max_entries:
+                return
+            self._entries[key] = standalone_question
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def skip(self):
+        with self._lock:
+            self.self_contained += 1
+
+    def stats(self) -> Dict[str, float]:
+        avoided = self.memo_hits + self.self_contained
+        total = avoided + self.llm_calls
+        return {
+            "llm_calls": self.llm_calls,
+            "memo_hits": self.memo_hits,
+            "self_contained": self.self_contained,
+            "avoided_rate": avoided / total if total else 0.0,
+        }
+
+
+condense_cache = CondenseCache(condense_cache_max_entries)
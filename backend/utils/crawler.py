@@ -0,0 +1,535 @@
+import asyncio
+import hashlib
+import json
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from html.parser import HTMLParser
+from typing import Dict, Iterator, List, Optional, Set
+from urllib.parse import urldefrag, urljoin, urlparse
+from urllib.robotparser import RobotFileParser
+from xml.etree import ElementTree
+
+from dotenv import load_dotenv
+from langchain.docstore.document import Document
+
+from .vectorstore import vector_store_backend
+
+# load your credentials from .env file
+load_dotenv()
+
+pinecone_namespace = os.getenv("PINECONE_NAMESPACE")
+
+# defaults of a crawl, /api/ingest-url can lower or raise them per request
+crawl_max_depth = int(os.getenv("CRAWL_MAX_DEPTH", "3"))
+crawl_max_pages = int(os.getenv("CRAWL_MAX_PAGES", "1000"))
+# connections of the crawler's pool, and at most this many per host
+crawl_max_connections = int(os.getenv("CRAWL_MAX_CONNECTIONS", "32"))
+crawl_host_connections = int(os.getenv("CRAWL_HOST_CONNECTIONS", "8"))
+# seconds between two requests to the same host, robots.txt may ask for more
+crawl_host_delay = float(os.getenv("CRAWL_HOST_DELAY", "0"))
+# seconds per request
+crawl_timeout = float(os.getenv("CRAWL_TIMEOUT", "30"))
+crawl_cache_dir = os.getenv("CRAWL_CACHE_DIR", os.path.join(".cache", "crawl"))
+
+CRAWL_USER_AGENT = "python-chatbot-starter"
+# sitemaps listed by another sitemap are followed this deep
+MAX_SITEMAP_DEPTH = 2
+# links to files that are not web pages are not followed
+_SKIPPED_EXTENSIONS = re.compile(
+    r"\.(png|jpe?g|gif|svg|webp|ico|css|js|json|xml|pdf|zip|gz|tar|mp3|mp4|"
+    r"webm|woff2?|ttf|eot)$",
+    re.IGNORECASE,
+)
+_HTML_TYPES = ("text/html", "application/xhtml+xml")
+_SKIPPED_TAGS = {"script", "style", "noscript", "template", "svg"}
+# tags that end a line of text
+_BLOCK_TAGS = {
+    "address", "article", "aside", "blockquote", "br", "dd", "div", "dl", "dt",
+    "figcaption", "footer", "form", "h1", "h2", "h3", "h4", "h5", "h6",
+    "header", "hr", "li", "main", "nav", "ol", "p", "pre", "section", "table",
+    "td", "th", "tr", "ul",
+}  # fmt: skip
+
+_DONE = object()
+
+
+class _PageParser(HTMLParser):
+    """
+    Title, description, language, visible text and link targets of an HTML
+    page. The metadata keys and placeholders are those of langchain's
+    WebBaseLoader, which ingested single pages before the crawler.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = ""
+        self.description: Optional[str] = None
+        self.language: Optional[str] = None
+        self.links: List[str] = []
+        self._parts: List[str] = []
+        self._skipped = 0
+        self._in_title = False
+
+    def handle_starttag(self, tag: str, attrs: list):
+        if tag in _SKIPPED_TAGS:
+            self._skipped += 1
+        elif tag == "title":
+            self._in_title = True
+        elif tag == "a":
+            href = dict(attrs).get("href")
+            if href:
+                self.links.append(href)
+        elif tag == "meta" and dict(attrs).get("name") == "description":
+            self.description = dict(attrs).get("content") or "No description found."
+        elif tag == "html" and self.language is None:
+            self.language = dict(attrs).get("lang") or "No language found."
+        if tag in _BLOCK_TAGS:
+            self._parts.append("\n")
+
+    def handle_endtag(self, tag: str):
+        if tag in _SKIPPED_TAGS and self._skipped:
+            self._skipped -= 1
+        elif tag == "title":
+            self._in_title = False
+        if tag in _BLOCK_TAGS:
+            self._parts.append("\n")
+
+    def handle_data(self, data: str):
+        if self._in_title:
+            self.title += data
+        elif not self._skipped:
+            self._parts.append(data)
+
+    def text(self) -> str:
+        lines = (" ".join(line.split()) for line in "".join(self._parts).splitlines())
+        return "\n".join(line for line in lines if line)
+
+    def metadata(self, url: str) -> dict:
+        metadata = {"source": url}
+        title = " ".join(self.title.split())
+        if title:
+            metadata["title"] = title
+        if self.description is not None:
+            metadata["description"] = self.description
+        if self.language is not None:
+            metadata["language"] = self.language
+        return metadata
+
+
+def normalize_url(url: str) -> str:
+    url, _ = urldefrag(url.strip())
+    parsed = urlparse(url)
+    # http://host and http://host/ are the same page
+    return parsed._replace(path=parsed.path or "/").geturl()
+
+
+class CrawledPage:
+    """A new or changed page, with what is needed to record it once ingested"""
+
+    def __init__(
+        self,
+        url: str,
+        documents: List[Document],
+        stale_ids: List[str],
+        etag: Optional[str],
+        last_modified: Optional[str],
+        sha256: str,
+        links: List[str],
+    ):
+        self.url = url
+        self.documents = documents
+        self.stale_ids = stale_ids
+        self.etag = etag
+        self.last_modified = last_modified
+        self.sha256 = sha256
+        self.links = links
+
+
+class PageCache:
+    """
+    Persistent record of every ingested page: validators (ETag and
+    Last-Modified) for conditional requests, content hash, outgoing links and
+    the IDs of the vectors its chunks produced.
+
+    Unchanged pages are answered with 304 or hash to the same content and
+    are skipped, their cached links keep the crawl going. Pages ingested
+    incompletely keep their IDs without a hash, so the next crawl fetches
+    them unconditionally and deletes those IDs first.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, sha256 TEXT, "
+            "links TEXT NOT NULL, chunk_ids TEXT NOT NULL, fetched_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, url: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT etag, last_modified, sha256, links, chunk_ids "
+                "FROM pages WHERE url = ?",
+                (url,),
+            ).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, sha256, links, chunk_ids = row
+        return {
+            "etag": etag,
+            "last_modified": last_modified,
+            "sha256": sha256,
+            "links": json.loads(links),
+            "chunk_ids": json.loads(chunk_ids),
+        }
+
+    def touch(self, url: str, etag: Optional[str], last_modified: Optional[str]):
+        """Refresh the validators of an unchanged page"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE pages SET etag = COALESCE(?, etag), "
+                "last_modified = COALESCE(?, last_modified), fetched_at = ? "
+                "WHERE url = ?",
+                (etag, last_modified, time.time(), url),
+            )
+            self._conn.commit()
+
+    def record(self, page: CrawledPage, chunk_ids: List[str], complete: bool = True):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pages (url, etag, last_modified, sha256, "
+                "links, chunk_ids, fetched_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    page.url,
+                    page.etag if complete else None,
+                    page.last_modified if complete else None,
+                    page.sha256 if complete else None,
+                    json.dumps(page.links),
+                    json.dumps(chunk_ids),
+                    time.time(),
+                ),
+            )
+            self._conn.commit()
+
+    def forget(self, urls: List[str]):
+        """Drop pages whose vectors were deleted, the next crawl ingests them"""
+        with self._lock:
+            self._conn.executemany(
+                "DELETE FROM pages WHERE url = ?", [(url,) for url in urls]
+            )
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM pages")
+            self._conn.commit()
+
+
+class SiteCrawler:
+    """
+    Fetches a page, and in crawl mode the pages listed by the site's
+    sitemaps and the same-site pages linked from it, breadth first up to
+    `max_depth` links away and `max_pages` pages.
+
+    Requests go through one async connection pool with at most
+    `host_connections` concurrent requests and `host_delay` seconds between
+    requests per host; crawls honour robots.txt. New and changed pages are
+    handed over to the caller's thread through a bounded queue, so fetching
+    stays ahead of ingestion without holding the whole site in memory.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        cache: PageCache,
+        crawl: bool = False,
+        max_depth: Optional[int] = None,
+        max_pages: Optional[int] = None,
+        max_connections: int = crawl_max_connections,
+        host_connections: int = crawl_host_connections,
+        host_delay: float = crawl_host_delay,
+        timeout: float = crawl_timeout,
+    ):
+        self.start_url = normalize_url(url)
+        self.host = urlparse(self.start_url).netloc
+        self.cache = cache
+        self.crawl = crawl
+        # a single page unless crawling, CRAWL_MAX_* when not given
+        if not crawl:
+            max_depth, max_pages = 0, 1
+        self.max_depth = crawl_max_depth if max_depth is None else max_depth
+        self.max_pages = crawl_max_pages if max_pages is None else max_pages
+        self.max_connections = max_connections
+        self.host_connections = host_connections
+        self.host_delay = host_delay
+        self.timeout = timeout
+        # pages new or changed, unchanged (304 or same content), failed,
+        # skipped for a content type other than HTML or plain text, or not
+        # fetched because robots.txt disallows them
+        self.counts = {
+            "changed": 0,
+            "unchanged": 0,
+            "failed": 0,
+            "unsupported": 0,
+            "disallowed": 0,
+        }
+        # why failed and unsupported pages were not ingested, by url
+        self.errors: Dict[str, str] = {}
+        self._seen: Set[str] = set()
+        self._scheduled = 0
+        self._robots: Optional[RobotFileParser] = None
+        self._host_slots: Dict[str, asyncio.Semaphore] = {}
+        self._host_next: Dict[str, float] = {}
+        self._cancelled = threading.Event()
+
+    def iter_pages(self) -> Iterator[CrawledPage]:
+        """Crawls on a background thread and yields new and changed pages"""
+        results: queue.Queue = queue.Queue(maxsize=self.max_connections)
+        thread = threading.Thread(
+            target=lambda: asyncio.run(self._run(results)), name="crawler"
+        )
+        thread.start()
+        try:
+            while True:
+                item = results.get()
+                if item is _DONE:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            self._cancelled.set()
+            thread.join()
+
+    def _hand_over(self, results: queue.Queue, item) -> bool:
+        while not self._cancelled.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    async def _run(self, results: queue.Queue):
+        import httpx
+
+        try:
+            async with httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.max_connections),
+                timeout=self.timeout,
+                follow_redirects=True,
+                headers={"User-Agent": CRAWL_USER_AGENT},
+            ) as client:
+                frontier: asyncio.Queue = asyncio.Queue()
+                self._enqueue(frontier, self.start_url, 0)
+                if self.crawl:
+                    await self._load_robots(client)
+                    for url in await self._sitemap_urls(client):
+                        self._enqueue(frontier, url, 1)
+                workers = [
+                    asyncio.create_task(self._worker(client, frontier, results))
+                    for _ in range(self.max_connections)
+                ]
+                await frontier.join()
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+        except BaseException as e:
+            await asyncio.to_thread(self._hand_over, results, e)
+        finally:
+            await asyncio.to_thread(self._hand_over, results, _DONE)
+
+    def _allowed(self, url: str) -> bool:
+        parsed = urlparse(url)
+        if parsed.scheme not in ("http", "https") or parsed.netloc != self.host:
+            return False
+        if _SKIPPED_EXTENSIONS.search(parsed.path):
+            return False
+        if self._robots is not None and not self._robots.can_fetch(
+            CRAWL_USER_AGENT, url
+        ):
+            self.counts["disallowed"] += 1
+            return False
+        return True
+
+    def _enqueue(self, frontier: asyncio.Queue, url: str, depth: int):
+        url = normalize_url(url)
+        if url in self._seen or self._scheduled >= self.max_pages:
+            return
+        self._seen.add(url)
+        if url != self.start_url and not self._allowed(url):
+            return
+        self._scheduled += 1
+        frontier.put_nowait((url, depth))
+
+    async def _get(self, client, url: str, headers: Optional[dict] = None):
+        """GET within the politeness limits of the url's host"""
+        host = urlparse(url).netloc
+        if host not in self._host_slots:
+            self._host_slots[host] = asyncio.Semaphore(self.host_connections)
+        async with self._host_slots[host]:
+            delay = self.host_delay
+            if self._robots is not None and host == self.host:
+                delay = max(
+                    delay, float(self._robots.crawl_delay(CRAWL_USER_AGENT) or 0)
+                )
+            if delay:
+                # requests start at least `delay` seconds apart
+                now = time.monotonic()
+                start = max(now, self._host_next.get(host, now))
+                self._host_next[host] = start + delay
+                await asyncio.sleep(start - now)
+            return await client.get(url, headers=headers or {})
+
+    async def _load_robots(self, client):
+        robots_url = urljoin(self.start_url, "/robots.txt")
+        try:
+            response = await self._get(client, robots_url)
+        except Exception as e:
+            print(f"Could not fetch {robots_url}: {e}")
+            return
+        if response.status_code == 200:
+            self._robots = RobotFileParser(robots_url)
+            self._robots.parse(response.text.splitlines())
+
+    async def _sitemap_urls(self, client) -> List[str]:
+        sitemaps = (self._robots.site_maps() if self._robots else None) or [
+            urljoin(self.start_url, "/sitemap.xml")
+        ]
+        urls: List[str] = []
+        seen: Set[str] = set()
+        pending = [(sitemap, 0) for sitemap in sitemaps]
+        while pending and len(urls) < self.max_pages:
+            sitemap, depth = pending.pop(0)
+            if sitemap in seen:
+                continue
+            seen.add(sitemap)
+            try:
+                response = await self._get(client, sitemap)
+                if response.status_code != 200:
+                    continue
+                root = ElementTree.fromstring(response.content)
+            except Exception as e:
+                print(f"Could not read sitemap {sitemap}: {e}")
+                continue
+            # <urlset> lists pages, <sitemapindex> lists more sitemaps
+            locs = [
+                element.text.strip()
+                for element in root.iter()
+                if element.tag.endswith("loc") and element.text
+            ]
+            if root.tag.endswith("sitemapindex"):
+                if depth < MAX_SITEMAP_DEPTH:
+                    pending.extend((loc, depth + 1) for loc in locs)
+            else:
+                urls.extend(locs)
+        return urls
+
+    async def _worker(self, client, frontier: asyncio.Queue, results: queue.Queue):
+        while True:
+            url, depth = await frontier.get()
+            try:
+                if not self._cancelled.is_set():
+                    links = await self._visit(client, url, results)
+                    if depth < self.max_depth:
+                        for link in links:
+                            self._enqueue(frontier, link, depth + 1)
+            except Exception as e:
+                self._skip(url, "failed", str(e))
+            finally:
+                frontier.task_done()
+
+    async def _visit(self, client, url: str, results: queue.Queue) -> List[str]:
+        """Fetches `url`, hands it over when new or changed, returns its links"""
+        entry = await asyncio.to_thread(self.cache.get, url)
+        headers = {}
+        if entry and entry["sha256"]:
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        response = await self._get(client, url, headers)
+        etag = response.headers.get("etag")
+        last_modified = response.headers.get("last-modified")
+        if response.status_code == 304:
+            self.counts["unchanged"] += 1
+            await asyncio.to_thread(self.cache.touch, url, etag, last_modified)
+            return entry["links"]
+        if response.status_code != 200:
+            self._skip(url, "failed", f"HTTP {response.status_code}")
+            return []
+
+        content_type = response.headers.get("content-type", "").split(";")[0]
+        sha256 = hashlib.sha256(response.content).hexdigest()
+        if content_type in _HTML_TYPES:
+            parser = _PageParser()
+            parser.feed(response.text)
+            base = str(response.url)
+            links = [urljoin(base, link) for link in parser.links]
+            text, metadata = parser.text(), parser.metadata(url)
+        elif content_type == "text/plain":
+            links, text, metadata = [], response.text, {"source": url}
+        else:
+            self._skip(url, "unsupported", f"unsupported content type '{content_type}'")
+            return []
+
+        if entry and entry["sha256"] == sha256:
+            self.counts["unchanged"] += 1
+            await asyncio.to_thread(self.cache.touch, url, etag, last_modified)
+            return links
+        page = CrawledPage(
+            url,
+            [Document(page_content=text, metadata=metadata)] if text else [],
+            entry["chunk_ids"] if entry else [],
+            etag,
+            last_modified,
+            sha256,
+            links,
+        )
+        self.counts["changed"] += 1
+        await asyncio.to_thread(self._hand_over, results, page)
+        return links
+
+    def _skip(self, url: str, count: str, reason: str):
+        self.counts[count] += 1
+        self.errors[url] = reason
+        print(f"Could not crawl {url}: {reason}")
+
+    def summary(self) -> str:
+        counts = self.counts
+        return (
+            f"Crawled {self.start_url}: {counts['changed']} new or changed pages, "
+            f"{counts['unchanged']} unchanged, {counts['failed']} failed, "
+            f"{counts['unsupported']} of unsupported content types, "
+            f"{counts['disallowed']} disallowed by robots.txt"
+        )
+
+
+_caches: Dict[str, PageCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_page_cache(namespace: Optional[str] = pinecone_namespace) -> PageCache:
+    """
+    Crawled pages are tracked per backend and namespace, like the ingest
+    manifest, since their vector IDs only mean something in that index
+    """
+    path = os.path.join(
+        crawl_cache_dir, f"{vector_store_backend}-{namespace or 'default'}.sqlite"
+    )
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = PageCache(path)
+        return _caches[path]
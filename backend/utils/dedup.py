@@ -0,0 +1,451 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import uuid
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+from langchain.docstore.document import Document
+
+from .embedding_cache import normalize_text
+from .vectorstore import vector_store_backend
+
+# load your credentials from .env file
+load_dotenv()
+
+pinecone_namespace = os.getenv("PINECONE_NAMESPACE")
+
+# minimum estimated Jaccard similarity of two chunks' word shingles for the
+# second one to be dropped at ingestion, 0 disables deduplication
+dedup_threshold = float(os.getenv("DEDUP_THRESHOLD", "0.9"))
+dedup_index_dir = os.getenv("DEDUP_INDEX_DIR", os.path.join(".cache", "dedup"))
+
+# words per shingle
+SHINGLE_WORDS = 5
+# MinHash signature length, split into LSH bands of MINHASH_PERMUTATIONS /
+# LSH_BANDS rows; 16 bands of 8 rows make chunks above ~0.7 similarity
+# candidates, the threshold is then checked on the full signatures
+MINHASH_PERMUTATIONS = 128
+LSH_BANDS = 16
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+# fixed seed, signatures are persisted and compared across runs
+_rng = np.random.RandomState(42)
+_PERM_A = _rng.randint(1, _MAX_HASH, MINHASH_PERMUTATIONS, dtype=np.uint64)
+_PERM_B = _rng.randint(0, _MAX_HASH, MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+# SQLite limits the number of bound parameters per statement
+_SQL_BATCH = 500
+# prefix of the references to chunks kept by a run but not upserted yet
+_PENDING = "pending:"
+
+
+def shingles(text: str) -> List[str]:
+    words = normalize_text(text).lower().split()
+    if len(words) <= SHINGLE_WORDS:
+        return [" ".join(words)] if words else []
+    return [
+        " ".join(words[i : i + SHINGLE_WORDS])
+        for i in range(len(words) - SHINGLE_WORDS + 1)
+    ]
+
+
+def minhash(text: str) -> Optional[np.ndarray]:
+    """MinHash signature of the word shingles of `text`, None when empty"""
+    hashes = np.array(
+        [zlib.crc32(shingle.encode("utf8")) for shingle in set(shingles(text))],
+        dtype=np.uint64,
+    )
+    if not len(hashes):
+        return None
+    # a * h + b stays below 2**64 for 32 bit a, b and h
+    permuted = (np.outer(hashes, _PERM_A) + _PERM_B) % _MERSENNE_PRIME & _MAX_HASH
+    return permuted.min(axis=0).astype(np.uint32)
+
+
+def band_keys(signature: np.ndarray) -> List[int]:
+    """One LSH bucket key per band, as signed 64 bit integers for SQLite"""
+    rows = MINHASH_PERMUTATIONS // LSH_BANDS
+    return [
+        int.from_bytes(
+            hashlib.blake2b(
+                bytes([band]) + signature[band * rows : (band + 1) * rows].tobytes(),
+                digest_size=8,
+            ).digest(),
+            "little",
+            signed=True,
+        )
+        for band in range(LSH_BANDS)
+    ]
+
+
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    """Jaccard similarity estimated from two MinHash signatures"""
+    return float(np.mean(a == b))
+
+
+def chunk_key(chunk: Document) -> str:
+    """Identifies a chunk of an ingestion run by its source and text"""
+    source = str(chunk.metadata.get("source", ""))
+    return hashlib.sha256(f"{source}\0{chunk.page_content}".encode("utf8")).hexdigest()
+
+
+class NearDuplicateIndex:
+    """
+    Persistent MinHash LSH index of the chunks in a vector store namespace,
+    keyed by vector ID so chunks deleted from the store can be forgotten.
+
+    Dropped near duplicates are kept beside it with the ID of the chunk they
+    duplicate. They get IDs like stored chunks and are tracked in the source
+    index under their own source, so deleting that source forgets them. Once
+    the chunk they duplicate is deleted they become orphans, see `orphans`.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS signatures ("
+            "id TEXT PRIMARY KEY, signature BLOB NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS bands (key INTEGER NOT NULL, id TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS bands_key ON bands (key)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS bands_id ON bands (id)")
+        # kept_id is a vector ID, or a pending reference to a chunk kept by a
+        # run that is not upserted yet
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS duplicates ("
+            "id TEXT PRIMARY KEY, kept_id TEXT NOT NULL, "
+            "signature BLOB NOT NULL, document TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS duplicates_kept_id ON duplicates (kept_id)"
+        )
+        self._conn.commit()
+
+    def candidates(self, keys: List[int]) -> Dict[str, np.ndarray]:
+        """Signatures of the indexed chunks sharing a bucket with `keys`"""
+        keys = list(set(keys))
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), _SQL_BATCH):
+                batch = keys[i : i + _SQL_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    "SELECT signatures.id, signatures.signature FROM signatures "
+                    "JOIN bands ON bands.id = signatures.id "
+                    f"WHERE bands.key IN ({placeholders})",
+                    batch,
+                ).fetchall()
+                for id_, blob in rows:
+                    found[id_] = np.frombuffer(blob, dtype=np.uint32)
+        return found
+
+    def add(self, ids: List[str], signatures: List[np.ndarray]):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO signatures (id, signature) VALUES (?, ?)",
+                [(id_, signature.tobytes()) for id_, signature in zip(ids, signatures)],
+            )
+            self._conn.executemany(
+                "INSERT INTO bands (key, id) VALUES (?, ?)",
+                [
+                    (key, id_)
+                    for id_, signature in zip(ids, signatures)
+                    for key in band_keys(signature)
+                ],
+            )
+            self._conn.commit()
+
+    def add_duplicates(
+        self,
+        ids: List[str],
+        kept_ids: List[str],
+        signatures: List[np.ndarray],
+        chunks: List[Document],
+    ):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO duplicates (id, kept_id, signature, document) "
+                "VALUES (?, ?, ?, ?)",
+                [
+                    (
+                        id_,
+                        kept_id,
+                        signature.tobytes(),
+                        json.dumps(
+                            {"text": chunk.page_content, "metadata": chunk.metadata}
+                        ),
+                    )
+                    for id_, kept_id, signature, chunk in zip(
+                        ids, kept_ids, signatures, chunks
+                    )
+                ],
+            )
+            self._conn.commit()
+
+    def resolve_duplicates(self, references: Dict[str, str]):
+        """Point duplicates of pending chunks at their vector IDs"""
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE duplicates SET kept_id = ? WHERE kept_id = ?",
+                [(kept_id, reference) for reference, kept_id in references.items()],
+            )
+            self._conn.commit()
+
+    def forget_duplicates(self, references: List[str]):
+        """Forget the duplicates of pending chunks that were never upserted"""
+        with self._lock:
+            self._conn.executemany(
+                "DELETE FROM duplicates WHERE kept_id = ?",
+                [(reference,) for reference in references],
+            )
+            self._conn.commit()
+
+    def orphans(
+        self, threshold: float = dedup_threshold
+    ) -> List[Tuple[str, Document, np.ndarray]]:
+        """
+        Duplicates whose kept chunk was deleted. Those still near another
+        indexed chunk, or near an orphan returned before them, are pointed at
+        it instead. The others are returned as (id, chunk, signature), to be
+        stored under their ID and then passed to `promote`. Until then they
+        stay orphans, so a failed promotion is retried on the next call.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, signature, document FROM duplicates "
+                "WHERE kept_id NOT LIKE ? AND NOT EXISTS "
+                "(SELECT 1 FROM signatures WHERE signatures.id = kept_id)",
+                (f"{_PENDING}%",),
+            ).fetchall()
+        orphans = []
+        for id_, blob, document in rows:
+            signature = np.frombuffer(blob, dtype=np.uint32)
+            others = list(self.candidates(band_keys(signature)).items())
+            others += [(other_id, other) for other_id, _, other in orphans]
+            kept_id = next(
+                (
+                    other_id
+                    for other_id, other in others
+                    if similarity(signature, other) >= threshold
+                ),
+                None,
+            )
+            if kept_id is None:
+                record = json.loads(document)
+                chunk = Document(
+                    page_content=record["text"], metadata=record["metadata"]
+                )
+                orphans.append((id_, chunk, signature))
+                continue
+            with self._lock:
+                self._conn.execute(
+                    "UPDATE duplicates SET kept_id = ? WHERE id = ?", (kept_id, id_)
+                )
+                self._conn.commit()
+        return orphans
+
+    def promote(self, ids: List[str], signatures: List[np.ndarray]):
+        """Index orphans stored in the vector store as kept chunks"""
+        self.add(ids, signatures)
+        with self._lock:
+            for i in range(0, len(ids), _SQL_BATCH):
+                batch = ids[i : i + _SQL_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                self._conn.execute(
+                    f"DELETE FROM duplicates WHERE id IN ({placeholders})", batch
+                )
+            self._conn.commit()
+
+    def delete(self, ids: List[str]):
+        """
+        Forget chunks and duplicates by ID, the duplicates of deleted chunks
+        become orphans
+        """
+        with self._lock:
+            for i in range(0, len(ids), _SQL_BATCH):
+                batch = ids[i : i + _SQL_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                self._conn.execute(
+                    f"DELETE FROM signatures WHERE id IN ({placeholders})", batch
+                )
+                self._conn.execute(
+                    f"DELETE FROM bands WHERE id IN ({placeholders})", batch
+                )
+                self._conn.execute(
+                    f"DELETE FROM duplicates WHERE id IN ({placeholders})", batch
+                )
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM signatures")
+            self._conn.execute("DELETE FROM bands")
+            self._conn.execute("DELETE FROM duplicates")
+            self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM signatures").fetchone()
+        return count
+
+
+class ChunkDeduplicator:
+    """
+    Drops chunks of an ingestion run that are near duplicates of a chunk
+    already in the index or kept earlier in the same run, from any source.
+    Each dropped chunk is recorded in the index with the chunk it duplicates
+    (see `NearDuplicateIndex.orphans`), so its content is stored again if
+    that chunk is deleted. Kept chunks are added to the index once upserted
+    (see `commit`), and forgotten if their batch fails (see `discard`), so a
+    failed batch does not hide its chunks from later ones.
+    """
+
+    def __init__(self, index: NearDuplicateIndex, threshold: float = dedup_threshold):
+        self.index = index
+        self.threshold = threshold
+        # references to the chunks of this run that are not upserted yet
+        self._run = uuid.uuid4().hex
+        # chunks kept by this run: bucket key -> (chunk_key, signature), and
+        # the signature of each chunk not upserted yet, by chunk_key
+        self._buckets: Dict[int, List[Tuple[str, np.ndarray]]] = {}
+        self._pending: Dict[str, np.ndarray] = {}
+
+    def _reference(self, key: str) -> str:
+        return f"{_PENDING}{self._run}:{key}"
+
+    def _duplicate_of(
+        self,
+        signature: np.ndarray,
+        keys: List[int],
+        indexed: Dict[int, List[Tuple[str, np.ndarray]]],
+    ) -> Optional[str]:
+        """Vector ID or pending reference of a near duplicate, if any"""
+        for key in keys:
+            for other_key, other in self._buckets.get(key, ()):
+                if similarity(signature, other) >= self.threshold:
+                    return self._reference(other_key)
+            for other_id, other in indexed.get(key, ()):
+                if similarity(signature, other) >= self.threshold:
+                    return other_id
+        return None
+
+    def filter(
+        self, chunks: List[Document]
+    ) -> Tuple[List[Document], List[Document], List[str]]:
+        """Returns the kept chunks, the dropped ones and the IDs they got"""
+        signatures = [minhash(chunk.page_content) for chunk in chunks]
+        keys = [
+            band_keys(signature) if signature is not None else []
+            for signature in signatures
+        ]
+        # one lookup for the whole batch, bucketed again to find the
+        # candidates of each chunk
+        indexed: Dict[int, List[Tuple[str, np.ndarray]]] = {}
+        lookup_keys = [key for chunk_keys in keys for key in chunk_keys]
+        if lookup_keys:
+            for id_, signature in self.index.candidates(lookup_keys).items():
+                for key in band_keys(signature):
+                    indexed.setdefault(key, []).append((id_, signature))
+
+        kept, dropped, kept_ids, dropped_signatures = [], [], [], []
+        for chunk, signature, chunk_keys in zip(chunks, signatures, keys):
+            kept_id = (
+                self._duplicate_of(signature, chunk_keys, indexed)
+                if signature is not None
+                else None
+            )
+            if kept_id is not None:
+                dropped.append(chunk)
+                kept_ids.append(kept_id)
+                dropped_signatures.append(signature)
+                continue
+            kept.append(chunk)
+            if signature is not None:
+                key = chunk_key(chunk)
+                self._pending[key] = signature
+                for bucket_key in chunk_keys:
+                    self._buckets.setdefault(bucket_key, []).append((key, signature))
+        dropped_ids = [str(uuid.uuid4()) for _ in dropped]
+        if dropped:
+            self.index.add_duplicates(
+                dropped_ids, kept_ids, dropped_signatures, dropped
+            )
+        return kept, dropped, dropped_ids
+
+    def commit(self, chunks: List[Document], ids: List[str]):
+        """Index the signatures of upserted chunks under their vector IDs"""
+        entries = [
+            (chunk_key(chunk), id_, self._pending.pop(chunk_key(chunk), None))
+            for chunk, id_ in zip(chunks, ids)
+        ]
+        entries = [entry for entry in entries if entry[2] is not None]
+        if entries:
+            self.index.add(
+                [id_ for _, id_, _ in entries],
+                [signature for _, _, signature in entries],
+            )
+            self.index.resolve_duplicates(
+                {self._reference(key): id_ for key, id_, _ in entries}
+            )
+
+    def discard(self, chunks: List[Document]):
+        """
+        Forget kept chunks whose batch failed, and the duplicates dropped in
+        their favour: the run fails, so their sources are ingested again
+        anyway
+        """
+        references = []
+        for chunk in chunks:
+            key = chunk_key(chunk)
+            signature = self._pending.pop(key, None)
+            if signature is None:
+                continue
+            references.append(self._reference(key))
+            for bucket_key in band_keys(signature):
+                bucket = self._buckets.get(bucket_key, [])
+                bucket[:] = [entry for entry in bucket if entry[0] != key]
+        if references:
+            self.index.forget_duplicates(references)
+
+    def close(self):
+        """Forget the duplicates of chunks the run never upserted"""
+        if self._pending:
+            self.index.forget_duplicates(
+                [self._reference(key) for key in self._pending]
+            )
+            self._pending = {}
+
+
+_indexes: Dict[str, NearDuplicateIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_dedup_index(
+    namespace: Optional[str] = pinecone_namespace,
+) -> Optional[NearDuplicateIndex]:
+    """
+    Shared near-duplicate index of a vector store namespace, None when
+    DEDUP_THRESHOLD is 0
+    """
+    if dedup_threshold <= 0:
+        return None
+    path = os.path.join(
+        dedup_index_dir, f"{vector_store_backend}-{namespace or 'default'}.sqlite"
+    )
+    with _indexes_lock:
+        if path not in _indexes:
+            _indexes[path] = NearDuplicateIndex(path)
+        return _indexes[path]
@@ -1,13 +1,22 @@
 import os
+from typing import List, Optional
 
-import pinecone
 from dotenv import load_dotenv
 
+from .answer_cache import mark_corpus_changed
+from .bm25 import get_bm25_index
+from .clients import clients
+from .crawler import get_page_cache
+from .dedup import get_dedup_index
+from .embedding_cache import get_embeddings
+from .ingest import delete_chunks
+from .manifest import get_manifest
+from .sources import get_source_index
+from .vectorstore import get_vectorstore, vector_store_backend
+
 # load your credentials from .env file
 load_dotenv()
 
-EMBEDDING_DIM = 1536
-
 openai_api_key = os.getenv("OPENAI_API_KEY")
 pinecone_api_key = os.getenv("PINECONE_API_KEY")
 pinecone_environment = os.getenv("PINECONE_ENVIRONMENT")
@@ -15,20 +24,89 @@ pinecone_index = os.getenv("PINECONE_INDEX_NAME")
 pinecone_namespace = os.getenv("PINECONE_NAMESPACE")
 
 
-def delete_all():
-    pinecone.init(
-        api_key=os.getenv("PINECONE_API_KEY"),
-        environment=os.getenv("PINECONE_ENVIRONMENT"),
-    )
-    index = pinecone.Index(pinecone_index)
+def _known_ids(namespace: Optional[str]) -> List[str]:
+    """IDs of every vector the source index or the ingest manifest knows of"""
+    ids = set(get_source_index(namespace).ids())
+    for entry in get_manifest(namespace).entries.values():
+        ids.update(entry["chunk_ids"])
+    return list(ids)
+
+
+def _clear_indexes(namespace: Optional[str]):
+    """Empties the indexes kept beside the vectors of a namespace"""
+    bm25_index = get_bm25_index(namespace)
+    if bm25_index is not None:
+        bm25_index.clear()
+    dedup_index = get_dedup_index(namespace)
+    if dedup_index is not None:
+        dedup_index.clear()
+    get_source_index(namespace).clear()
+    # files and crawled pages would be skipped as unchanged otherwise
+    get_manifest(namespace).clear()
+    get_page_cache(namespace).clear()
+
+
+def delete_all(namespace: Optional[str] = pinecone_namespace):
+    """
+    Deletes every vector of the namespace, then its side indexes. They are
+    kept when the delete fails or finds nothing to delete, so the vectors
+    left can still be found and deleted.
+    """
     try:
-        namespace = pinecone_namespace if pinecone_namespace else ""
-        index.delete(delete_all=True, namespace=namespace)
-        return "Successfully deleted"
-    except:
-        # gcp-starter does not allow deleteAll
-        # alternatively, you can delete the index and create a new one
-        # see: https://docs.pinecone.io/docs/starter-environment
-        pinecone.delete_index(pinecone_index)
-        pinecone.create_index(pinecone_index, dimension=EMBEDDING_DIM)
+        if vector_store_backend == "local":
+            get_vectorstore(get_embeddings(), namespace).delete(delete_all=True)
+            _clear_indexes(namespace)
+            return "Successfully deleted"
+
+        index = clients.pinecone_index(pinecone_index)
+        try:
+            index.delete(delete_all=True, namespace=namespace or "")
+        except Exception:
+            # gcp-starter does not allow deleteAll, delete the known vectors
+            # by ID; the index is shared with the other namespaces, so it is
+            # never deleted and recreated
+            ids = _known_ids(namespace)
+            if not ids:
+                return (
+                    "No known vectors to delete, vectors ingested before the "
+                    "source index existed must be deleted in the Pinecone console"
+                )
+            delete_chunks(ids, namespace)
+            _clear_indexes(namespace)
+            return f"Successfully deleted {len(ids)} vectors"
+        _clear_indexes(namespace)
         return "Successfully deleted"
+    finally:
+        # cached chat answers may cite the deleted documents, even when the
+        # delete failed part way
+        mark_corpus_changed(namespace)
+
+
+def delete_documents(
+    sources: List[str] = [],
+    prefixes: List[str] = [],
+    batch_ids: List[str] = [],
+    namespace: Optional[str] = pinecone_namespace,
+):
+    """
+    Deletes the vectors of the given sources (file paths or URLs), of the
+    sources starting with one of `prefixes` and of the ingestion batches (job
+    IDs), looked up in the source index instead of wiping the vector store
+    """
+    source_index = get_source_index(namespace)
+    found = source_index.find(sources, prefixes, batch_ids)
+    # files ingested incrementally before the source index existed
+    manifest = get_manifest(namespace)
+    for file_path, entry in manifest.entries.items():
+        if file_path in sources or file_path.startswith(tuple(prefixes)):
+            found.setdefault(file_path, []).extend(entry["chunk_ids"])
+
+    ids = list({id_ for chunk_ids in found.values() for id_ in chunk_ids})
+    if ids:
+        print(f"Deleting {len(ids)} vectors of {len(found)} sources...")
+        delete_chunks(ids, namespace)
+    # re-ingesting a deleted file or page must not be skipped as unchanged
+    manifest.forget(list(found))
+    manifest.save()
+    get_page_cache(namespace).forget(list(found))
+    return f"Deleted {len(ids)} vectors of {len(found)} sources"
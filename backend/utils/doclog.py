@@ -0,0 +1,171 @@
+import json
+import os
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+from langchain.docstore.document import Document
+
+try:
+    import fcntl
+except ImportError:  # Windows, the local indexes are then single process
+    fcntl = None
+
+
+def read_json(path: str) -> Any:
+    try:
+        with open(path, "r", encoding="utf8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_json(path: str, data: Any):
+    """Atomically replace a small JSON file"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def file_stamp(path: str) -> Optional[Tuple[int, int, int]]:
+    """Changes whenever the file is rewritten or replaced, None when missing"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+@contextmanager
+def file_lock(path: str, shared: bool = False) -> Iterator[None]:
+    """
+    Advisory lock between the processes using a local index: exclusive for
+    writers, shared for readers. The lock file lives beside the index
+    directory, so removing the directory does not drop the lock.
+    """
+    with open(path, "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        # closing the file releases the lock
+        yield
+
+
+def truncate_file(path: str, size: int):
+    """Drop bytes past `size`, left behind by an append that never committed"""
+    if os.path.exists(path) and os.path.getsize(path) > size:
+        os.truncate(path, size)
+
+
+class DocumentLog:
+    """
+    Append-only log of (id, text, metadata) records for the local indexes.
+
+    Records are JSON lines addressed by row through a memory-mapped byte
+    offset table, so a single document is read with one seek and nothing is
+    loaded up front. Deleted rows are kept as persistent tombstones. The
+    owner tracks the committed row count and calls `remap` after appending,
+    and `invalidate` and `refresh` when another process wrote to the log.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.deleted: Set[int] = set()
+        self._deleted_stamp = None
+        self._offsets: Optional[np.ndarray] = None
+        self._count = 0
+        self._id_to_row: Optional[Dict[str, int]] = None
+        self.refresh()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def refresh(self) -> bool:
+        """Reload the tombstones if another process deleted rows"""
+        stamp = file_stamp(self._path("deleted.json"))
+        if stamp == self._deleted_stamp:
+            return False
+        self.deleted = set(read_json(self._path("deleted.json")) or [])
+        self._deleted_stamp = stamp
+        return True
+
+    def invalidate(self):
+        """Drop the id -> row lookup, another process appended rows"""
+        self._id_to_row = None
+
+    def remap(self, count: int):
+        self._count = count
+        self._offsets = (
+            np.memmap(
+                self._path("offsets.bin"), dtype=np.int64, mode="r", shape=(count,)
+            )
+            if count
+            else None
+        )
+
+    def append(
+        self,
+        start_row: int,
+        ids: List[str],
+        texts: Iterable[str],
+        metadatas: Iterable[dict],
+    ):
+        """Write records for rows start_row, start_row + 1, ..."""
+        offsets_path = self._path("offsets.bin")
+        if (
+            os.path.exists(offsets_path)
+            and os.path.getsize(offsets_path) > start_row * 8
+        ):
+            end = np.fromfile(
+                offsets_path, dtype=np.int64, count=1, offset=start_row * 8
+            )
+            truncate_file(self._path("docs.jsonl"), int(end[0]))
+            truncate_file(offsets_path, start_row * 8)
+        offsets = []
+        with open(self._path("docs.jsonl"), "ab") as f:
+            for id_, text, metadata in zip(ids, texts, metadatas):
+                offsets.append(f.tell())
+                record = {"id": id_, "text": text, "metadata": metadata}
+                f.write(json.dumps(record).encode("utf8") + b"\n")
+        with open(self._path("offsets.bin"), "ab") as f:
+            f.write(np.asarray(offsets, dtype=np.int64).tobytes())
+        if self._id_to_row is not None:
+            for row, id_ in enumerate(ids, start=start_row):
+                self._id_to_row[id_] = row
+
+    def read(self, row: int) -> Tuple[str, Document]:
+        with open(self._path("docs.jsonl"), "rb") as f:
+            f.seek(int(self._offsets[row]))
+            record = json.loads(f.readline())
+        return record["id"], Document(
+            page_content=record["text"], metadata=record["metadata"]
+        )
+
+    def row_ids(self) -> Dict[str, int]:
+        """Lazily build the id -> row lookup, only needed for deletes"""
+        if self._id_to_row is None:
+            id_to_row = {}
+            if self._count:
+                with open(self._path("docs.jsonl"), "rb") as f:
+                    for row, line in enumerate(f):
+                        if row >= self._count:
+                            break
+                        id_to_row[json.loads(line)["id"]] = row
+            self._id_to_row = id_to_row
+        return self._id_to_row
+
+    def delete(self, ids: List[str]):
+        row_ids = self.row_ids()
+        self.delete_rows(row_ids[id_] for id_ in ids if id_ in row_ids)
+
+    def delete_rows(self, rows: Iterable[int]):
+        self.deleted.update(rows)
+        write_json(self._path("deleted.json"), sorted(self.deleted))
+        self._deleted_stamp = file_stamp(self._path("deleted.json"))
+
+    def reset(self):
+        """Forget everything, the owner removes the files"""
+        self.deleted = set()
+        self._deleted_stamp = None
+        self._id_to_row = None
+        self.remap(0)
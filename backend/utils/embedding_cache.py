@@ -0,0 +1,219 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Dict, List, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+from langchain.schema.embeddings import Embeddings
+
+from .clients import clients
+
+# load your credentials from .env file
+load_dotenv()
+
+openai_api_key = os.getenv("OPENAI_API_KEY")
+
+EMBEDDING_MODEL = "text-embedding-ada-002"
+
+embedding_cache_path = os.getenv(
+    "EMBEDDING_CACHE_PATH", os.path.join(".cache", "embeddings.sqlite")
+)
+# maximum number of cached vectors, 0 disables the cache
+embedding_cache_max_entries = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "200000"))
+
+# SQLite limits the number of bound parameters per statement
+_SQL_BATCH = 500
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize text before hashing so trivially different copies share a key
+    """
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def cache_key(model: str, text: str) -> str:
+    digest = hashlib.sha256(normalize_text(text).encode("utf8")).hexdigest()
+    return f"{model}:{digest}"
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Content-addressed, persistent cache in front of an Embeddings object.
+
+    Vectors are stored in SQLite keyed by (model, sha256 of the normalized
+    text). Each hit refreshes the entry's last-used time and the least
+    recently used entries are evicted once `max_entries` is exceeded.
+    """
+
+    def __init__(
+        self,
+        underlying: Embeddings,
+        model: str,
+        path: str,
+        max_entries: int,
+    ):
+        self.underlying = underlying
+        self.model = model
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used "
+            "ON embeddings (last_used)"
+        )
+        self._conn.commit()
+        (self._count,) = self._conn.execute(
+            "SELECT COUNT(*) FROM embeddings"
+        ).fetchone()
+
+    def _lookup(self, keys: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            for i in range(0, len(unique_keys), _SQL_BATCH):
+                batch = unique_keys[i : i + _SQL_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                    batch,
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+                self._conn.commit()
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def _store(self, keys: List[str], vectors: List[List[float]]):
+        now = time.time()
+        rows = [
+            (key, np.asarray(vector, dtype=np.float32).tobytes(), now)
+            for key, vector in zip(keys, vectors)
+        ]
+        with self._lock:
+            cursor = self._conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, vector, last_used) "
+                "VALUES (?, ?, ?)",
+                rows,
+            )
+            self._count += cursor.rowcount
+            if self._count > self.max_entries:
+                cursor = self._conn.execute(
+                    "DELETE FROM embeddings WHERE key IN ("
+                    "SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (self._count - self.max_entries,),
+                )
+                self._count -= cursor.rowcount
+            self._conn.commit()
+
+    def _missing(self, texts: List[str], keys: List[str], found: Dict) -> List[str]:
+        """Texts that still need embedding, deduplicated by cache key"""
+        missing = {}
+        for text, key in zip(texts, keys):
+            if key not in found and key not in missing:
+                missing[key] = text
+        return list(missing.values())
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [cache_key(self.model, text) for text in texts]
+        found = self._lookup(keys)
+        missing = self._missing(texts, keys, found)
+        if missing:
+            missing_keys = [cache_key(self.model, text) for text in missing]
+            vectors = self.underlying.embed_documents(missing)
+            self._store(missing_keys, vectors)
+            found.update(zip(missing_keys, vectors))
+        return [found[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        key = cache_key(self.model, text)
+        found = self._lookup([key])
+        if key not in found:
+            found[key] = self.underlying.embed_query(text)
+            self._store([key], [found[key]])
+        return found[key]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        loop = asyncio.get_running_loop()
+        keys = [cache_key(self.model, text) for text in texts]
+        found = await loop.run_in_executor(None, self._lookup, keys)
+        missing = self._missing(texts, keys, found)
+        if missing:
+            missing_keys = [cache_key(self.model, text) for text in missing]
+            vectors = await self.underlying.aembed_documents(missing)
+            await loop.run_in_executor(None, self._store, missing_keys, vectors)
+            found.update(zip(missing_keys, vectors))
+        return [found[key] for key in keys]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        loop = asyncio.get_running_loop()
+        key = cache_key(self.model, text)
+        found = await loop.run_in_executor(None, self._lookup, [key])
+        if key not in found:
+            found[key] = await self.underlying.aembed_query(text)
+            await loop.run_in_executor(None, self._store, [key], [found[key]])
+        return found[key]
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+_embeddings: Optional[Embeddings] = None
+_embeddings_lock = threading.Lock()
+
+
+def get_embeddings() -> Embeddings:
+    """
+    Return the process wide embeddings object, wrapped in the persistent
+    cache unless EMBEDDING_CACHE_MAX_ENTRIES=0
+    """
+    global _embeddings
+    with _embeddings_lock:
+        if _embeddings is None:
+            embeddings = clients.deferred_embeddings(model=EMBEDDING_MODEL)
+            if embedding_cache_max_entries > 0:
+                embeddings = CachedEmbeddings(
+                    embeddings,
+                    model=EMBEDDING_MODEL,
+                    path=embedding_cache_path,
+                    max_entries=embedding_cache_max_entries,
+                )
+            _embeddings = embeddings
+        return _embeddings
+
+
+def print_cache_stats(embeddings: Embeddings):
+    if isinstance(embeddings, CachedEmbeddings):
+        stats = embeddings.stats()
+        print(
+            f"Embedding cache: {stats['hits']} hits, {stats['misses']} misses "
+            f"({stats['hit_rate']:.0%} hit rate)"
+        )
@@ -1,21 +1,23 @@
 import glob
 import os
-from multiprocessing import Pool
-from typing import List
+import threading
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
 
-import pinecone
 from dotenv import load_dotenv
 from langchain.docstore.document import Document
-from langchain.document_loaders import (CSVLoader, PyPDFLoader, TextLoader,
-                                        UnstructuredHTMLLoader,
-                                        UnstructuredMarkdownLoader,
-                                        UnstructuredPowerPointLoader,
-                                        UnstructuredWordDocumentLoader,
-                                        WebBaseLoader)
-from langchain.embeddings import OpenAIEmbeddings
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.vectorstores import Pinecone
-from tqdm import tqdm
+
+from .answer_cache import mark_corpus_changed
+from .bm25 import get_bm25_index
+from .crawler import SiteCrawler, get_page_cache
+from .dedup import ChunkDeduplicator, get_dedup_index
+from .embedding_cache import get_embeddings, print_cache_stats
+from .manifest import get_manifest
+from .parsers import LOADER_MAPPING, iter_documents
+from .pipeline import IngestionPipeline, StageStats
+from .sources import get_source_index
+from .vectorstore import (add_embeddings, get_vectorstore, maybe_rebuild_ivf,
+                          required_env_vars)
 
 # load your credentials from .env file
 load_dotenv()
@@ -30,169 +32,306 @@ CHUNK_SIZE = 1000
 CHUNK_OVERLAP = 0
 
 """
-Ingest your documents into Pinecone vectorstore
+Ingest your documents into the Pinecone or local vectorstore
 """
 
 source_directory = "docs"  # path to folder containing documents to ingest
 
-# Map file extensions to document loaders and their arguments
-LOADER_MAPPING = {
-    ".csv": (CSVLoader, {}),
-    ".doc": (UnstructuredWordDocumentLoader, {}),
-    ".docx": (UnstructuredWordDocumentLoader, {}),
-    ".html": (UnstructuredHTMLLoader, {}),
-    ".md": (UnstructuredMarkdownLoader, {}),
-    ".pdf": (PyPDFLoader, {}),
-    ".ppt": (UnstructuredPowerPointLoader, {}),
-    ".pptx": (UnstructuredPowerPointLoader, {}),
-    ".txt": (TextLoader, {"encoding": "utf8"}),
-    # Add more mappings for other file extensions and loaders as needed
-}
-
-
-def load_single_document(file_path: str) -> List[Document]:
-    """
-    load a single document from a file path
-    """
-    ext = "." + file_path.rsplit(".", 1)[-1]
-    if ext in LOADER_MAPPING:
-        loader_class, loader_args = LOADER_MAPPING[ext]
-        loader = loader_class(file_path, **loader_args)
-        return loader.load()
-
-    raise ValueError(f"Unsupported file extension '{ext}'")
+# vector IDs per delete call
+DELETE_BATCH_SIZE = 1000
+# orphaned near duplicates embedded and upserted at once
+PROMOTE_BATCH_SIZE = 100
 
 
-def load_documents(source_dir: str, ignored_files: List[str] = []) -> List[Document]:
+def list_documents(source_dir: str, ignored_files: List[str] = []) -> List[str]:
     """
-    Loads all documents from the source documents directory, ignoring specified files
+    Lists the supported files in the source directory, ignoring specified files
     """
     all_files = []
     for ext in LOADER_MAPPING:
         all_files.extend(
             glob.glob(os.path.join(source_dir, f"**/*{ext}"), recursive=True)
         )
-    filtered_files = [
-        file_path for file_path in all_files if file_path not in ignored_files
-    ]
+    return [file_path for file_path in all_files if file_path not in ignored_files]
 
-    with Pool(processes=os.cpu_count()) as pool:
-        results = []
-        with tqdm(
-            total=len(filtered_files), desc="Loading new documents", ncols=80
-        ) as pbar:
-            for i, docs in enumerate(
-                pool.imap_unordered(load_single_document, filtered_files)
-            ):
-                results.extend(docs)
-                pbar.update()
 
-    return results
+def check_env_vars():
+    # throw error if environment variables are not set
+    env_vars = ["OPENAI_API_KEY"] + required_env_vars()
+
+    for var in env_vars:
+        if not os.getenv(var):
+            raise ValueError(f"Please set {var} in .env file.")
 
 
-def process_url(url_path: str) -> List[str]:
+def delete_chunks(ids: List[str], namespace: Optional[str] = pinecone_namespace):
     """
-    Load url, split in chunks and return processed texts
+    Removes chunks from the vector store and the indexes kept beside it, in
+    batches of DELETE_BATCH_SIZE IDs. Near duplicates dropped in favour of a
+    deleted chunk are then stored in its place (see `promote_duplicates`).
     """
-    loader = WebBaseLoader(url_path)
-    documents = loader.load()
-    if not documents:
-        print("No new documents to load")
-        return []
-
-    print(f"Loaded {len(documents)} new documents from {url_path}")
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP
-    )
-    texts = text_splitter.split_documents(documents)
-    print(f"Split into {len(texts)} chunks of text (max. {CHUNK_SIZE} tokens each)")
-    return texts
-
-
-def process_documents(
-    source_directory: str, ignored_files: List[str] = []
-) -> List[str]:
+    vectorstore = get_vectorstore(get_embeddings(), namespace)
+    bm25_index = get_bm25_index(namespace)
+    dedup_index = get_dedup_index(namespace)
+    source_index = get_source_index(namespace)
+    try:
+        for i in range(0, len(ids), DELETE_BATCH_SIZE):
+            batch = ids[i : i + DELETE_BATCH_SIZE]
+            vectorstore.delete(ids=batch)
+            if bm25_index is not None:
+                bm25_index.delete(batch)
+            if dedup_index is not None:
+                dedup_index.delete(batch)
+            source_index.delete(batch)
+    finally:
+        mark_corpus_changed(namespace)
+    if dedup_index is not None:
+        promote_duplicates(namespace)
+
+
+def promote_duplicates(namespace: Optional[str] = pinecone_namespace):
     """
-    Load documents, split in chunks, and return processed texts
+    Embeds and upserts the near duplicates whose kept chunk was deleted,
+    under the IDs they were tracked with, so their sources keep that content
     """
-    print(f"Loading documents from {source_directory}")
-    documents = load_documents(source_directory, ignored_files)
-    if not documents:
-        print("No new documents to load")
-        return []
-
-    print(f"Loaded {len(documents)} new documents from {source_directory}")
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP
+    dedup_index = get_dedup_index(namespace)
+    orphans = dedup_index.orphans() if dedup_index is not None else []
+    if not orphans:
+        return
+    print(f"Storing {len(orphans)} near duplicates of deleted chunks...")
+    embeddings = get_embeddings()
+    vectorstore = get_vectorstore(embeddings, namespace)
+    bm25_index = get_bm25_index(namespace)
+    try:
+        for i in range(0, len(orphans), PROMOTE_BATCH_SIZE):
+            ids, chunks, signatures = zip(*orphans[i : i + PROMOTE_BATCH_SIZE])
+            texts = [chunk.page_content for chunk in chunks]
+            add_embeddings(
+                vectorstore,
+                texts,
+                embeddings.embed_documents(texts),
+                metadatas=[chunk.metadata for chunk in chunks],
+                ids=list(ids),
+            )
+            if bm25_index is not None:
+                bm25_index.add(list(chunks), list(ids))
+            dedup_index.promote(list(ids), list(signatures))
+    finally:
+        if bm25_index is not None:
+            bm25_index.commit()
+        mark_corpus_changed(namespace)
+
+
+def run_ingestion_pipeline(
+    documents: Iterable[List[Document]],
+    split: bool = True,
+    on_upsert: Optional[Callable[[List[Document], List[str]], None]] = None,
+    stats: Optional[Dict[str, StageStats]] = None,
+    batch_id: Optional[str] = None,
+    namespace: Optional[str] = pinecone_namespace,
+    cancel: Optional[threading.Event] = None,
+):
+    """
+    Streams documents through the load -> split -> embed -> upsert pipeline
+    and reports the throughput of each stage. Upserted chunks, and dropped
+    near duplicates, are recorded in the source index under their source and
+    `batch_id` and passed to `on_upsert`. Setting `cancel` stops the run with
+    IngestionCancelled.
+    """
+    # # create embeddings, unchanged chunks are served from the cache
+    embeddings = get_embeddings()
+    vectorstore = get_vectorstore(embeddings, namespace)
+    text_splitter = (
+        RecursiveCharacterTextSplitter(
+            chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP
+        )
+        if split
+        else None
     )
-    texts = text_splitter.split_documents(documents)
-    print(f"Split into {len(texts)} chunks of text (max. {CHUNK_SIZE} tokens each)")
-    return texts
-
-
-def ingest_docs(texts):
-    # throw error if environment variables are not set
-    env_vars = [
-        "OPENAI_API_KEY",
-        "PINECONE_API_KEY",
-        "PINECONE_ENVIRONMENT",
-        "PINECONE_INDEX_NAME",
-    ]
-
-    for var in env_vars:
-        if not os.getenv(var):
-            raise ValueError(f"Please set {var} in .env file.")
-
-    # initialize pinecone if not already initialized
-    pinecone.init(
-        api_key=os.getenv("PINECONE_API_KEY"),
-        environment=os.getenv("PINECONE_ENVIRONMENT"),
+    bm25_index = get_bm25_index(namespace)
+    source_index = get_source_index(namespace)
+    dedup_index = get_dedup_index(namespace)
+    # near duplicates of stored chunks or of earlier chunks of the run are
+    # dropped before they are embedded
+    deduplicator = ChunkDeduplicator(dedup_index) if dedup_index is not None else None
+
+    def index_chunks(chunks: List[Document], ids: List[str]):
+        # keep the lexical index in step with the vector store
+        if bm25_index is not None:
+            bm25_index.add(chunks, ids)
+        index_duplicates(chunks, ids)
+
+    def index_duplicates(chunks: List[Document], ids: List[str]):
+        # dropped duplicates are tracked like stored chunks, so deleting or
+        # ingesting their source again forgets them
+        source_index.add(chunks, ids, batch_id)
+        if on_upsert is not None:
+            on_upsert(chunks, ids)
+
+    pipeline = IngestionPipeline(
+        embeddings,
+        vectorstore,
+        text_splitter,
+        on_upsert=index_chunks,
+        stats=stats,
+        deduplicator=deduplicator,
+        cancel=cancel,
+        on_duplicate=index_duplicates,
     )
+    try:
+        stats = pipeline.run(documents)
+    finally:
+        # even a failed run may have upserted some batches
+        if bm25_index is not None:
+            bm25_index.commit()
+        if deduplicator is not None:
+            deduplicator.close()
+        mark_corpus_changed(namespace)
+    pipeline.print_stats()
+    maybe_rebuild_ivf(vectorstore)
+    print_cache_stats(embeddings)
+    return stats
+
+
+def ingest_docs(
+    texts,
+    stats: Optional[Dict[str, StageStats]] = None,
+    batch_id: Optional[str] = None,
+    namespace: Optional[str] = pinecone_namespace,
+):
+    check_env_vars()
 
     try:
-        print("Ingesting documents into Pinecone vectorstore...")
-        # # create embeddings
-        embeddings = OpenAIEmbeddings(
-            model="text-embedding-ada-002", openai_api_key=os.getenv("OPENAI_API_KEY")
+        print("Ingesting documents into vectorstore...")
+        # # ingest already split documents into the configured vectorstore
+        run_ingestion_pipeline(
+            [texts], split=False, stats=stats, batch_id=batch_id, namespace=namespace
         )
-
-        # # ingest documents into pinecone
-        if os.getenv("PINECONE_NAMESPACE"):
-            Pinecone.from_documents(
-                texts,
-                embeddings,
-                index_name=os.getenv("PINECONE_INDEX_NAME"),
-                namespace=os.getenv("PINECONE_NAMESPACE"),
-            )
-        else:
-            Pinecone.from_documents(
-                texts,
-                embeddings,
-                index_name=os.getenv("PINECONE_INDEX_NAME"),
-                namespace="",
-            )
-        print("Documents ingested into Pinecone vectorstore.")
+        print("Documents ingested into vectorstore.")
         return True
     except Exception as e:
         print(f"An error occurred whilst ingesting your files: {str(e)}")
         raise e
 
 
-def load_and_ingest_documents(source_dir: str, ignored_files: List[str] = []):
-    loaded_texts = process_documents(source_dir, ignored_files=ignored_files)
-    if not loaded_texts:
-        print("No texts to ingest")
+def load_and_ingest_documents(
+    source_dir: str,
+    ignored_files: List[str] = [],
+    incremental: bool = False,
+    stats: Optional[Dict[str, StageStats]] = None,
+    batch_id: Optional[str] = None,
+    namespace: Optional[str] = pinecone_namespace,
+    cancel: Optional[threading.Event] = None,
+):
+    """
+    Ingest every supported file in `source_dir`. With `incremental`, the
+    ingest manifest is used to skip unchanged files and to delete the vectors
+    of changed or removed ones before re-ingesting.
+    """
+    check_env_vars()
+    file_paths = list_documents(source_dir, ignored_files)
+
+    manifest = get_manifest(namespace) if incremental else None
+    if manifest is not None:
+        file_paths, stale_ids, removed = manifest.plan(source_dir, file_paths)
+        print(
+            f"{len(file_paths)} new or changed files, {len(removed)} removed, "
+            f"{len(manifest.entries) - len(removed)} tracked"
+        )
+        if stale_ids:
+            print(f"Deleting {len(stale_ids)} stale vectors...")
+            delete_chunks(stale_ids, namespace)
+        manifest.forget(removed)
+        manifest.forget(file_paths)
+        manifest.save()
+
+    if not file_paths:
+        print("No new documents to load")
         return
 
-    # Process the loaded texts using the ingest_docs function
-    ingest_docs(loaded_texts)
-
+    chunk_ids = {file_path: [] for file_path in file_paths}
 
-def load_and_ingest_url(url: str):
-    loaded_texts = process_url(url_path=url)
-    if not loaded_texts:
-        print("No texts to ingest")
-        return
+    def record_chunk_ids(chunks: List[Document], ids: List[str]):
+        for chunk, id_ in zip(chunks, ids):
+            chunk_ids.setdefault(chunk.metadata.get("source"), []).append(id_)
 
-    # Process the loaded texts using the ingest_docs function
-    ingest_docs(loaded_texts)
+    complete = False
+    try:
+        print(f"Ingesting {len(file_paths)} files from {source_dir}...")
+        # files are parsed, split, embedded and upserted concurrently
+        run_ingestion_pipeline(
+            iter_documents(file_paths),
+            on_upsert=record_chunk_ids,
+            stats=stats,
+            batch_id=batch_id,
+            namespace=namespace,
+            cancel=cancel,
+        )
+        complete = True
+        print("Documents ingested into vectorstore.")
+    except Exception as e:
+        print(f"An error occurred whilst ingesting your files: {str(e)}")
+        raise e
+    finally:
+        if manifest is not None:
+            for file_path in file_paths:
+                if complete or chunk_ids[file_path]:
+                    manifest.record(file_path, chunk_ids[file_path], complete)
+            manifest.save()
+
+
+def load_and_ingest_url(
+    url: str,
+    stats: Optional[Dict[str, StageStats]] = None,
+    crawl: bool = False,
+    max_depth: Optional[int] = None,
+    max_pages: Optional[int] = None,
+    batch_id: Optional[str] = None,
+    namespace: Optional[str] = pinecone_namespace,
+    cancel: Optional[threading.Event] = None,
+):
+    """
+    Ingest a web page, or with `crawl` the pages of its site (see
+    SiteCrawler). Pages unchanged since they were last ingested are skipped,
+    the vectors of changed pages are replaced. Raises ValueError when the
+    single page to ingest could not be fetched or is neither HTML nor
+    plain text.
+    """
+    check_env_vars()
+    cache = get_page_cache(namespace)
+    crawler = SiteCrawler(
+        url, cache, crawl=crawl, max_depth=max_depth, max_pages=max_pages
+    )
+    pages = {}
+    chunk_ids: Dict[str, List[str]] = {}
+
+    def iter_pages() -> Iterator[List[Document]]:
+        for page in crawler.iter_pages():
+            if page.stale_ids:
+                delete_chunks(page.stale_ids, namespace)
+            pages[page.url] = page
+            chunk_ids[page.url] = []
+            yield page.documents
+
+    def record_chunk_ids(chunks: List[Document], ids: List[str]):
+        for chunk, id_ in zip(chunks, ids):
+            chunk_ids[chunk.metadata["source"]].append(id_)
+
+    complete = False
+    try:
+        # pages are split, embedded and upserted while the crawl goes on
+        run_ingestion_pipeline(
+            iter_pages(),
+            on_upsert=record_chunk_ids,
+            stats=stats,
+            batch_id=batch_id,
+            namespace=namespace,
+            cancel=cancel,
+        )
+        complete = True
+    finally:
+        for page_url, page in pages.items():
+            cache.record(page, chunk_ids[page_url], complete)
+        print(crawler.summary())
+    if not crawl and crawler.start_url in crawler.errors:
+        raise ValueError(f"Could not ingest {url}: {crawler.errors[crawler.start_url]}")
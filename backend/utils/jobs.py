@@ -0,0 +1,317 @@
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+
+from .delete import delete_documents
+from .ingest import load_and_ingest_documents, load_and_ingest_url
+from .metrics import metrics
+from .namespaces import pinecone_namespace
+from .pipeline import (IngestionCancelled, StageStats, chunks_per_second,
+                       new_stage_stats)
+
+# load your credentials from .env file
+load_dotenv()
+
+ingest_jobs_path = os.getenv(
+    "INGEST_JOBS_PATH", os.path.join(".cache", "ingest_jobs.sqlite")
+)
+ingest_upload_dir = os.getenv("INGEST_UPLOAD_DIR", os.path.join(".cache", "uploads"))
+# number of ingestion jobs running at the same time per worker
+ingest_max_concurrent_jobs = int(os.getenv("INGEST_MAX_CONCURRENT_JOBS", "1"))
+# seconds between two heartbeats of a worker's jobs, the progress of its
+# running jobs is saved with each heartbeat
+ingest_job_heartbeat = float(os.getenv("INGEST_JOB_HEARTBEAT", "10"))
+# unfinished jobs without a heartbeat for this long are taken over
+ingest_job_stale_after = float(os.getenv("INGEST_JOB_STALE_AFTER", "60"))
+
+QUEUED = "queued"
+RUNNING = "running"
+# stopped by a shutdown, resumed by another worker or on the next start
+INTERRUPTED = "interrupted"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+UNFINISHED = (QUEUED, RUNNING, INTERRUPTED)
+
+
+def _progress(stats: Dict[str, StageStats]) -> Dict[str, float]:
+    return {
+        "chunks_per_sec": round(chunks_per_second(stats), 1),
+        "files_parsed": stats["load"].batches,
+        "chunks_embedded": stats["embed"].items,
+        "vectors_upserted": stats["upsert"].items,
+        "retries": stats["embed"].retries + stats["upsert"].retries,
+        "duplicates_dropped": stats["split"].dropped,
+        "tokens_saved": stats["split"].dropped_tokens,
+    }
+
+
+class IngestJobQueue:
+    """
+    Runs ingestion jobs on a small thread pool, outside the request handlers.
+
+    Jobs are recorded in a SQLite table shared by the workers of the app.
+    Each worker owns the jobs it runs and refreshes their heartbeat; jobs
+    interrupted by a shutdown, or whose worker stopped sending heartbeats,
+    are taken over by another worker or on the next start. A resumed job
+    first deletes the vectors it upserted before the interruption. Uploaded
+    files live in a per job directory under `upload_dir` until the job has
+    finished. Progress of running jobs is read live from the pipeline stage
+    counters by their worker, and saved with each heartbeat for the others.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        upload_dir: str,
+        max_workers: int,
+        heartbeat: float = ingest_job_heartbeat,
+        stale_after: float = ingest_job_stale_after,
+    ):
+        self.path = path
+        self.upload_dir = upload_dir
+        self.max_workers = max_workers
+        self.heartbeat = heartbeat
+        self.stale_after = stale_after
+        # identifies the jobs of this worker in the shared table
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._live: Dict[str, Dict[str, StageStats]] = {}
+        # set on shutdown, running pipelines stop after their current upserts
+        self._cancel = threading.Event()
+        self._closed = threading.Event()
+        self._heartbeat_thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Open the job table and resubmit jobs left over by a previous run"""
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, kind TEXT NOT NULL, payload TEXT NOT NULL, "
+            "status TEXT NOT NULL, progress TEXT, error TEXT, "
+            "created_at REAL NOT NULL, updated_at REAL NOT NULL, "
+            "owner TEXT, heartbeat REAL)"
+        )
+        # job tables created before jobs had owners
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        for column, kind in (("owner", "TEXT"), ("heartbeat", "REAL")):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+        self._conn.commit()
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="ingest-job"
+        )
+        self._resume_stale()
+        self._heartbeat_thread = threading.Thread(
+            target=self._beat, name="ingest-job-heartbeat", daemon=True
+        )
+        self._heartbeat_thread.start()
+
+    def shutdown(self):
+        """
+        Stops the running jobs once the batches they are upserting are done
+        and hands every unfinished job of this worker back to the table
+        """
+        self._cancel.set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        self._closed.set()
+        if self._heartbeat_thread is not None:
+            self._heartbeat_thread.join()
+        if self._conn is not None:
+            with self._lock:
+                # released jobs are stale at once for the other workers
+                self._conn.execute(
+                    "UPDATE jobs SET owner = NULL, heartbeat = NULL "
+                    "WHERE owner = ? AND status IN (?, ?, ?)",
+                    (self.owner, *UNFINISHED),
+                )
+                self._conn.commit()
+            self._conn.close()
+
+    def _resume_stale(self):
+        """
+        Claims and resubmits the unfinished jobs of workers that released
+        them or stopped sending heartbeats
+        """
+        now = time.time()
+        cutoff = now - self.stale_after
+        claimed = []
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, kind, payload FROM jobs WHERE status IN (?, ?, ?) "
+                "AND (heartbeat IS NULL OR heartbeat < ?) "
+                "AND (owner IS NULL OR owner != ?) ORDER BY created_at",
+                (*UNFINISHED, cutoff, self.owner),
+            ).fetchall()
+            for job_id, kind, payload in rows:
+                # another worker may be claiming the same job, the heartbeat
+                # is checked again under SQLite's write lock
+                cursor = self._conn.execute(
+                    "UPDATE jobs SET owner = ?, heartbeat = ?, status = ?, "
+                    "updated_at = ? WHERE id = ? "
+                    "AND (heartbeat IS NULL OR heartbeat < ?)",
+                    (self.owner, now, QUEUED, now, job_id, cutoff),
+                )
+                self._conn.commit()
+                if cursor.rowcount:
+                    claimed.append((job_id, kind, json.loads(payload)))
+        for job_id, kind, payload in claimed:
+            print(f"Resuming ingestion job {job_id}")
+            self._executor.submit(self._run, job_id, kind, payload, True)
+
+    def _beat(self):
+        while not self._closed.wait(self.heartbeat):
+            try:
+                now = time.time()
+                with self._lock:
+                    self._conn.execute(
+                        "UPDATE jobs SET heartbeat = ? "
+                        "WHERE owner = ? AND status IN (?, ?)",
+                        (now, self.owner, QUEUED, RUNNING),
+                    )
+                    # for status polls answered by the other workers
+                    self._conn.executemany(
+                        "UPDATE jobs SET progress = ? WHERE id = ? AND owner = ?",
+                        [
+                            (json.dumps(_progress(stats)), job_id, self.owner)
+                            for job_id, stats in list(self._live.items())
+                        ],
+                    )
+                    self._conn.commit()
+                if not self._cancel.is_set():
+                    self._resume_stale()
+            except Exception as e:
+                print(f"Ingestion job heartbeat failed: {e}")
+
+    def new_upload_dir(self) -> tuple:
+        """Returns (job_id, directory) for the files of a documents job"""
+        job_id = uuid.uuid4().hex
+        job_dir = os.path.join(self.upload_dir, job_id)
+        os.makedirs(job_dir)
+        return job_id, job_dir
+
+    def submit(self, kind: str, payload: dict, job_id: Optional[str] = None) -> str:
+        job_id = job_id or uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, kind, payload, status, created_at, "
+                "updated_at, owner, heartbeat) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, json.dumps(payload), QUEUED, now, now, self.owner, now),
+            )
+            self._conn.commit()
+        self._executor.submit(self._run, job_id, kind, payload)
+        return job_id
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT kind, status, progress, error, created_at, updated_at "
+                "FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        kind, status, progress, error, created_at, updated_at = row
+        live = self._live.get(job_id)
+        return {
+            "job_id": job_id,
+            "kind": kind,
+            "status": status,
+            "progress": _progress(live) if live else json.loads(progress or "{}"),
+            "error": error,
+            "created_at": created_at,
+            "updated_at": updated_at,
+        }
+
+    def _update(self, job_id: str, **fields):
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            # a job taken over by another worker is no longer ours to update
+            self._conn.execute(
+                f"UPDATE jobs SET {assignments} WHERE id = ? AND owner = ?",
+                (*fields.values(), job_id, self.owner),
+            )
+            self._conn.commit()
+
+    def _run(self, job_id: str, kind: str, payload: dict, resumed: bool = False):
+        stats = new_stage_stats()
+        self._live[job_id] = stats
+        self._update(job_id, status=RUNNING)
+        start = time.perf_counter()
+        status = FAILED
+        # jobs queued before namespaces were recorded ran in the default one
+        namespace = payload.get("namespace", pinecone_namespace)
+        try:
+            if resumed:
+                # chunks get new vector IDs, the ones upserted before the
+                # interruption would be stored twice
+                print(delete_documents(batch_ids=[job_id], namespace=namespace))
+            if kind == "documents":
+                load_and_ingest_documents(
+                    payload["source_dir"],
+                    stats=stats,
+                    batch_id=job_id,
+                    namespace=namespace,
+                    cancel=self._cancel,
+                )
+            elif kind == "url":
+                load_and_ingest_url(
+                    payload["url"],
+                    stats=stats,
+                    crawl=payload.get("crawl", False),
+                    max_depth=payload.get("max_depth"),
+                    max_pages=payload.get("max_pages"),
+                    batch_id=job_id,
+                    namespace=namespace,
+                    cancel=self._cancel,
+                )
+            else:
+                raise ValueError(f"Unknown ingestion job kind '{kind}'")
+            status = SUCCEEDED
+            self._update(
+                job_id, status=SUCCEEDED, progress=json.dumps(_progress(stats))
+            )
+        except IngestionCancelled:
+            status = INTERRUPTED
+            print(f"Ingestion job {job_id} interrupted, it will be resumed")
+            self._update(
+                job_id, status=INTERRUPTED, progress=json.dumps(_progress(stats))
+            )
+        except Exception as e:
+            traceback.print_exc()
+            self._update(
+                job_id,
+                status=FAILED,
+                progress=json.dumps(_progress(stats)),
+                error=str(e),
+            )
+        finally:
+            self._live.pop(job_id, None)
+            metrics.observe(
+                "ingest_job_seconds", time.perf_counter() - start, kind=kind
+            )
+            metrics.inc("ingest_jobs_total", kind=kind, status=status)
+            # an interrupted job needs its files when it is resumed
+            if kind == "documents" and status != INTERRUPTED:
+                shutil.rmtree(payload["source_dir"], ignore_errors=True)
+
+
+job_queue = IngestJobQueue(
+    ingest_jobs_path, ingest_upload_dir, ingest_max_concurrent_jobs
+)
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from .vectorstore import vector_store_backend
+
+# load your credentials from .env file
+load_dotenv()
+
+pinecone_namespace = os.getenv("PINECONE_NAMESPACE")
+
+ingest_manifest_dir = os.getenv("INGEST_MANIFEST_DIR", ".cache")
+
+_HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def file_sha256(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(_HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class IngestManifest:
+    """
+    Persistent record of every ingested file: size, mtime, content hash and
+    the IDs of the vectors its chunks produced.
+
+    `plan` compares a directory listing against the manifest so only new or
+    changed files are ingested, and returns the vector IDs of changed or
+    removed files so they can be deleted first. Size and mtime are checked
+    before hashing, so unchanged files are never read.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[str, dict] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf8") as f:
+                self.entries = json.load(f)
+
+    def save(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf8") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+
+    def plan(
+        self, source_dir: str, file_paths: List[str]
+    ) -> Tuple[List[str], List[str], List[str]]:
+        """
+        Returns (files to ingest, stale vector IDs to delete, removed files)
+        """
+        to_ingest = []
+        stale_ids = []
+        for file_path in file_paths:
+            stat = os.stat(file_path)
+            entry = self.entries.get(file_path)
+            if entry and entry["sha256"]:
+                if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                    continue
+                sha256 = file_sha256(file_path)
+                if entry["sha256"] == sha256:
+                    # touched but identical content, only refresh the stat
+                    entry.update(size=stat.st_size, mtime=stat.st_mtime)
+                    continue
+            if entry:
+                stale_ids.extend(entry["chunk_ids"])
+            to_ingest.append(file_path)
+
+        present = set(file_paths)
+        prefix = os.path.join(source_dir, "")
+        removed = [
+            file_path
+            for file_path in self.entries
+            if file_path.startswith(prefix) and file_path not in present
+        ]
+        for file_path in removed:
+            stale_ids.extend(self.entries[file_path]["chunk_ids"])
+        return to_ingest, stale_ids, removed
+
+    def forget(self, file_paths: List[str]):
+        for file_path in file_paths:
+            self.entries.pop(file_path, None)
+
+    def clear(self):
+        self.entries = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def record(self, file_path: str, chunk_ids: List[str], complete: bool = True):
+        """
+        Store the chunk IDs of an ingested file. Incomplete files keep their
+        IDs without a hash, so the next run deletes and re-ingests them.
+        """
+        stat = os.stat(file_path)
+        self.entries[file_path] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "sha256": file_sha256(file_path) if complete else None,
+            "chunk_ids": chunk_ids,
+        }
+
+
+def get_manifest(namespace: Optional[str] = pinecone_namespace) -> IngestManifest:
+    """
+    Manifests are kept per backend and namespace, since vector IDs are only
+    meaningful inside the index that holds them
+    """
+    name = f"manifest-{vector_store_backend}-{namespace or 'default'}.json"
+    return IngestManifest(os.path.join(ingest_manifest_dir, name))
@@ -0,0 +1,198 @@
+import os
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+# load your credentials from .env file
+load_dotenv()
+
+# fraction of chat requests whose stage timings are recorded, 0 disables them
+metrics_sample_rate = float(os.getenv("METRICS_SAMPLE_RATE", "0.1"))
+# send the stage timings of sampled requests in a Server-Timing header
+server_timing_header = os.getenv("SERVER_TIMING_HEADER", "true").lower() == "true"
+
+METRICS_PREFIX = "chatbot"
+# seconds, upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# exported counters and histograms
+METRIC_HELP = {
+    "chat_requests_total": "Chat requests by retrieval path",
+    "chat_coalesced_total": "Chat requests served by an identical one in flight",
+    "chat_coalesce_lagged_total": "Chat streams cut off for falling behind the answer",
+    "chat_stage_seconds": "Time spent per stage of sampled chat requests",
+    "ingest_stage_seconds": "Busy time per ingestion stage and run",
+    "ingest_item_seconds": "Time to parse one pool task or split one file",
+    "ingest_stage_items_total": "Documents, chunks or vectors per ingestion stage",
+    "ingest_stage_retries_total": "Retried embedding requests and upserts",
+    "ingest_dedup_chunks_total": "Chunks dropped as near duplicates at ingestion",
+    "ingest_dedup_tokens_total": "Embedding tokens saved by dropping near duplicates",
+    "ingest_jobs_total": "Finished ingestion jobs by kind and status",
+    "ingest_job_seconds": "Duration of ingestion jobs",
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _format_labels(labels: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in labels]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    """Observation counts per latency bucket, their sum and count"""
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name: str, labels: Labels) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(float(bound))
+            bucket_labels = _format_labels(labels, f'le="{le}"')
+            lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {self.sum}")
+        lines.append(f"{name}_count{_format_labels(labels)} {self.count}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Counters and latency histograms in the Prometheus text format.
+
+    Stats kept by other modules (cache hit rates, retrieval paths, ...) are
+    exported as gauges through collectors, functions returning a flat dict
+    that are called at scrape time.
+    """
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._collectors: Dict[str, Callable[[], Dict[str, float]]] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(seconds)
+
+    def register_collector(self, name: str, collect: Callable[[], Dict[str, float]]):
+        self._collectors[f"{self.prefix}_{name}"] = collect
+
+    def _header(self, name: str, kind: str) -> List[str]:
+        lines = [f"# TYPE {self.prefix}_{name} {kind}"]
+        if name in METRIC_HELP:
+            lines.insert(0, f"# HELP {self.prefix}_{name} {METRIC_HELP[name]}")
+        return lines
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, series in self._counters.items():
+                lines += self._header(name, "counter")
+                for labels, value in series.items():
+                    lines.append(
+                        f"{self.prefix}_{name}{_format_labels(labels)} {value}"
+                    )
+            for name, series in self._histograms.items():
+                lines += self._header(name, "histogram")
+                for labels, histogram in series.items():
+                    lines += histogram.lines(f"{self.prefix}_{name}", labels)
+        for prefix, collect in self._collectors.items():
+            for key, value in collect().items():
+                name = f"{prefix}_{key}"
+                lines += [f"# TYPE {name} gauge", f"{name} {float(value)}"]
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry(METRICS_PREFIX)
+
+
+class Trace:
+    """
+    Stage timings of one sampled request. Spans with the same name add up,
+    e.g. the query embedding of a speculative and a direct retrieval.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans: Dict[str, float] = {}
+
+    def record(self, stage: str, seconds: float):
+        self.spans[stage] = self.spans.get(stage, 0.0) + seconds
+
+    def server_timing(self) -> str:
+        return ", ".join(
+            f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.spans.items()
+        )
+
+    def finish(self, name: str):
+        """Records the total time and observes every stage into `name`"""
+        self.record("total", time.perf_counter() - self.start)
+        for stage, seconds in self.spans.items():
+            metrics.observe(name, seconds, stage=stage)
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+
+
+def start_trace() -> Optional[Trace]:
+    """
+    Starts a trace for the current request (and the tasks it creates) with
+    probability METRICS_SAMPLE_RATE; unsampled requests get None
+    """
+    trace = Trace() if random.random() < metrics_sample_rate else None
+    _current_trace.set(trace)
+    return trace
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """Times the block into the trace of the current request, if sampled"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.record(stage, time.perf_counter() - start)
+
+
+@contextmanager
+def timed(name: str, **labels: str) -> Iterator[None]:
+    """Always times the block into a histogram, for code off the hot path"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe(name, time.perf_counter() - start, **labels)
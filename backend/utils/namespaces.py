@@ -0,0 +1,108 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Mapping, Optional
+
+from dotenv import load_dotenv
+
+# load your credentials from .env file
+load_dotenv()
+
+# namespace of requests that do not choose one
+pinecone_namespace = os.getenv("PINECONE_NAMESPACE")
+# comma separated namespaces requests may choose, any valid name when unset
+allowed_namespaces = {
+    namespace.strip()
+    for namespace in os.getenv("ALLOWED_NAMESPACES", "").split(",")
+    if namespace.strip()
+}
+# namespaces whose retrievers and cached answers are kept warm per worker
+namespace_cache_size = int(os.getenv("NAMESPACE_CACHE_SIZE", "32"))
+
+# request header, or query parameter, choosing the namespace
+NAMESPACE_HEADER = "X-Namespace"
+NAMESPACE_PARAM = "namespace"
+# namespaces also name files and directories of the local caches
+_NAMESPACE_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+def resolve_namespace(requested: Optional[str]) -> Optional[str]:
+    """
+    The namespace a request works in, PINECONE_NAMESPACE unless it chooses
+    one. Raises ValueError for malformed or disallowed names.
+    """
+    if not requested:
+        return pinecone_namespace
+    if not _NAMESPACE_PATTERN.match(requested):
+        raise ValueError(
+            f"Invalid namespace '{requested}', use up to 64 letters, digits, "
+            "'-' or '_'"
+        )
+    if (
+        allowed_namespaces
+        and requested not in allowed_namespaces
+        and requested != pinecone_namespace
+    ):
+        raise ValueError(f"Namespace '{requested}' is not allowed")
+    return requested
+
+
+def request_namespace(
+    headers: Mapping[str, str], query_params: Mapping[str, str]
+) -> Optional[str]:
+    return resolve_namespace(
+        headers.get(NAMESPACE_HEADER) or query_params.get(NAMESPACE_PARAM)
+    )
+
+
+class NamespaceLRU:
+    """
+    Per-namespace objects built on first use, the least recently used ones
+    are dropped beyond `max_entries` namespaces
+    """
+
+    def __init__(self, max_entries: int = namespace_cache_size):
+        self.max_entries = max(max_entries, 1)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def cached(self, namespace: Optional[str]) -> Optional[Any]:
+        """The object of a warm namespace, None instead of building it"""
+        with self._lock:
+            if namespace in self._entries:
+                self._entries.move_to_end(namespace)
+                self.hits += 1
+                return self._entries[namespace]
+        return None
+
+    def get(self, namespace: Optional[str], factory: Callable[[], Any]) -> Any:
+        value = self.cached(namespace)
+        if value is not None:
+            return value
+        with self._lock:
+            self.misses += 1
+        # built outside the lock, other namespaces are not held up meanwhile
+        value = factory()
+        with self._lock:
+            value = self._entries.setdefault(namespace, value)
+            self._entries.move_to_end(namespace)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def values(self) -> List[Any]:
+        with self._lock:
+            return list(self._entries.values())
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "namespaces": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,320 @@
+import atexit
+import mmap
+import os
+import queue
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from importlib import import_module
+from multiprocessing import Pool
+from typing import Callable, Dict, Iterator, List, Tuple, Union
+
+from dotenv import load_dotenv
+from langchain.docstore.document import Document
+from tqdm import tqdm
+
+from .metrics import metrics
+
+# load your credentials from .env file
+load_dotenv()
+
+# parser processes, shared by every ingestion of the app or script
+parser_pool_size = int(os.getenv("PARSER_POOL_SIZE", "0")) or os.cpu_count()
+# start the processes with the app rather than on the first ingestion
+parser_pool_warm = os.getenv("PARSER_POOL_WARM", "true").lower() == "true"
+# files parsed by a process before it is replaced, caps leaks in the parsers
+parser_max_tasks_per_child = int(os.getenv("PARSER_MAX_TASKS_PER_CHILD", "50"))
+# files smaller than this are parsed together, up to this many bytes per task
+parser_batch_bytes = int(os.getenv("PARSER_BATCH_BYTES", str(1024 * 1024)))
+# PDFs with at least this many pages are extracted in page ranges spread over
+# the pool, 0 parses every PDF as a whole
+pdf_split_pages = int(os.getenv("PDF_SPLIT_PAGES", "200"))
+# pages per task of a split PDF
+pdf_pages_per_task = int(os.getenv("PDF_PAGES_PER_TASK", "50"))
+# only PDFs of this many bytes or more are opened to count their pages
+pdf_split_min_bytes = int(os.getenv("PDF_SPLIT_MIN_BYTES", str(1024 * 1024)))
+
+# upper bound on the files of one batched task
+MAX_FILES_PER_TASK = 32
+# imported by every parser process when it starts, the loaders import them
+# lazily on their first file otherwise
+WARM_MODULES = (
+    "pypdf",
+    "unstructured.partition.html",
+    "unstructured.partition.md",
+    "unstructured.partition.docx",
+    "unstructured.partition.pptx",
+)
+
+# Map file extensions to document loaders and their arguments. Loaders are
+# given by import path and only imported when their extension is first seen.
+_WORD_LOADER = "langchain.document_loaders.word_document.UnstructuredWordDocumentLoader"
+_POWERPOINT_LOADER = (
+    "langchain.document_loaders.powerpoint.UnstructuredPowerPointLoader"
+)
+LOADER_MAPPING = {
+    ".csv": ("langchain.document_loaders.csv_loader.CSVLoader", {}),
+    ".doc": (_WORD_LOADER, {}),
+    ".docx": (_WORD_LOADER, {}),
+    ".html": ("langchain.document_loaders.html.UnstructuredHTMLLoader", {}),
+    ".md": ("langchain.document_loaders.markdown.UnstructuredMarkdownLoader", {}),
+    ".pdf": ("langchain.document_loaders.pdf.PyPDFLoader", {}),
+    ".ppt": (_POWERPOINT_LOADER, {}),
+    ".pptx": (_POWERPOINT_LOADER, {}),
+    ".txt": ("langchain.document_loaders.text.TextLoader", {"encoding": "utf8"}),
+    # Add more mappings for other file extensions and loaders as needed
+}
+
+_loader_classes: Dict[str, type] = {}
+
+# a whole file, or pages [start, stop) of a PDF
+ParseItem = Union[str, Tuple[str, int, int]]
+
+
+def import_loader(path: str) -> type:
+    """Import a loader class from its dotted path, once per process"""
+    if path not in _loader_classes:
+        module_name, class_name = path.rsplit(".", 1)
+        _loader_classes[path] = getattr(import_module(module_name), class_name)
+    return _loader_classes[path]
+
+
+def load_single_document(file_path: str) -> List[Document]:
+    """
+    load a single document from a file path
+    """
+    ext = "." + file_path.rsplit(".", 1)[-1]
+    if ext in LOADER_MAPPING:
+        loader_path, loader_args = LOADER_MAPPING[ext]
+        loader = import_loader(loader_path)(file_path, **loader_args)
+        return loader.load()
+
+    raise ValueError(f"Unsupported file extension '{ext}'")
+
+
+@contextmanager
+def _open_pdf(file_path: str) -> Iterator:
+    import pypdf
+
+    # memory-mapped, the workers extracting pages of the same file share
+    # the page cache instead of each reading the file
+    with open(file_path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield pypdf.PdfReader(data)
+
+
+def count_pdf_pages(file_path: str) -> int:
+    try:
+        with _open_pdf(file_path) as reader:
+            return len(reader.pages)
+    except Exception:
+        # empty, damaged or encrypted, left to the loader to report
+        return 0
+
+
+def count_pages(file_paths: List[str]) -> List[int]:
+    return [count_pdf_pages(file_path) for file_path in file_paths]
+
+
+def load_pdf_pages(file_path: str, start: int, stop: int) -> List[Document]:
+    """
+    Extract pages [start, stop) of a PDF, with the metadata PyPDFLoader sets
+    """
+    with _open_pdf(file_path) as reader:
+        return [
+            Document(
+                page_content=reader.pages[page].extract_text(),
+                metadata={"source": file_path, "page": page},
+            )
+            for page in range(start, stop)
+        ]
+
+
+def _warm_worker():
+    for loader_path, _ in LOADER_MAPPING.values():
+        import_loader(loader_path)
+    for module in WARM_MODULES:
+        try:
+            import_module(module)
+        except ImportError:
+            pass
+
+
+def _load_items(
+    items: List[ParseItem],
+) -> Tuple[float, List[Tuple[ParseItem, List[Document]]]]:
+    """Parses the items of a pool task, returns its duration and documents"""
+    start = time.perf_counter()
+    results = [
+        (
+            item,
+            (
+                load_pdf_pages(*item)
+                if isinstance(item, tuple)
+                else load_single_document(item)
+            ),
+        )
+        for item in items
+    ]
+    return time.perf_counter() - start, results
+
+
+def plan_parse_tasks(
+    file_paths: List[str],
+    batch_bytes: int = parser_batch_bytes,
+    split_pages: int = pdf_split_pages,
+    pages_per_task: int = pdf_pages_per_task,
+    split_min_bytes: int = pdf_split_min_bytes,
+    page_counter: Callable[[List[str]], List[int]] = count_pages,
+) -> List[List[ParseItem]]:
+    """
+    Groups files into pool tasks, largest files first so a big file does not
+    start last and hold up the end of the run. PDFs of `split_pages` pages or
+    more are cut into tasks of `pages_per_task` pages, other files of
+    `batch_bytes` or more get a task of their own, and smaller ones share
+    tasks of about `batch_bytes` to spread the per-task overhead. Only PDFs of
+    `split_min_bytes` or more have their pages counted, by `page_counter`.
+    """
+    sizes = {}
+    for file_path in file_paths:
+        try:
+            sizes[file_path] = os.path.getsize(file_path)
+        except OSError:
+            # the loader raises a proper error for it
+            sizes[file_path] = 0
+
+    candidates = [
+        file_path
+        for file_path in file_paths
+        if split_pages
+        and file_path.endswith(".pdf")
+        and sizes[file_path] >= split_min_bytes
+    ]
+    page_counts = dict(zip(candidates, page_counter(candidates))) if candidates else {}
+
+    tasks = []
+    batch = []
+    batch_size = 0
+    for file_path in sorted(file_paths, key=sizes.get, reverse=True):
+        size = sizes[file_path]
+        pages = page_counts.get(file_path, 0)
+        if split_pages and pages >= split_pages:
+            tasks.extend(
+                [(file_path, start, min(start + pages_per_task, pages))]
+                for start in range(0, pages, pages_per_task)
+            )
+            continue
+        if size >= batch_bytes:
+            tasks.append([file_path])
+            continue
+        if batch and (
+            batch_size + size > batch_bytes or len(batch) >= MAX_FILES_PER_TASK
+        ):
+            tasks.append(batch)
+            batch = []
+            batch_size = 0
+        batch.append(file_path)
+        batch_size += size
+    if batch:
+        tasks.append(batch)
+    return tasks
+
+
+class ParserPool:
+    """
+    Long lived process pool parsing documents for every ingestion of the
+    process, so requests do not pay for spawning processes and importing the
+    parsers. Processes import the loaders when they start (see
+    WARM_MODULES) and are replaced after `max_tasks_per_child` tasks.
+    """
+
+    def __init__(self, processes: int, max_tasks_per_child: int):
+        self.processes = processes
+        self.max_tasks_per_child = max_tasks_per_child or None
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = Pool(
+                    processes=self.processes,
+                    initializer=_warm_worker,
+                    maxtasksperchild=self.max_tasks_per_child,
+                )
+                atexit.register(self.close)
+            return self._pool
+
+    def start(self):
+        """Start and warm up the processes ahead of the first ingestion"""
+        self.get()
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+
+    def iter_documents(self, file_paths: List[str]) -> Iterator[List[Document]]:
+        """
+        Parses files in the pool and yields the documents of one file at a
+        time, in the order the files finish; the page ranges of a split PDF
+        are put back in page order. At most two tasks per process are parsed
+        ahead of the consumer, so memory does not grow with the number of
+        files.
+        """
+        pool = self.get()
+        # the pages of large PDFs are counted in parallel by the pool
+        tasks = deque(
+            plan_parse_tasks(
+                file_paths, page_counter=lambda paths: pool.map(count_pdf_pages, paths)
+            )
+        )
+        finished: queue.Queue = queue.Queue()
+        pending = 0
+        # extracted page ranges of split PDFs, by file and first page
+        ranges: Dict[str, Dict[int, List[Document]]] = {}
+        remaining: Dict[str, int] = {}
+        for task in tasks:
+            for item in task:
+                if isinstance(item, tuple):
+                    remaining[item[0]] = remaining.get(item[0], 0) + 1
+        with tqdm(
+            total=len(file_paths), desc="Loading new documents", ncols=80
+        ) as pbar:
+            while tasks or pending:
+                while tasks and pending < 2 * self.processes:
+                    pool.apply_async(
+                        _load_items,
+                        (tasks.popleft(),),
+                        callback=finished.put,
+                        error_callback=finished.put,
+                    )
+                    pending += 1
+                result = finished.get()
+                pending -= 1
+                if isinstance(result, BaseException):
+                    raise result
+                seconds, result = result
+                metrics.observe("ingest_item_seconds", seconds, stage="load")
+                for item, documents in result:
+                    if isinstance(item, tuple):
+                        file_path, start, _ = item
+                        ranges.setdefault(file_path, {})[start] = documents
+                        remaining[file_path] -= 1
+                        if remaining[file_path]:
+                            continue
+                        parts = sorted(ranges.pop(file_path).items())
+                        documents = [doc for _, part in parts for doc in part]
+                    yield documents
+                    pbar.update()
+
+
+parser_pool = ParserPool(parser_pool_size, parser_max_tasks_per_child)
+
+
+def iter_documents(file_paths: List[str]) -> Iterator[List[Document]]:
+    """Parses `file_paths` in the shared parser pool"""
+    return parser_pool.iter_documents(file_paths)
@@ -0,0 +1,529 @@
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from dotenv import load_dotenv
+from langchain.docstore.document import Document
+from langchain.schema.embeddings import Embeddings
+from langchain.schema.vectorstore import VectorStore
+from langchain.text_splitter import TextSplitter
+
+from .dedup import ChunkDeduplicator
+from .metrics import metrics, timed
+from .token_budget import TokenCounter
+from .vectorstore import add_embeddings
+
+# load your credentials from .env file
+load_dotenv()
+
+# maximum number of chunks embedded and upserted together
+ingest_batch_size = int(os.getenv("INGEST_BATCH_SIZE", "64"))
+# maximum number of tokens per embedding request
+ingest_batch_max_tokens = int(os.getenv("INGEST_BATCH_MAX_TOKENS", "50000"))
+# number of batches buffered between two pipeline stages
+ingest_queue_size = int(os.getenv("INGEST_QUEUE_SIZE", "4"))
+# embedding requests and upserts in flight at the same time, the embedding
+# limit is lowered while the API answers with rate limit errors
+ingest_embed_concurrency = int(os.getenv("INGEST_EMBED_CONCURRENCY", "4"))
+ingest_upsert_concurrency = int(os.getenv("INGEST_UPSERT_CONCURRENCY", "2"))
+# retries of a batch after a rate limit or transient error
+ingest_max_retries = int(os.getenv("INGEST_MAX_RETRIES", "8"))
+
+# seconds, full jitter exponential backoff between retries
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+# statuses worth retrying: rate limited, overloaded or briefly unavailable
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+# exceptions without a status that are worth retrying, by class name
+RETRYABLE_ERRORS = {"APIConnectionError", "APITimeoutError", "MaxRetryError"}
+
+_DONE = object()
+STAGES = ("load", "split", "embed", "upsert")
+
+# chunk token counts are only needed once, nothing worth memoizing
+_token_counter = TokenCounter("text-embedding-ada-002", max_entries=0)
+
+
+class IngestionCancelled(Exception):
+    """Raised by a pipeline run stopped through its `cancel` event"""
+
+
+def _status(error: BaseException) -> Optional[int]:
+    # openai errors carry `status_code`, pinecone's `status`
+    status = getattr(error, "status_code", None) or getattr(error, "status", None)
+    return status if isinstance(status, int) else None
+
+
+def is_rate_limited(error: BaseException) -> bool:
+    return _status(error) == 429 or type(error).__name__ == "RateLimitError"
+
+
+def is_retryable(error: BaseException) -> bool:
+    return (
+        is_rate_limited(error)
+        or _status(error) in RETRYABLE_STATUSES
+        or type(error).__name__ in RETRYABLE_ERRORS
+        or isinstance(error, (ConnectionError, TimeoutError))
+    )
+
+
+def retry_delay(error: BaseException, attempt: int) -> float:
+    """Retry-After when the API sends one, full jitter backoff otherwise"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return min(float(headers.get("retry-after")), RETRY_MAX_DELAY)
+    except (TypeError, ValueError):
+        return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**attempt))
+
+
+class AdaptiveLimiter:
+    """
+    Bounds the calls in flight to a rate limited API. The limit is halved on
+    every rate limit error and raised by one after as many successful calls
+    as the current limit, up to `max_limit`.
+    """
+
+    def __init__(self, max_limit: int):
+        self.max_limit = max(max_limit, 1)
+        self.limit = self.max_limit
+        self._in_flight = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self, throttled: bool = False):
+        with self._condition:
+            self._in_flight -= 1
+            if throttled:
+                self.limit = max(self.limit // 2, 1)
+                self._successes = 0
+            else:
+                self._successes += 1
+                if self._successes >= self.limit and self.limit < self.max_limit:
+                    self.limit += 1
+                    self._successes = 0
+            self._condition.notify_all()
+
+
+class StageStats:
+    """
+    Items processed by a pipeline stage and the time it spent working on them
+    """
+
+    def __init__(self, name: str, unit: str):
+        self.name = name
+        self.unit = unit
+        # inputs consumed, for the load stage this is the number of files
+        self.batches = 0
+        self.items = 0
+        # summed over the workers of the stage
+        self.worker_seconds = 0.0
+        # time spent blocked on the neighbouring queues
+        self.wait_seconds = 0.0
+        # calls retried after a rate limit or transient error
+        self.retries = 0
+        # chunks dropped as near duplicates and the tokens they would have cost
+        self.dropped = 0
+        self.dropped_tokens = 0
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.lock = threading.Lock()
+
+    @property
+    def busy_seconds(self) -> float:
+        return max(self.worker_seconds - self.wait_seconds, 0.0)
+
+    @property
+    def throughput(self) -> float:
+        return self.items / self.busy_seconds if self.busy_seconds else 0.0
+
+    def __str__(self) -> str:
+        retries = f", {self.retries} retries" if self.retries else ""
+        dropped = (
+            f", {self.dropped} near duplicates dropped saving "
+            f"{self.dropped_tokens} tokens"
+            if self.dropped
+            else ""
+        )
+        return (
+            f"{self.name}: {self.items} {self.unit} in {self.busy_seconds:.1f}s "
+            f"({self.throughput:.1f} {self.unit}/s{retries}{dropped})"
+        )
+
+
+def new_stage_stats() -> Dict[str, StageStats]:
+    return {
+        "load": StageStats("load", "documents"),
+        "split": StageStats("split", "chunks"),
+        "embed": StageStats("embed", "chunks"),
+        "upsert": StageStats("upsert", "vectors"),
+    }
+
+
+def chunks_per_second(stats: Dict[str, StageStats]) -> float:
+    """
+    Sustained ingestion rate: chunks upserted per second of wall time since
+    the pipeline started, the headline number of a run
+    """
+    start = stats["load"].started_at
+    if start is None:
+        return 0.0
+    end = stats["upsert"].finished_at or time.perf_counter()
+    return stats["upsert"].items / (end - start) if end > start else 0.0
+
+
+def observe_stage_stats(stats: Dict[str, StageStats]):
+    """Exports the busy time and item count of each stage on /metrics"""
+    for name, stage in stats.items():
+        metrics.observe("ingest_stage_seconds", stage.busy_seconds, stage=name)
+        metrics.inc("ingest_stage_items_total", stage.items, stage=name)
+        metrics.inc("ingest_stage_retries_total", stage.retries, stage=name)
+    metrics.inc("ingest_dedup_chunks_total", stats["split"].dropped)
+    metrics.inc("ingest_dedup_tokens_total", stats["split"].dropped_tokens)
+
+
+class IngestionPipeline:
+    """
+    load -> split -> embed -> upsert, connected by bounded queues.
+
+    A slow stage applies backpressure to the ones before it: embedding starts
+    as soon as the first file is parsed and memory holds at most `queue_size`
+    batches per stage instead of the whole corpus. Loading and splitting run
+    on one thread each, embedding and upserting on `embed_concurrency` and
+    `upsert_concurrency` threads. Batches are cut at `batch_size` chunks or
+    `batch_max_tokens` tokens. Rate limit and transient errors are retried
+    with jittered backoff, and rate limits also lower the number of
+    embedding requests in flight; a batch that keeps failing stops the run,
+    the batches upserted before it are kept. With a `deduplicator`, near
+    duplicate chunks are dropped between splitting and embedding and
+    reported to `on_duplicate` with the IDs they are tracked under. Setting
+    `cancel` stops the run once the batches being upserted are done.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        vectorstore: VectorStore,
+        text_splitter: Optional[TextSplitter] = None,
+        batch_size: int = ingest_batch_size,
+        queue_size: int = ingest_queue_size,
+        on_upsert: Optional[Callable[[List[Document], List[str]], None]] = None,
+        stats: Optional[Dict[str, StageStats]] = None,
+        batch_max_tokens: int = ingest_batch_max_tokens,
+        embed_concurrency: int = ingest_embed_concurrency,
+        upsert_concurrency: int = ingest_upsert_concurrency,
+        max_retries: int = ingest_max_retries,
+        deduplicator: Optional[ChunkDeduplicator] = None,
+        cancel: Optional[threading.Event] = None,
+        on_duplicate: Optional[Callable[[List[Document], List[str]], None]] = None,
+    ):
+        self.embeddings = embeddings
+        self.vectorstore = vectorstore
+        self.text_splitter = text_splitter
+        self.batch_size = batch_size
+        self.batch_max_tokens = batch_max_tokens
+        self.queue_size = queue_size
+        self.embed_concurrency = max(embed_concurrency, 1)
+        self.upsert_concurrency = max(upsert_concurrency, 1)
+        self.max_retries = max_retries
+        # called with each upserted batch of chunks and their vector IDs
+        self.on_upsert = on_upsert
+        self.deduplicator = deduplicator
+        self.on_duplicate = on_duplicate
+        self.cancel = cancel
+        # pass a shared dict to observe progress while the pipeline runs
+        self.stats = stats if stats is not None else new_stage_stats()
+        self._embed_limiter = AdaptiveLimiter(self.embed_concurrency)
+        self._upsert_limiter = AdaptiveLimiter(self.upsert_concurrency)
+        # upsert workers report their batches one at a time
+        self._on_upsert_lock = threading.Lock()
+        # set for a failed stage and the ones feeding it, the stages after
+        # it still finish the batches already handed to them
+        self._stop = {name: threading.Event() for name in STAGES}
+        self._errors: List[BaseException] = []
+
+    def _fail(self, name: str, error: BaseException):
+        self._errors.append(error)
+        for stage in STAGES[: STAGES.index(name) + 1]:
+            self._stop[stage].set()
+
+    def _cancel(self):
+        # upserts in flight are finished and reported through on_upsert,
+        # batches not upserted yet are dropped
+        if not self._stop["upsert"].is_set():
+            self._fail("upsert", IngestionCancelled("Ingestion was cancelled"))
+
+    def _put(self, out_queue: queue.Queue, item, stats: StageStats):
+        start = time.perf_counter()
+        receiver = STAGES[STAGES.index(stats.name) + 1]
+        while not self._stop[receiver].is_set():
+            try:
+                out_queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        with stats.lock:
+            stats.wait_seconds += time.perf_counter() - start
+
+    def _drain(self, in_queue: queue.Queue, stats: StageStats) -> Iterator:
+        """Yield items from `in_queue` until the previous stage is done"""
+        while not self._stop[stats.name].is_set():
+            start = time.perf_counter()
+            try:
+                item = in_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            finally:
+                with stats.lock:
+                    stats.wait_seconds += time.perf_counter() - start
+            if item is _DONE:
+                # let the other workers of the stage see it too
+                in_queue.put(item)
+                return
+            yield item
+
+    def _call(
+        self, call: Callable[[], Any], limiter: AdaptiveLimiter, stats: StageStats
+    ) -> Any:
+        """Run `call` under `limiter`, retrying rate limit and transient errors"""
+        attempt = 0
+        while True:
+            limiter.acquire()
+            try:
+                result = call()
+            except Exception as e:
+                limiter.release(throttled=is_rate_limited(e))
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                delay = retry_delay(e, attempt)
+                print(
+                    f"{stats.name} failed ({type(e).__name__}), "
+                    f"retrying in {delay:.1f}s"
+                )
+                with stats.lock:
+                    stats.retries += 1
+                attempt += 1
+                if self._stop[stats.name].wait(delay):
+                    raise
+                continue
+            limiter.release()
+            return result
+
+    def _run_stage(
+        self,
+        name: str,
+        items: Iterator,
+        work: Callable,
+        out_queue: Optional[queue.Queue],
+        count: Callable[[object], int],
+        workers: List[int],
+    ):
+        """
+        Apply `work` to every item and forward the results downstream; the
+        last worker of a stage to finish forwards the end of the input
+        """
+        stats = self.stats[name]
+        start = time.perf_counter()
+        with stats.lock:
+            if stats.started_at is None:
+                stats.started_at = start
+        try:
+            for item in items:
+                with stats.lock:
+                    stats.batches += 1
+                for result in work(item):
+                    with stats.lock:
+                        stats.items += count(result)
+                    if out_queue is not None:
+                        self._put(out_queue, result, stats)
+                if self._stop[name].is_set():
+                    break
+        except BaseException as e:
+            self._fail(name, e)
+        finally:
+            close = getattr(items, "close", None)
+            if close is not None:
+                close()
+            end = time.perf_counter()
+            with stats.lock:
+                stats.worker_seconds += end - start
+                workers[0] -= 1
+                last = workers[0] == 0
+                if last:
+                    stats.finished_at = end
+            if last and out_queue is not None:
+                self._put(out_queue, _DONE, stats)
+
+    def _split(self, documents: List[Document]) -> Iterator[List[Document]]:
+        with timed("ingest_item_seconds", stage="split"):
+            chunks = (
+                self.text_splitter.split_documents(documents)
+                if self.text_splitter
+                else documents
+            )
+            if self.deduplicator is not None:
+                chunks, dropped, dropped_ids = self.deduplicator.filter(chunks)
+                if dropped and self.on_duplicate is not None:
+                    with self._on_upsert_lock:
+                        self.on_duplicate(dropped, dropped_ids)
+                stats = self.stats["split"]
+                with stats.lock:
+                    stats.dropped += len(dropped)
+                    stats.dropped_tokens += sum(
+                        _token_counter.count(chunk.page_content) for chunk in dropped
+                    )
+        batch = []
+        batch_tokens = 0
+        for chunk in chunks:
+            tokens = _token_counter.count(chunk.page_content)
+            if batch and (
+                len(batch) >= self.batch_size
+                or batch_tokens + tokens > self.batch_max_tokens
+            ):
+                yield batch
+                batch = []
+                batch_tokens = 0
+            batch.append(chunk)
+            batch_tokens += tokens
+        if batch:
+            yield batch
+
+    def _discard(self, chunks: List[Document]):
+        # near duplicates of a failed batch's chunks must not be dropped
+        if self.deduplicator is not None:
+            with self._on_upsert_lock:
+                self.deduplicator.discard(chunks)
+
+    def _embed(self, chunks: List[Document]) -> Iterator[tuple]:
+        texts = [chunk.page_content for chunk in chunks]
+        try:
+            vectors = self._call(
+                lambda: self.embeddings.embed_documents(texts),
+                self._embed_limiter,
+                self.stats["embed"],
+            )
+        except BaseException:
+            self._discard(chunks)
+            raise
+        yield chunks, vectors
+
+    def _upsert(self, batch: tuple) -> Iterator[List[str]]:
+        chunks, vectors = batch
+        # IDs are fixed before the first attempt, so retries overwrite
+        ids = [str(uuid.uuid4()) for _ in chunks]
+        try:
+            self._call(
+                lambda: add_embeddings(
+                    self.vectorstore,
+                    [chunk.page_content for chunk in chunks],
+                    vectors,
+                    metadatas=[dict(chunk.metadata) for chunk in chunks],
+                    ids=ids,
+                ),
+                self._upsert_limiter,
+                self.stats["upsert"],
+            )
+        except BaseException:
+            self._discard(chunks)
+            raise
+        with self._on_upsert_lock:
+            if self.deduplicator is not None:
+                self.deduplicator.commit(chunks, ids)
+            if self.on_upsert is not None:
+                self.on_upsert(chunks, ids)
+        yield ids
+
+    def run(self, documents: Iterable[List[Document]]) -> Dict[str, StageStats]:
+        """
+        Ingest an iterable of document lists (typically the pages of one
+        file per item) and return the per-stage statistics
+        """
+        split_queue = queue.Queue(maxsize=self.queue_size)
+        embed_queue = queue.Queue(maxsize=self.queue_size)
+        upsert_queue = queue.Queue(maxsize=self.queue_size)
+
+        stats = self.stats
+        stages = [
+            ("load", 1, lambda: iter(documents), _single, split_queue, len),
+            (
+                "split",
+                1,
+                lambda: self._drain(split_queue, stats["split"]),
+                self._split,
+                embed_queue,
+                len,
+            ),
+            (
+                "embed",
+                self.embed_concurrency,
+                lambda: self._drain(embed_queue, stats["embed"]),
+                self._embed,
+                upsert_queue,
+                _batch_len,
+            ),
+            (
+                "upsert",
+                self.upsert_concurrency,
+                lambda: self._drain(upsert_queue, stats["upsert"]),
+                self._upsert,
+                None,
+                len,
+            ),
+        ]
+        threads = []
+        for name, concurrency, items, work, out_queue, count in stages:
+            # workers of the stage still running
+            workers = [concurrency]
+            # the loader's iterator is shared, the queues are read by every worker
+            shared_items = items() if concurrency == 1 else None
+            for i in range(concurrency):
+                threads.append(
+                    threading.Thread(
+                        target=self._run_stage,
+                        args=(
+                            name,
+                            shared_items or items(),
+                            work,
+                            out_queue,
+                            count,
+                            workers,
+                        ),
+                        name=f"ingest-{name}-{i}",
+                    )
+                )
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(timeout=0.1)
+                if self.cancel is not None and self.cancel.is_set():
+                    self._cancel()
+        observe_stage_stats(self.stats)
+
+        if self._errors:
+            raise self._errors[0]
+        return self.stats
+
+    def print_stats(self):
+        print(f"Ingestion rate: {chunks_per_second(self.stats):.1f} chunks/s")
+        for stats in self.stats.values():
+            print(stats)
+
+
+def _single(item) -> Iterator:
+    yield item
+
+
+def _batch_len(batch: tuple) -> int:
+    chunks, _ = batch
+    return len(chunks)
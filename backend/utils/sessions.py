@@ -0,0 +1,163 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+from langchain.schema import AIMessage, BaseMessage, HumanMessage
+
+# load your credentials from .env file
+load_dotenv()
+
+# conversations kept in memory per worker, 0 disables server-side sessions
+chat_session_max_entries = int(os.getenv("CHAT_SESSION_MAX_ENTRIES", "10000"))
+# SQLite file shared by the workers, sessions stay in memory only when unset
+chat_session_path = os.getenv("CHAT_SESSION_PATH")
+# seconds an idle conversation is kept
+chat_session_ttl = float(os.getenv("CHAT_SESSION_TTL", str(24 * 3600)))
+
+# seconds between two purges of expired sessions from disk
+PURGE_INTERVAL = 600
+
+
+def _encode(messages: List[BaseMessage]) -> str:
+    return json.dumps(
+        [
+            {
+                "role": "user" if isinstance(message, HumanMessage) else "assistant",
+                "content": message.content,
+            }
+            for message in messages
+        ]
+    )
+
+
+def _decode(data: str) -> List[BaseMessage]:
+    return [
+        (
+            HumanMessage(content=message["content"])
+            if message["role"] == "user"
+            else AIMessage(content=message["content"])
+        )
+        for message in json.loads(data)
+    ]
+
+
+class SessionStore:
+    """
+    Formatted chat history window per conversation ID, so clients only send
+    the new message of each turn.
+
+    Sessions live in an in-process LRU. With `path` they are written through
+    to SQLite, which lets them survive restarts and be shared by workers:
+    every save bumps a version column, and a worker only decodes a session
+    again when the version on disk differs from its cached copy.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        # id -> (version, updated_at, messages)
+        self._sessions: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._purged_at = 0.0
+        if path and self.enabled:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "id TEXT PRIMARY KEY, messages TEXT NOT NULL, "
+                "version INTEGER NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._conn.commit()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def _cache(self, session_id: str, version: int, updated_at: float, messages):
+        self._sessions[session_id] = (version, updated_at, messages)
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > self.max_entries:
+            self._sessions.popitem(last=False)
+
+    def get(self, session_id: str) -> Optional[List[BaseMessage]]:
+        """History of the conversation, None when unknown or expired"""
+        with self._lock:
+            cached = self._sessions.get(session_id)
+            if self._conn is not None:
+                row = self._conn.execute(
+                    "SELECT version, updated_at FROM sessions WHERE id = ?",
+                    (session_id,),
+                ).fetchone()
+                if row is None:
+                    cached = None
+                elif cached is None or cached[0] != row[0]:
+                    # new to this worker or changed by another one
+                    (data,) = self._conn.execute(
+                        "SELECT messages FROM sessions WHERE id = ?", (session_id,)
+                    ).fetchone()
+                    cached = (row[0], row[1], _decode(data))
+                    self.loads += 1
+            if cached is None or time.time() - cached[1] > self.ttl:
+                self._sessions.pop(session_id, None)
+                self.misses += 1
+                return None
+            self._cache(session_id, *cached)
+            self.hits += 1
+            return list(cached[2])
+
+    def save(self, session_id: str, messages: List[BaseMessage]):
+        now = time.time()
+        with self._lock:
+            version = self._sessions.get(session_id, (0,))[0] + 1
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT INTO sessions (id, messages, version, updated_at) "
+                    "VALUES (?, ?, 1, ?) ON CONFLICT (id) DO UPDATE SET "
+                    "messages = excluded.messages, version = version + 1, "
+                    "updated_at = excluded.updated_at",
+                    (session_id, _encode(messages), now),
+                )
+                (version,) = self._conn.execute(
+                    "SELECT version FROM sessions WHERE id = ?", (session_id,)
+                ).fetchone()
+                if now - self._purged_at > PURGE_INTERVAL:
+                    self._conn.execute(
+                        "DELETE FROM sessions WHERE updated_at < ?", (now - self.ttl,)
+                    )
+                    self._purged_at = now
+                self._conn.commit()
+            self._cache(session_id, version, now, list(messages))
+
+    def delete(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+                self._conn.commit()
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._sessions),
+            "hits": self.hits,
+            "misses": self.misses,
+            "loads": self.loads,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+chat_sessions = SessionStore(
+    chat_session_max_entries, chat_session_ttl, chat_session_path
+)
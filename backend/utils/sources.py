@@ -0,0 +1,142 @@
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+from langchain.docstore.document import Document
+
+from .vectorstore import vector_store_backend
+
+# load your credentials from .env file
+load_dotenv()
+
+pinecone_namespace = os.getenv("PINECONE_NAMESPACE")
+
+source_index_dir = os.getenv("SOURCE_INDEX_DIR", os.path.join(".cache", "sources"))
+
+# SQLite limits the number of bound parameters per statement
+_SQL_BATCH = 500
+
+
+def _escape_like(prefix: str) -> str:
+    return prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+class SourceIndex:
+    """
+    Persistent map from the source (file path or URL) and the ingestion batch
+    (job ID) of every chunk to its vector ID, so the vectors of a document
+    can be deleted without scanning or wiping the vector store.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "id TEXT PRIMARY KEY, source TEXT NOT NULL, batch TEXT)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS chunks_source ON chunks (source)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS chunks_batch ON chunks (batch)")
+        self._conn.commit()
+
+    def add(self, chunks: List[Document], ids: List[str], batch: Optional[str] = None):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO chunks (id, source, batch) VALUES (?, ?, ?)",
+                [
+                    (id_, str(chunk.metadata.get("source", "")), batch)
+                    for chunk, id_ in zip(chunks, ids)
+                ],
+            )
+            self._conn.commit()
+
+    def find(
+        self,
+        sources: List[str] = [],
+        prefixes: List[str] = [],
+        batches: List[str] = [],
+    ) -> Dict[str, List[str]]:
+        """Vector IDs by source, of the given sources, source prefixes and batches"""
+        # at most _SQL_BATCH bound parameters per query
+        queries = []
+        for column, values in (("source", sources), ("batch", batches)):
+            for i in range(0, len(values), _SQL_BATCH):
+                batch = values[i : i + _SQL_BATCH]
+                queries.append((f"{column} IN ({','.join('?' * len(batch))})", batch))
+        for i in range(0, len(prefixes), _SQL_BATCH):
+            batch = prefixes[i : i + _SQL_BATCH]
+            queries.append(
+                (
+                    " OR ".join(["source LIKE ? ESCAPE '\\'"] * len(batch)),
+                    [_escape_like(prefix) + "%" for prefix in batch],
+                )
+            )
+        found: Dict[str, List[str]] = {}
+        seen = set()
+        with self._lock:
+            for condition, params in queries:
+                rows = self._conn.execute(
+                    f"SELECT id, source FROM chunks WHERE {condition}", params
+                ).fetchall()
+                for id_, source in rows:
+                    # a chunk may match several selectors
+                    if id_ not in seen:
+                        seen.add(id_)
+                        found.setdefault(source, []).append(id_)
+        return found
+
+    def ids(self) -> List[str]:
+        with self._lock:
+            return [id_ for (id_,) in self._conn.execute("SELECT id FROM chunks")]
+
+    def sources(self) -> Dict[str, int]:
+        """Number of chunks per source"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT source, COUNT(*) FROM chunks GROUP BY source ORDER BY source"
+            ).fetchall()
+        return dict(rows)
+
+    def delete(self, ids: List[str]):
+        with self._lock:
+            for i in range(0, len(ids), _SQL_BATCH):
+                batch = ids[i : i + _SQL_BATCH]
+                self._conn.execute(
+                    f"DELETE FROM chunks WHERE id IN ({','.join('?' * len(batch))})",
+                    batch,
+                )
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM chunks")
+            self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()
+        return count
+
+
+_indexes: Dict[str, SourceIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_source_index(namespace: Optional[str] = pinecone_namespace) -> SourceIndex:
+    """Shared source index of a vector store namespace"""
+    path = os.path.join(
+        source_index_dir, f"{vector_store_backend}-{namespace or 'default'}.sqlite"
+    )
+    with _indexes_lock:
+        if path not in _indexes:
+            _indexes[path] = SourceIndex(path)
+        return _indexes[path]
@@ -0,0 +1,178 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List
+
+from dotenv import load_dotenv
+from langchain.docstore.document import Document
+from langchain.schema import BaseMessage
+
+# load your credentials from .env file
+load_dotenv()
+
+# model whose tokenizer is used to count prompt tokens
+prompt_token_model = os.getenv("PROMPT_TOKEN_MODEL", "gpt-3.5-turbo")
+# tokens of chat history sent to the condense question prompt
+history_token_budget = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))
+# tokens of retrieved context sent to the QA prompt
+context_token_budget = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+# number of memoized token counts
+token_count_cache_max_entries = int(os.getenv("TOKEN_COUNT_CACHE_MAX_ENTRIES", "50000"))
+
+# tokens the chat format adds around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+# tokens of the separator between two context chunks
+CHUNK_SEPARATOR = "\n\n"
+CHUNK_SEPARATOR_TOKENS = 1
+# characters per token when the tiktoken encoding can not be loaded
+FALLBACK_CHARS_PER_TOKEN = 4
+
+
+def format_documents(docs: List[Document]) -> str:
+    """Context as it is sent in the QA prompt"""
+    return CHUNK_SEPARATOR.join(doc.page_content for doc in docs)
+
+
+class TokenCounter:
+    """
+    tiktoken counts memoized by text hash, so the same chat message or
+    retrieved chunk is only encoded once. The encoding is loaded on first
+    use; without it (e.g. offline) counts are estimated from the length.
+    """
+
+    def __init__(self, model: str, max_entries: int):
+        self.model = model
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._counts: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._encoding = None
+        self._loaded = False
+        self._load_lock = threading.Lock()
+
+    def _load_encoding(self):
+        with self._load_lock:
+            if not self._loaded:
+                try:
+                    import tiktoken
+
+                    self._encoding = tiktoken.encoding_for_model(self.model)
+                except Exception as e:
+                    print(f"Could not load the tiktoken encoding, estimating: {e}")
+                self._loaded = True
+        return self._encoding
+
+    def count(self, text: str) -> int:
+        key = hash(text)
+        with self._lock:
+            tokens = self._counts.get(key)
+            if tokens is not None:
+                self._counts.move_to_end(key)
+                self.hits += 1
+                return tokens
+            self.misses += 1
+        encoding = self._load_encoding()
+        tokens = (
+            len(encoding.encode(text))
+            if encoding is not None
+            else -(-len(text) // FALLBACK_CHARS_PER_TOKEN)
+        )
+        with self._lock:
+            self._counts[key] = tokens
+            while len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+        return tokens
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Longest prefix of `text` that fits in `max_tokens`"""
+        encoding = self._load_encoding()
+        if encoding is None:
+            return text[: max_tokens * FALLBACK_CHARS_PER_TOKEN]
+        return encoding.decode(encoding.encode(text)[:max_tokens])
+
+
+class PromptPacker:
+    """
+    Fits chat history and retrieved chunks into token budgets.
+
+    History is kept newest first until the budget is spent, chunks are kept
+    in retrieval order and skipped when they do not fit; a top chunk larger
+    than the whole budget is truncated rather than dropped. The tokens left
+    out are counted as saved.
+    """
+
+    def __init__(self, counter: TokenCounter, history_budget: int, context_budget: int):
+        self.counter = counter
+        self.history_budget = history_budget
+        self.context_budget = context_budget
+        self.history_tokens_in = 0
+        self.history_tokens_sent = 0
+        self.context_tokens_in = 0
+        self.context_tokens_sent = 0
+        self._lock = threading.Lock()
+
+    def pack_history(
+        self, messages: List[BaseMessage], record: bool = True
+    ) -> List[BaseMessage]:
+        counts = [
+            self.counter.count(message.content) + MESSAGE_OVERHEAD_TOKENS
+            for message in messages
+        ]
+        kept = 0
+        used = 0
+        for tokens in reversed(counts):
+            if used + tokens > self.history_budget:
+                break
+            used += tokens
+            kept += 1
+        if record:
+            with self._lock:
+                self.history_tokens_in += sum(counts)
+                self.history_tokens_sent += used
+        return messages[len(messages) - kept :]
+
+    def pack_context(self, docs: List[Document]) -> List[Document]:
+        packed = []
+        total = 0
+        used = 0
+        for doc in docs:
+            tokens = self.counter.count(doc.page_content) + CHUNK_SEPARATOR_TOKENS
+            total += tokens
+            if used + tokens <= self.context_budget:
+                packed.append(doc)
+                used += tokens
+            elif not packed:
+                budget = self.context_budget - CHUNK_SEPARATOR_TOKENS
+                packed.append(
+                    Document(
+                        page_content=self.counter.truncate(doc.page_content, budget),
+                        metadata=doc.metadata,
+                    )
+                )
+                used += self.context_budget
+        with self._lock:
+            self.context_tokens_in += total
+            self.context_tokens_sent += used
+        return packed
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.counter.hits + self.counter.misses
+        return {
+            "history_tokens_in": self.history_tokens_in,
+            "history_tokens_sent": self.history_tokens_sent,
+            "context_tokens_in": self.context_tokens_in,
+            "context_tokens_sent": self.context_tokens_sent,
+            "tokens_saved": self.history_tokens_in
+            - self.history_tokens_sent
+            + self.context_tokens_in
+            - self.context_tokens_sent,
+            "token_count_hit_rate": self.counter.hits / lookups if lookups else 0.0,
+        }
+
+
+prompt_packer = PromptPacker(
+    TokenCounter(prompt_token_model, token_count_cache_max_entries),
+    history_token_budget,
+    context_token_budget,
+)
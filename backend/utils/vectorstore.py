@@ -0,0 +1,523 @@
+import asyncio
+import os
+import shutil
+import threading
+import uuid
+import weakref
+from functools import partial
+from typing import Any, Iterable, List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+from langchain.callbacks.manager import AsyncCallbackManagerForRetrieverRun
+from langchain.docstore.document import Document
+from langchain.schema.embeddings import Embeddings
+from langchain.schema.vectorstore import VectorStore, VectorStoreRetriever
+from langchain.vectorstores import Pinecone
+from langchain.vectorstores.utils import DistanceStrategy
+
+from .clients import clients
+from .doclog import (DocumentLog, file_lock, file_stamp, read_json,
+                     truncate_file, write_json)
+from .metrics import span
+
+# load your credentials from .env file
+load_dotenv()
+
+pinecone_api_key = os.getenv("PINECONE_API_KEY")
+pinecone_environment = os.getenv("PINECONE_ENVIRONMENT")
+pinecone_index = os.getenv("PINECONE_INDEX_NAME")
+pinecone_namespace = os.getenv("PINECONE_NAMESPACE")
+
+# "pinecone" (default) or "local"
+vector_store_backend = os.getenv("VECTOR_STORE", "pinecone").lower()
+local_vectorstore_dir = os.getenv("LOCAL_VECTORSTORE_DIR", "vectorstore")
+# "float16" or "int8" (int8 stores a float32 scale per row)
+local_vectorstore_dtype = os.getenv("LOCAL_VECTORSTORE_DTYPE", "float16")
+# number of IVF partitions, 0 disables the coarse partition
+local_vectorstore_nlist = int(os.getenv("LOCAL_VECTORSTORE_NLIST", "0"))
+# number of IVF partitions scanned per query
+local_vectorstore_nprobe = int(os.getenv("LOCAL_VECTORSTORE_NPROBE", "8"))
+
+# rows scored per matrix multiplication during a brute force scan
+SEARCH_BLOCK_ROWS = 65536
+# rows sampled to train the IVF centroids
+IVF_TRAIN_ROWS_PER_LIST = 64
+IVF_TRAIN_ITERATIONS = 10
+
+_PINECONE_ENV_VARS = [
+    "PINECONE_API_KEY",
+    "PINECONE_ENVIRONMENT",
+    "PINECONE_INDEX_NAME",
+]
+
+
+class LocalVectorStore(VectorStore):
+    """
+    Disk backed vector store for running without Pinecone.
+
+    Embeddings are L2 normalised and appended to a memory-mapped float16 or
+    int8 matrix, so a restart only maps the files instead of reading the
+    corpus into RAM. Texts and metadata live in a JSON lines file addressed
+    through a row -> byte offset table. Cosine similarity is an inner product
+    over the normalised rows; an optional IVF partition restricts the scan to
+    the `nprobe` closest centroids for large corpora.
+
+    Several processes can share a directory: writes hold an exclusive file
+    lock and append after the rows committed on disk, and every operation
+    first reloads the state if another process changed it.
+    """
+
+    def __init__(
+        self,
+        persist_directory: str,
+        embedding: Embeddings,
+        dtype: str = "float16",
+        nprobe: int = 8,
+    ):
+        if dtype not in ("float16", "int8"):
+            raise ValueError(f"Unsupported local vector store dtype '{dtype}'")
+        self._dir = persist_directory
+        self._embedding = embedding
+        self._nprobe = nprobe
+        self._default_dtype = dtype
+        self._lock = threading.RLock()
+        self._lock_path = os.path.normpath(self._dir) + ".lock"
+        os.makedirs(self._dir, exist_ok=True)
+
+        self._docs = DocumentLog(self._dir)
+        with file_lock(self._lock_path, shared=True):
+            self._load_info()
+            self._remap()
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self._embedding
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self._dir, name)
+
+    def _load_info(self):
+        self._info_stamp = file_stamp(self._path("info.json"))
+        info = read_json(self._path("info.json")) or {}
+        self._dtype = info.get("dtype", self._default_dtype)
+        self._dim = info.get("dim")
+        self._count = info.get("count", 0)
+        self._ivf_count = info.get("ivf_count", 0)
+
+    def _write_info(self):
+        write_json(
+            self._path("info.json"),
+            {
+                "dtype": self._dtype,
+                "dim": self._dim,
+                "count": self._count,
+                "ivf_count": self._ivf_count,
+            },
+        )
+        self._info_stamp = file_stamp(self._path("info.json"))
+
+    def _refresh(self):
+        """
+        Pick up rows, tombstones and partitions written by other processes,
+        called holding the file lock
+        """
+        if file_stamp(self._path("info.json")) != self._info_stamp:
+            self._load_info()
+            self._docs.invalidate()
+            self._remap()
+        self._docs.refresh()
+
+    def _remap(self):
+        """Memory-map the on-disk arrays for the committed row count"""
+        self._vectors = self._scales = None
+        self._centroids = self._ivf_order = self._ivf_bounds = None
+        self._docs.remap(self._count)
+        if not self._count:
+            return
+        self._vectors = np.memmap(
+            self._path("vectors.bin"),
+            dtype=self._dtype,
+            mode="r",
+            shape=(self._count, self._dim),
+        )
+        if self._dtype == "int8":
+            self._scales = np.memmap(
+                self._path("scales.bin"),
+                dtype=np.float32,
+                mode="r",
+                shape=(self._count,),
+            )
+        if self._ivf_count:
+            self._centroids = np.load(self._path("ivf_centroids.npy"))
+            self._ivf_order = np.load(self._path("ivf_order.npy"), mmap_mode="r")
+            self._ivf_bounds = np.load(self._path("ivf_bounds.npy"))
+
+    def _encode(self, vectors: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        if self._dtype == "float16":
+            return vectors.astype(np.float16), None
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        quantized = np.round(vectors / scales[:, None]).astype(np.int8)
+        return quantized, scales.astype(np.float32)
+
+    def _score_rows(self, rows: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """Inner product between the query and a selection of stored rows"""
+        scores = self._vectors[rows].astype(np.float32) @ query
+        if self._scales is not None:
+            scores *= self._scales[rows]
+        return scores
+
+    def _score_range(self, start: int, stop: int, query: np.ndarray) -> np.ndarray:
+        scores = self._vectors[start:stop].astype(np.float32) @ query
+        if self._scales is not None:
+            scores *= self._scales[start:stop]
+        return scores
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        texts = list(texts)
+        if not texts:
+            return []
+        vectors = np.asarray(self._embedding.embed_documents(texts), dtype=np.float32)
+        return self.add_embeddings(texts, vectors, metadatas=metadatas, ids=ids)
+
+    def add_embeddings(
+        self,
+        texts: List[str],
+        vectors: Any,
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+    ) -> List[str]:
+        """
+        Append precomputed embeddings and their texts to the store
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        metadatas = metadatas or [{} for _ in texts]
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        encoded, scales = self._encode(vectors / norms)
+
+        with file_lock(self._lock_path), self._lock:
+            self._refresh()
+            if self._dim is None:
+                self._dim = int(vectors.shape[1])
+            elif vectors.shape[1] != self._dim:
+                raise ValueError(
+                    f"Embedding dimension {vectors.shape[1]} does not match the "
+                    f"local vector store dimension {self._dim}"
+                )
+
+            self._docs.append(self._count, ids, texts, metadatas)
+            truncate_file(
+                self._path("vectors.bin"),
+                self._count * self._dim * np.dtype(self._dtype).itemsize,
+            )
+            truncate_file(self._path("scales.bin"), self._count * 4)
+            with open(self._path("vectors.bin"), "ab") as f:
+                f.write(encoded.tobytes())
+            if scales is not None:
+                with open(self._path("scales.bin"), "ab") as f:
+                    f.write(scales.tobytes())
+
+            self._count += len(texts)
+            self._write_info()
+            self._remap()
+        return ids
+
+    def delete(
+        self,
+        ids: Optional[List[str]] = None,
+        delete_all: Optional[bool] = None,
+        **kwargs: Any,
+    ) -> Optional[bool]:
+        if not delete_all and ids is None:
+            raise ValueError("Either ids or delete_all must be provided.")
+        with file_lock(self._lock_path), self._lock:
+            if delete_all:
+                shutil.rmtree(self._dir, ignore_errors=True)
+                os.makedirs(self._dir, exist_ok=True)
+                self._load_info()
+                self._docs.reset()
+                self._remap()
+                return True
+            self._refresh()
+            if self._count:
+                self._docs.delete(ids)
+        return True
+
+    def build_ivf(self, nlist: int, seed: int = 0):
+        """
+        Train `nlist` spherical k-means centroids over the stored rows and
+        persist the row order grouped by partition. Rows appended afterwards
+        are scanned exhaustively until the partition is rebuilt.
+        """
+        with file_lock(self._lock_path), self._lock:
+            self._refresh()
+            if self._count < nlist:
+                return
+            rng = np.random.default_rng(seed)
+            sample_size = min(self._count, nlist * IVF_TRAIN_ROWS_PER_LIST)
+            sample_rows = np.sort(
+                rng.choice(self._count, size=sample_size, replace=False)
+            )
+            sample = self._vectors[sample_rows].astype(np.float32)
+            if self._scales is not None:
+                sample *= self._scales[sample_rows][:, None]
+            centroids = sample[rng.choice(sample_size, size=nlist, replace=False)]
+            for _ in range(IVF_TRAIN_ITERATIONS):
+                assignment = np.argmax(sample @ centroids.T, axis=1)
+                for list_id in range(nlist):
+                    members = sample[assignment == list_id]
+                    if len(members):
+                        centroid = members.sum(axis=0)
+                        centroids[list_id] = centroid / max(
+                            np.linalg.norm(centroid), 1e-12
+                        )
+
+            assignment = np.empty(self._count, dtype=np.int32)
+            for start in range(0, self._count, SEARCH_BLOCK_ROWS):
+                block = self._vectors[start : start + SEARCH_BLOCK_ROWS]
+                assignment[start : start + len(block)] = np.argmax(
+                    block.astype(np.float32) @ centroids.T, axis=1
+                )
+            order = np.argsort(assignment, kind="stable").astype(np.int64)
+            bounds = np.searchsorted(assignment[order], np.arange(nlist + 1))
+
+            # replaced, not rewritten, other processes may have them mapped
+            for name, array in (
+                ("ivf_centroids", centroids),
+                ("ivf_order", order),
+                ("ivf_bounds", bounds),
+            ):
+                np.save(self._path(f"{name}.tmp.npy"), array)
+                os.replace(self._path(f"{name}.tmp.npy"), self._path(f"{name}.npy"))
+            self._ivf_count = self._count
+            self._write_info()
+            self._remap()
+
+    def _candidate_scores(self, query: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (rows, scores) for every row the query has to be compared to"""
+        if self._centroids is None:
+            scores = [
+                self._score_range(start, start + SEARCH_BLOCK_ROWS, query)
+                for start in range(0, self._count, SEARCH_BLOCK_ROWS)
+            ]
+            return np.arange(self._count), np.concatenate(scores)
+
+        nprobe = min(self._nprobe, len(self._centroids))
+        probes = np.argpartition(-(self._centroids @ query), nprobe - 1)[:nprobe]
+        rows = [
+            np.asarray(self._ivf_order[self._ivf_bounds[p] : self._ivf_bounds[p + 1]])
+            for p in probes
+        ]
+        # rows appended after the partition was built
+        rows.append(np.arange(self._ivf_count, self._count))
+        rows = np.sort(np.concatenate(rows))
+        return rows, self._score_rows(rows, query)
+
+    def similarity_search_by_vector_with_score(
+        self, embedding: List[float], k: int = 4, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        # shared, so no other process rewrites the files while rows are read
+        with file_lock(self._lock_path, shared=True), self._lock:
+            self._refresh()
+            if not self._count:
+                return []
+            query = np.asarray(embedding, dtype=np.float32)
+            query /= max(np.linalg.norm(query), 1e-12)
+            rows, scores = self._candidate_scores(query)
+            if self._docs.deleted:
+                scores[np.isin(rows, list(self._docs.deleted))] = -np.inf
+
+            k = min(k, len(rows))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            results = []
+            for i in top:
+                if np.isinf(scores[i]):
+                    continue
+                _, doc = self._docs.read(int(rows[i]))
+                results.append((doc, float(scores[i])))
+            return results
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        embedding = self._embedding.embed_query(query)
+        return self.similarity_search_by_vector_with_score(embedding, k, **kwargs)
+
+    def similarity_search_by_vector(
+        self, embedding: List[float], k: int = 4, **kwargs: Any
+    ) -> List[Document]:
+        return [
+            doc
+            for doc, _ in self.similarity_search_by_vector_with_score(
+                embedding, k, **kwargs
+            )
+        ]
+
+    def similarity_search(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def _select_relevance_score_fn(self):
+        return self._cosine_relevance_score_fn
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        persist_directory: str = local_vectorstore_dir,
+        **kwargs: Any,
+    ) -> "LocalVectorStore":
+        store = cls(persist_directory, embedding, **kwargs)
+        store.add_texts(texts, metadatas=metadatas)
+        return store
+
+
+class LazyPinecone(Pinecone):
+    """
+    Pinecone store that initialises Pinecone and opens the index client on
+    first use, so building it at import time needs no network access
+    """
+
+    def __init__(
+        self,
+        index_name: str,
+        embedding: Embeddings,
+        text_key: str,
+        namespace: Optional[str] = None,
+    ):
+        self._index_name = index_name
+        self._embedding = embedding
+        self._text_key = text_key
+        self._namespace = namespace
+        self.distance_strategy = DistanceStrategy.COSINE
+
+    @property
+    def _index(self) -> Any:
+        return clients.pinecone_index(self._index_name)
+
+
+class AsyncVectorStoreRetriever(VectorStoreRetriever):
+    """
+    Retriever whose async path embeds the query on the async OpenAI client and
+    only hands the index lookup to the default executor, instead of running
+    the whole sync similarity search (embedding included) in a thread.
+    """
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        embeddings = self.vectorstore.embeddings
+        if self.search_type != "similarity" or embeddings is None:
+            return await super()._aget_relevant_documents(
+                query, run_manager=run_manager
+            )
+        with span("embed_query"):
+            embedding = await embeddings.aembed_query(query)
+        search = partial(
+            self.vectorstore.similarity_search_by_vector_with_score,
+            embedding,
+            **self.search_kwargs,
+        )
+        with span("vector_query"):
+            docs_and_scores = await asyncio.get_running_loop().run_in_executor(
+                None, search
+            )
+        return [doc for doc, _ in docs_and_scores]
+
+
+# weak, a store is released once no retriever or ingestion uses it anymore
+_local_stores: "weakref.WeakValueDictionary[str, LocalVectorStore]" = (
+    weakref.WeakValueDictionary()
+)
+_local_stores_lock = threading.Lock()
+
+
+def required_env_vars() -> List[str]:
+    """
+    Environment variables the configured vector store backend needs
+    """
+    if vector_store_backend == "local":
+        return []
+    return _PINECONE_ENV_VARS
+
+
+def get_vectorstore(
+    embeddings: Embeddings, namespace: Optional[str] = pinecone_namespace
+) -> VectorStore:
+    """
+    Return the vector store of a namespace, of the backend selected by the
+    VECTOR_STORE env var.
+
+    Local stores are shared per directory while in use, so the ingestion
+    writer and the chat retriever in one process see the same memory-mapped
+    state. Stores of other processes pick up the changes on their next call.
+    """
+    if vector_store_backend == "local":
+        persist_directory = os.path.join(local_vectorstore_dir, namespace or "default")
+        with _local_stores_lock:
+            vectorstore = _local_stores.get(persist_directory)
+            if vectorstore is None:
+                vectorstore = LocalVectorStore(
+                    persist_directory,
+                    embeddings,
+                    dtype=local_vectorstore_dtype,
+                    nprobe=local_vectorstore_nprobe,
+                )
+                _local_stores[persist_directory] = vectorstore
+            return vectorstore
+
+    if vector_store_backend != "pinecone":
+        raise ValueError(f"Unsupported vector store '{vector_store_backend}'")
+
+    # pinecone is initialized on first use and the index client is pooled
+    return LazyPinecone(pinecone_index, embeddings, "text", namespace=namespace or None)
+
+
+def add_embeddings(
+    vectorstore: VectorStore,
+    texts: List[str],
+    vectors: List[List[float]],
+    metadatas: Optional[List[dict]] = None,
+    ids: Optional[List[str]] = None,
+) -> List[str]:
+    """
+    Write already embedded texts to either backend, so callers can embed and
+    upsert in separate steps
+    """
+    if isinstance(vectorstore, LocalVectorStore):
+        return vectorstore.add_embeddings(texts, vectors, metadatas=metadatas, ids=ids)
+
+    ids = ids or [str(uuid.uuid4()) for _ in texts]
+    metadatas = metadatas or [{} for _ in texts]
+    records = [
+        (id_, list(vector), {**metadata, vectorstore._text_key: text})
+        for id_, text, vector, metadata in zip(ids, texts, vectors, metadatas)
+    ]
+    vectorstore._index.upsert(vectors=records, namespace=vectorstore._namespace)
+    return ids
+
+
+def maybe_rebuild_ivf(vectorstore: VectorStore):
+    """
+    Rebuild the IVF partition of a local store once enough rows were appended
+    since the last build. No-op for Pinecone or when LOCAL_VECTORSTORE_NLIST=0.
+    """
+    if not isinstance(vectorstore, LocalVectorStore) or not local_vectorstore_nlist:
+        return
+    unpartitioned = vectorstore._count - vectorstore._ivf_count
+    if unpartitioned >= max(vectorstore._ivf_count, local_vectorstore_nlist):
+        print(f"Building IVF partition ({local_vectorstore_nlist} lists)...")
+        vectorstore.build_ivf(local_vectorstore_nlist)
@@ -0,0 +1,121 @@
+"""
+Measure concurrent /api/chat requests served by a single worker.
+
+Retrieval and generation are replaced with fakes of fixed latency, so the
+numbers only reflect how well the request path overlaps in-flight requests.
+`--blocking` makes the fakes sleep on the event loop, which is how the sync
+`invoke`/`stream` calls behaved before the chat path moved to `ainvoke` and
+`astream`.
+
+    python -m benchmarks.chat_concurrency --requests 200 --concurrency 50
+    python -m benchmarks.chat_concurrency --requests 200 --concurrency 50 --blocking
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+os.environ.setdefault("VECTOR_STORE", "local")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("EMBEDDING_CACHE_MAX_ENTRIES", "0")
+os.environ.setdefault("ANSWER_CACHE_MAX_ENTRIES", "0")
+# every request asks the same question
+os.environ.setdefault("CHAT_COALESCE", "false")
+
+import httpx
+from langchain.docstore.document import Document
+from langchain.schema.runnable import RunnableGenerator, RunnableLambda
+
+from backend.main import app
+from backend.routers import chat as chat_router
+from backend.utils.namespaces import pinecone_namespace
+
+
+def build_fakes(
+    retrieval_latency: float, tokens: int, token_latency: float, blocking: bool
+):
+    def question_inputs(inputs):
+        return {
+            "question": inputs["question"],
+            "chat_history": [],
+            "standalone_question": inputs["question"],
+        }
+
+    def retrieve(question):
+        time.sleep(retrieval_latency)
+        return [Document(page_content="context", metadata={"source": "fake"})]
+
+    async def aretrieve(question):
+        if blocking:
+            return retrieve(question)
+        await asyncio.sleep(retrieval_latency)
+        return [Document(page_content="context", metadata={"source": "fake"})]
+
+    def generate(input_iterator):
+        for _ in input_iterator:
+            pass
+        for _ in range(tokens):
+            time.sleep(token_latency)
+            yield "token "
+
+    async def agenerate(input_iterator):
+        async for _ in input_iterator:
+            pass
+        for _ in range(tokens):
+            if blocking:
+                time.sleep(token_latency)
+            else:
+                await asyncio.sleep(token_latency)
+            yield "token "
+
+    return (
+        RunnableLambda(question_inputs),
+        RunnableLambda(retrieve, afunc=aretrieve),
+        RunnableGenerator(generate, atransform=agenerate),
+    )
+
+
+async def run(args):
+    chat_router._question_inputs, retriever, chat_router.chain = build_fakes(
+        args.retrieval_latency, args.tokens, args.token_latency, args.blocking
+    )
+    # served as the warm retriever of the default namespace
+    chat_router.retrievers.get(pinecone_namespace, lambda: retriever)
+    payload = {"messages": [{"role": "user", "content": "What is in the docs?"}]}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://benchmark"
+    ) as client:
+
+        async def one_request():
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post("/api/chat", json=payload, timeout=None)
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one_request() for _ in range(args.requests)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    mode = "blocking" if args.blocking else "async"
+    print(f"mode={mode} requests={args.requests} concurrency={args.concurrency}")
+    print(f"throughput: {args.requests / elapsed:.1f} req/s")
+    print(f"latency p50: {statistics.median(latencies) * 1000:.0f} ms")
+    print(f"latency p95: {latencies[int(len(latencies) * 0.95) - 1] * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--retrieval-latency", type=float, default=0.2)
+    parser.add_argument("--tokens", type=int, default=20)
+    parser.add_argument("--token-latency", type=float, default=0.01)
+    parser.add_argument("--blocking", action="store_true")
+    asyncio.run(run(parser.parse_args()))
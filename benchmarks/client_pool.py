@@ -0,0 +1,86 @@
+"""
+Measure per-request OpenAI client setup against the pooled registry clients.
+
+A local fake OpenAI server answers embeddings and chat completions and
+sleeps `--connect-latency` seconds on every new connection, standing in for
+the TCP and TLS handshakes to the real API. `per-request` builds a fresh
+langchain model for every call, like ingestion and the chat models did
+before the client registry; `pooled` reuses keep-alive connections from
+`backend.utils.clients`. Embedding requests go through langchain's
+`embed_with_retry` directly, skipping the tiktoken length check so the
+benchmark runs offline.
+
+    python -m benchmarks.client_pool --requests 50 --connect-latency 0.05
+"""
+
+import argparse
+import os
+import statistics
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+from langchain.chat_models import ChatOpenAI
+from langchain.embeddings import OpenAIEmbeddings
+from langchain.embeddings.openai import embed_with_retry
+
+import backend.utils.clients as clients_module
+
+from .fakes import FakeOpenAIHandler, start_server
+
+
+def build_models(mode: str, registry: clients_module.ClientRegistry):
+    if mode == "pooled":
+        return registry.embeddings(), registry.chat_model()
+    return OpenAIEmbeddings(), ChatOpenAI()
+
+
+def run_mode(mode: str, requests: int, registry: clients_module.ClientRegistry):
+    FakeOpenAIHandler.connections = 0
+    models = build_models(mode, registry)
+    latencies = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        if mode == "per-request":
+            models = build_models(mode, registry)
+        embeddings, chat_model = models
+        embed_with_retry(
+            embeddings, input=["What is in the docs?"], **embeddings._invocation_params
+        )
+        chat_model.invoke("What is in the docs?")
+        latencies.append(time.perf_counter() - start)
+    return latencies, FakeOpenAIHandler.connections
+
+
+def main(args):
+    FakeOpenAIHandler.connect_latency = args.connect_latency
+    server, url = start_server(FakeOpenAIHandler)
+    base_url = f"{url}/v1"
+    os.environ["OPENAI_API_BASE"] = base_url
+    clients_module.openai_api_base = base_url
+    registry = clients_module.ClientRegistry(
+        max_connections=8,
+        max_keepalive_connections=8,
+        keepalive_expiry=60,
+        pool_threads=1,
+    )
+
+    print(
+        f"requests={args.requests} connect_latency={args.connect_latency * 1000:.0f} ms"
+        " (one embedding + one chat completion per request)"
+    )
+    for mode in ("per-request", "pooled"):
+        latencies, connections = run_mode(mode, args.requests, registry)
+        print(
+            f"{mode:>11}: mean {statistics.mean(latencies) * 1000:.1f} ms, "
+            f"p50 {statistics.median(latencies) * 1000:.1f} ms, "
+            f"{connections} connections opened"
+        )
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--connect-latency", type=float, default=0.05)
+    main(parser.parse_args())
@@ -0,0 +1,396 @@
+"""
+Local stand-ins for the OpenAI API, a Pinecone index and web pages.
+
+Each fake is a `BaseHTTPRequestHandler` configured through class attributes,
+served by `start_server` on a background thread:
+
+- `latency`: seconds before the response (before the first token for
+  streamed chat completions)
+- `connect_latency`: seconds slept on every new connection, standing in for
+  the TCP and TLS handshakes
+- `failure_rate`, `failure_status`: fraction of requests answered with an
+  error status instead, e.g. 429 to exercise rate limit handling
+
+`FakeOpenAIHandler` also streams `answer_tokens` words at `token_rate`
+tokens per second and returns deterministic embeddings of
+`embedding_dim` dimensions. `FakeWebHandler` serves a linked site with a
+sitemap and ETags, for crawls. `write_tiktoken_encoding` stands in for the
+tiktoken encoding download.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import random
+import re
+import socket
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Tuple
+
+import numpy as np
+
+
+class FakeServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+    connect_latency = 0.0
+    failure_rate = 0.0
+    failure_status = 429
+    connections = 0
+    requests = 0
+    failures = 0
+    _counter_lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        # headers and body are separate writes, avoid Nagle delays on keep-alive
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._count("connections")
+        time.sleep(self.connect_latency)
+
+    @classmethod
+    def _count(cls, counter: str):
+        with cls._counter_lock:
+            setattr(cls, counter, getattr(cls, counter) + 1)
+
+    @classmethod
+    def reset_stats(cls):
+        cls.connections = cls.requests = cls.failures = 0
+
+    @classmethod
+    def stats(cls) -> Dict[str, int]:
+        return {
+            "connections": cls.connections,
+            "requests": cls.requests,
+            "failures": cls.failures,
+        }
+
+    def read_json(self) -> Dict[str, Any]:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def send_payload(self, payload: bytes, content_type: str, status: int = 200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_json(self, body: Any, status: int = 200):
+        self.send_payload(json.dumps(body).encode("utf8"), "application/json", status)
+
+    def begin_request(self) -> bool:
+        """
+        Counts the request and applies the latency; returns False after
+        answering with an injected failure
+        """
+        self._count("requests")
+        if self.failure_rate and random.random() < self.failure_rate:
+            self._count("failures")
+            self.send_json(
+                {"error": {"message": "injected failure", "type": "benchmark"}},
+                status=self.failure_status,
+            )
+            return False
+        time.sleep(self.latency)
+        return True
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeOpenAIHandler(FakeServiceHandler):
+    """Embeddings and (streamed) chat completions"""
+
+    token_rate = 0.0
+    answer_tokens = 2
+    embedding_dim = 8
+
+    @classmethod
+    def embed(cls, text: Any) -> list:
+        # same input, same vector; langchain sends token ids instead of strings
+        if not isinstance(text, str):
+            text = json.dumps(text)
+        rng = np.random.default_rng(zlib.crc32(text.encode("utf8")))
+        vector = rng.standard_normal(cls.embedding_dim)
+        return np.round(vector / np.linalg.norm(vector), 6).tolist()
+
+    def do_POST(self):
+        request = self.read_json()
+        if not self.begin_request():
+            return
+        if self.path.endswith("/embeddings"):
+            inputs = request["input"]
+            if isinstance(inputs, str):
+                inputs = [inputs]
+            body = {
+                "object": "list",
+                "model": request["model"],
+                "data": [
+                    {"object": "embedding", "index": i, "embedding": self.embed(text)}
+                    for i, text in enumerate(inputs)
+                ],
+                "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)},
+            }
+            self.send_json(body)
+            return
+
+        words = ["an"] + ["answer"] * max(self.answer_tokens - 1, 0)
+        body = {
+            "id": "benchmark",
+            "object": "chat.completion",
+            "created": 0,
+            "model": request["model"],
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": " ".join(words)},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": 1,
+                "completion_tokens": len(words),
+                "total_tokens": len(words) + 1,
+            },
+        }
+        if not request.get("stream"):
+            if self.token_rate:
+                time.sleep(len(words) / self.token_rate)
+            self.send_json(body)
+            return
+
+        # server-sent events, one chunk per word of the answer
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i, word in enumerate(words):
+            if i and self.token_rate:
+                time.sleep(1 / self.token_rate)
+            chunk = {
+                **body,
+                "object": "chat.completion.chunk",
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"content": word if i == 0 else f" {word}"},
+                        "finish_reason": None,
+                    }
+                ],
+            }
+            self._write_chunk(f"data: {json.dumps(chunk)}\n\n")
+        self._write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, data: str):
+        payload = data.encode("utf8")
+        self.wfile.write(f"{len(payload):x}\r\n".encode("ascii") + payload + b"\r\n")
+        self.wfile.flush()
+
+
+class FakePineconeHandler(FakeServiceHandler):
+    """
+    Pinecone controller `whoami` and the index data plane (upsert, query,
+    delete, describe_index_stats) over an in-memory store per namespace
+    """
+
+    namespaces: Dict[str, Dict[str, Tuple[np.ndarray, dict]]] = {}
+    _store_lock = threading.Lock()
+
+    @classmethod
+    def reset_store(cls):
+        with cls._store_lock:
+            cls.namespaces = {}
+
+    def do_GET(self):
+        if not self.begin_request():
+            return
+        if self.path.startswith("/actions/whoami"):
+            self.send_json(
+                {
+                    "project_name": "benchmark",
+                    "user_label": "benchmark",
+                    "user_name": "benchmark",
+                }
+            )
+        elif self.path.startswith("/describe_index_stats"):
+            self.send_json(self._index_stats())
+        else:
+            self.send_json({"message": f"unknown path {self.path}"}, status=404)
+
+    def do_POST(self):
+        request = self.read_json()
+        if not self.begin_request():
+            return
+        namespace = request.get("namespace", "")
+        if self.path.startswith("/vectors/upsert"):
+            with self._store_lock:
+                store = self.namespaces.setdefault(namespace, {})
+                for vector in request["vectors"]:
+                    store[vector["id"]] = (
+                        np.asarray(vector["values"], dtype=np.float32),
+                        vector.get("metadata", {}),
+                    )
+            self.send_json({"upsertedCount": len(request["vectors"])})
+        elif self.path.startswith("/query"):
+            self.send_json(self._query(request, namespace))
+        elif self.path.startswith("/vectors/delete"):
+            with self._store_lock:
+                if request.get("deleteAll"):
+                    self.namespaces.pop(namespace, None)
+                else:
+                    store = self.namespaces.get(namespace, {})
+                    for id_ in request.get("ids", []):
+                        store.pop(id_, None)
+            self.send_json({})
+        elif self.path.startswith("/describe_index_stats"):
+            self.send_json(self._index_stats())
+        else:
+            self.send_json({"message": f"unknown path {self.path}"}, status=404)
+
+    def _query(self, request: dict, namespace: str) -> dict:
+        vector = request.get("vector")
+        if vector is None:
+            vector = request["queries"][0]["values"]
+        query = np.asarray(vector, dtype=np.float32).reshape(-1)
+        with self._store_lock:
+            items = list(self.namespaces.get(namespace, {}).items())
+        matches = []
+        if items:
+            matrix = np.stack([values for _, (values, _) in items])
+            scores = matrix @ query
+            top = np.argsort(-scores)[: request.get("topK", 10)]
+            for row in top:
+                id_, (values, metadata) = items[row]
+                match = {"id": id_, "score": float(scores[row]), "values": []}
+                if request.get("includeValues"):
+                    match["values"] = values.tolist()
+                if request.get("includeMetadata"):
+                    match["metadata"] = metadata
+                matches.append(match)
+        return {"matches": matches, "namespace": namespace}
+
+    def _index_stats(self) -> dict:
+        with self._store_lock:
+            counts = {name: len(store) for name, store in self.namespaces.items()}
+        return {
+            "namespaces": {
+                name: {"vectorCount": count} for name, count in counts.items()
+            },
+            "dimension": FakeOpenAIHandler.embedding_dim,
+            "indexFullness": 0.0,
+            "totalVectorCount": sum(counts.values()),
+        }
+
+
+class FakeWebHandler(FakeServiceHandler):
+    """
+    A static site of `site_pages` HTML pages `/pages/<n>.html` of
+    `page_words` words, each linking to `links_per_page` further pages, with
+    `/sitemap.xml` and `/robots.txt`. Pages carry an ETag and answer
+    conditional requests with 304 until `site_version` changes.
+    """
+
+    page_words = 500
+    site_pages = 100
+    links_per_page = 3
+    site_version = 0
+
+    def do_GET(self):
+        if not self.begin_request():
+            return
+        if self.path == "/robots.txt":
+            robots = f"User-agent: *\nAllow: /\nSitemap: {self._base()}/sitemap.xml\n"
+            self.send_payload(robots.encode("utf8"), "text/plain")
+            return
+        if self.path == "/sitemap.xml":
+            urls = "".join(
+                f"<url><loc>{self._base()}/pages/{page}.html</loc></url>"
+                for page in range(self.site_pages)
+            )
+            sitemap = (
+                '<?xml version="1.0" encoding="UTF-8"?><urlset xmlns='
+                f'"http://www.sitemaps.org/schemas/sitemap/0.9">{urls}</urlset>'
+            )
+            self.send_payload(sitemap.encode("utf8"), "application/xml")
+            return
+        match = re.fullmatch(r"/pages/(\d+)\.html", self.path)
+        if match is None:
+            self.send_payload(b"not found", "text/plain", status=404)
+            return
+        page = int(match.group(1))
+        etag = f'"{page}-{self.site_version}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        paragraphs = [
+            " ".join(f"page{page}v{self.site_version}word{i + j}" for j in range(50))
+            for i in range(0, self.page_words, 50)
+        ]
+        first_link = page * self.links_per_page + 1
+        links = [
+            f'<a href="/pages/{link}.html">page {link}</a>'
+            for link in range(first_link, first_link + self.links_per_page)
+            if link < self.site_pages
+        ]
+        html = (
+            f"<html><head><title>Page {page}</title></head><body>"
+            + "".join(f"<p>{paragraph}</p>" for paragraph in paragraphs)
+            + f"<nav>{''.join(links)}</nav></body></html>"
+        )
+        payload = html.encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _base(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+# tiktoken downloads the encoding of the OpenAI models from here and caches it
+# under the sha1 of the URL
+TIKTOKEN_ENCODING_URL = (
+    "https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken"
+)
+
+
+def tiktoken_encoding_path(cache_dir: str) -> str:
+    return os.path.join(
+        cache_dir, hashlib.sha1(TIKTOKEN_ENCODING_URL.encode()).hexdigest()
+    )
+
+
+def write_tiktoken_encoding(cache_dir: str):
+    """
+    Writes a stand-in for the cl100k_base encoding into a tiktoken cache
+    directory, so OpenAIEmbeddings and the prompt packer run offline. Its
+    tokens are single bytes and pairs of printable ASCII characters, which
+    counts about twice the tokens of the real encoding.
+    """
+    printable = [bytes([byte]) for byte in range(32, 127)]
+    tokens = [bytes([byte]) for byte in range(256)]
+    tokens += [first + second for first in printable for second in printable]
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(tiktoken_encoding_path(cache_dir), "wb") as f:
+        for rank, token in enumerate(tokens):
+            f.write(base64.b64encode(token) + f" {rank}\n".encode())
+
+
+def start_server(handler: type) -> Tuple[ThreadingHTTPServer, str]:
+    """Serves `handler` on a free local port, returns (server, base url)"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
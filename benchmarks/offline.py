@@ -0,0 +1,500 @@
+"""
+Load test the API offline against fake OpenAI, Pinecone and web servers.
+
+Starts the fakes from `benchmarks.fakes`, runs `uvicorn backend.main:app` in
+a fresh working directory pointed at them, and drives `/api/ingest`,
+`/api/ingest-url` (single pages and a site crawl) and `/api/chat` with
+concurrent clients. Reports request latency percentiles, time to first token
+and tokens/sec for chat, and chunks/sec for ingestion, and writes them to
+`--output` as JSON; pass a previous file as `--compare` to print the change
+of every metric.
+
+Settings the harness does not set (e.g. INGEST_MAX_CONCURRENT_JOBS) are
+read from the environment as usual. OpenAIEmbeddings and the prompt packer
+count tokens with tiktoken; unless TIKTOKEN_CACHE_DIR already holds its
+encoding, the app gets a stand-in encoding instead of downloading it.
+
+    python -m benchmarks.offline --chat-requests 200 --concurrency 20
+    python -m benchmarks.offline --failure-rate 0.05 --compare results.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+from .fakes import (FakeOpenAIHandler, FakePineconeHandler, FakeWebHandler,
+                    start_server, tiktoken_encoding_path,
+                    write_tiktoken_encoding)
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCE_DOCUMENTS_MARKER = "##SOURCE_DOCUMENTS##"
+JOB_POLL_INTERVAL = 0.1
+# statuses of backend.utils.jobs a job stays in until someone resumes it
+TERMINAL_JOB_STATES = ("succeeded", "failed", "interrupted")
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    """p50/p95/p99 and mean in milliseconds"""
+    if not values:
+        return {"mean": None, "p50": None, "p95": None, "p99": None}
+    if len(values) == 1:
+        values = values * 2
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {
+        "mean": statistics.mean(values) * 1000,
+        "p50": cuts[49] * 1000,
+        "p95": cuts[94] * 1000,
+        "p99": cuts[98] * 1000,
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def configure_fakes(args):
+    for handler in (FakeOpenAIHandler, FakePineconeHandler, FakeWebHandler):
+        handler.connect_latency = args.connect_latency
+        handler.failure_rate = args.failure_rate
+        handler.failure_status = args.failure_status
+        handler.reset_stats()
+    FakeOpenAIHandler.latency = args.openai_latency
+    FakeOpenAIHandler.token_rate = args.token_rate
+    FakeOpenAIHandler.answer_tokens = args.answer_tokens
+    FakeOpenAIHandler.embedding_dim = args.embedding_dim
+    FakePineconeHandler.latency = args.pinecone_latency
+    FakePineconeHandler.reset_store()
+    FakeWebHandler.latency = args.web_latency
+    FakeWebHandler.page_words = args.doc_words
+
+
+def tiktoken_cache_dir(workdir: str) -> str:
+    """
+    The tiktoken cache of the user when it holds the encoding already,
+    otherwise one with a stand-in encoding, so the app never downloads it
+    """
+    cache_dir = os.environ.get("TIKTOKEN_CACHE_DIR") or os.path.join(
+        tempfile.gettempdir(), "data-gym-cache"
+    )
+    if os.path.exists(tiktoken_encoding_path(cache_dir)):
+        return cache_dir
+    cache_dir = os.path.join(workdir, "tiktoken")
+    print("tiktoken encoding not cached, token counts use a stand-in encoding")
+    write_tiktoken_encoding(cache_dir)
+    return cache_dir
+
+
+def start_app(args, workdir: str, urls: Dict[str, str]) -> Tuple[subprocess.Popen, str]:
+    """Returns the app process and its base url once it answers"""
+    port = free_port()
+    env = {
+        **os.environ,
+        "PYTHONPATH": os.pathsep.join(
+            filter(None, [REPO_DIR, os.environ.get("PYTHONPATH")])
+        ),
+        "OPENAI_API_KEY": "benchmark",
+        "OPENAI_API_BASE": f"{urls['openai']}/v1",
+        "PINECONE_API_KEY": "benchmark",
+        "PINECONE_ENVIRONMENT": "benchmark",
+        "PINECONE_INDEX_NAME": "benchmark",
+        "PINECONE_CONTROLLER_HOST": urls["pinecone"],
+        "PINECONE_INDEX_HOST": urls["pinecone"],
+        "VECTOR_STORE": args.vector_store,
+        "TIKTOKEN_CACHE_DIR": tiktoken_cache_dir(workdir),
+        # every request should reach the fakes
+        "ANSWER_CACHE_MAX_ENTRIES": "0",
+    }
+    log = open(os.path.join(workdir, "app.log"), "w")
+    # relative cache paths of the app resolve inside the working directory
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "backend.main:app",
+            "--port",
+            str(port),
+            "--log-level",
+            "warning",
+        ],
+        cwd=workdir,
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + args.startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            httpx.get(f"{base_url}/docs", timeout=1).raise_for_status()
+            return process, base_url
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    process.kill()
+    sys.exit(f"The app did not start, see {log.name}")
+
+
+async def wait_for_jobs(client: httpx.AsyncClient, job_ids: List[str]) -> List[dict]:
+    jobs = {}
+    while len(jobs) < len(job_ids):
+        for job_id in job_ids:
+            if job_id in jobs:
+                continue
+            response = await client.get(f"/api/ingest/jobs/{job_id}")
+            response.raise_for_status()
+            job = response.json()
+            if job["status"] in TERMINAL_JOB_STATES:
+                job["finished"] = time.perf_counter()
+                jobs[job_id] = job
+        await asyncio.sleep(JOB_POLL_INTERVAL)
+    return [jobs[job_id] for job_id in job_ids]
+
+
+async def run_ingest_jobs(client: httpx.AsyncClient, submits: list, concurrency: int):
+    """
+    Submits the jobs `concurrency` at a time, waits for all of them and
+    returns the ingestion metrics
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    submitted = []
+    latencies = []
+    errors = 0
+
+    async def one_submit(submit):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                response = await submit()
+                response.raise_for_status()
+            except httpx.HTTPError:
+                errors += 1
+                return
+            latencies.append(time.perf_counter() - start)
+            submitted.append((response.json()["jobId"], start))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one_submit(submit) for submit in submits))
+    jobs = await wait_for_jobs(client, [job_id for job_id, _ in submitted])
+    elapsed = time.perf_counter() - start
+
+    chunks = sum(job["progress"].get("chunksEmbedded", 0) for job in jobs)
+    return {
+        "jobs": len(submits),
+        "submit_errors": errors,
+        "failed_jobs": sum(job["status"] == "failed" for job in jobs),
+        "interrupted_jobs": sum(job["status"] == "interrupted" for job in jobs),
+        "chunks": chunks,
+        "seconds": elapsed,
+        "chunks_per_sec": chunks / elapsed if elapsed else 0.0,
+        "submit_latency_ms": percentiles(latencies),
+        "job_latency_ms": percentiles(
+            [job["finished"] - start for job, (_, start) in zip(jobs, submitted)]
+        ),
+    }
+
+
+def document_text(job: int, index: int, words: int) -> str:
+    # distinct words per document, so nothing is skipped as unchanged
+    return "\n\n".join(
+        " ".join(f"doc{job}x{index}word{i + j}" for j in range(50))
+        for i in range(0, words, 50)
+    )
+
+
+async def ingest_scenario(client: httpx.AsyncClient, args) -> dict:
+    def submit(job: int):
+        files = [
+            (
+                "files",
+                (
+                    f"doc{job}_{index}.txt",
+                    document_text(job, index, args.doc_words),
+                    "text/plain",
+                ),
+            )
+            for index in range(args.files_per_job)
+        ]
+        return lambda: client.post("/api/ingest", files=files)
+
+    return await run_ingest_jobs(
+        client, [submit(job) for job in range(args.ingest_jobs)], args.concurrency
+    )
+
+
+async def ingest_url_scenario(client: httpx.AsyncClient, args, web_url: str) -> dict:
+    def submit(page: int):
+        url = f"{web_url}/pages/{page}.html"
+        return lambda: client.post("/api/ingest-url", json={"url": url})
+
+    return await run_ingest_jobs(
+        client, [submit(page) for page in range(args.url_jobs)], args.concurrency
+    )
+
+
+async def crawl_scenario(client: httpx.AsyncClient, args, web_url: str) -> dict:
+    """
+    Crawls the fake site twice: the second crawl finds every page unchanged
+    and measures conditional-GET skipping
+    """
+    FakeWebHandler.site_pages = args.crawl_pages
+    payload = {
+        "url": f"{web_url}/pages/0.html",
+        "crawl": True,
+        "maxPages": args.crawl_pages,
+        "maxDepth": args.crawl_pages,
+    }
+
+    def submit():
+        return client.post("/api/ingest-url", json=payload)
+
+    results = {}
+    for name in ("first", "repeat"):
+        results[name] = await run_ingest_jobs(client, [submit], 1)
+        results[name]["pages_per_sec"] = (
+            args.crawl_pages / results[name]["seconds"]
+            if results[name]["seconds"]
+            else 0.0
+        )
+    return results
+
+
+async def chat_scenario(client: httpx.AsyncClient, args) -> dict:
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    first_tokens = []
+    token_rates = []
+    total_tokens = 0
+    errors = 0
+    retrieval_paths = Counter()
+
+    async def one_chat(i: int):
+        nonlocal total_tokens, errors
+        # a burst of identical questions when --questions is set
+        question = i % args.questions if args.questions else i
+        messages = [{"role": "user", "content": f"What does document {question} say?"}]
+        if args.history:
+            messages = [
+                {"role": "user", "content": "What are the docs about?"},
+                {"role": "assistant", "content": "They are benchmark documents."},
+                *messages,
+            ]
+        # spread over tenants, each with its own warm retriever and caches
+        headers = (
+            {"X-Namespace": f"tenant-{i % args.namespaces}"}
+            if args.namespaces > 1
+            else {}
+        )
+        async with semaphore:
+            start = time.perf_counter()
+            first_token = None
+            answer = []
+            try:
+                async with client.stream(
+                    "POST", "/api/chat", json={"messages": messages}, headers=headers
+                ) as response:
+                    response.raise_for_status()
+                    retrieval_paths[response.headers.get("X-Retrieval-Path")] += 1
+                    async for chunk in response.aiter_text():
+                        text = chunk.split(SOURCE_DOCUMENTS_MARKER)[0]
+                        if text and first_token is None:
+                            first_token = time.perf_counter()
+                        answer.append(text)
+                        if SOURCE_DOCUMENTS_MARKER in chunk:
+                            break
+            except httpx.HTTPError:
+                errors += 1
+                return
+            end = time.perf_counter()
+        tokens = len("".join(answer).split())
+        total_tokens += tokens
+        latencies.append(end - start)
+        if first_token is not None:
+            first_tokens.append(first_token - start)
+            if end > first_token:
+                token_rates.append(tokens / (end - first_token))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one_chat(i) for i in range(args.chat_requests)))
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": args.chat_requests,
+        "namespaces": args.namespaces,
+        "errors": errors,
+        "seconds": elapsed,
+        "requests_per_sec": (args.chat_requests - errors) / elapsed,
+        "latency_ms": percentiles(latencies),
+        "time_to_first_token_ms": percentiles(first_tokens),
+        "tokens_per_sec": statistics.mean(token_rates) if token_rates else None,
+        "total_tokens_per_sec": total_tokens / elapsed,
+        "retrieval_paths": dict(retrieval_paths),
+    }
+
+
+def flatten(results: Any, prefix: str = "") -> Dict[str, float]:
+    if isinstance(results, dict):
+        flat = {}
+        for key, value in results.items():
+            flat.update(flatten(value, f"{prefix}{key}."))
+        return flat
+    if isinstance(results, (int, float)) and not isinstance(results, bool):
+        return {prefix[:-1]: results}
+    return {}
+
+
+def compare(results: dict, baseline_path: str):
+    with open(baseline_path) as f:
+        baseline = flatten(json.load(f)["scenarios"])
+    print(f"\nchange against {baseline_path}:")
+    for name, value in flatten(results["scenarios"]).items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        change = f"{(value - before) / before * 100:+.1f}%" if before else "n/a"
+        print(f"  {name:<50} {before:>12.2f} -> {value:>12.2f} ({change})")
+
+
+def print_results(results: dict):
+    for scenario, metrics in results["scenarios"].items():
+        print(f"\n{scenario}:")
+        for name, value in flatten(metrics).items():
+            print(f"  {name:<35} {value:.2f}")
+    print("\nfakes:", json.dumps(results["fakes"]))
+
+
+async def run(args, base_url: str, urls: Dict[str, str]) -> dict:
+    scenarios = {}
+    async with httpx.AsyncClient(
+        base_url=base_url,
+        timeout=None,
+        limits=httpx.Limits(max_connections=args.concurrency * 2),
+    ) as client:
+        # ingestion first, so chat retrieves from the ingested chunks
+        if "ingest" in args.scenarios:
+            scenarios["ingest"] = await ingest_scenario(client, args)
+        if "ingest-url" in args.scenarios:
+            scenarios["ingest_url"] = await ingest_url_scenario(
+                client, args, urls["web"]
+            )
+        if "crawl" in args.scenarios:
+            scenarios["crawl"] = await crawl_scenario(client, args, urls["web"])
+        if "chat" in args.scenarios:
+            scenarios["chat"] = await chat_scenario(client, args)
+    return scenarios
+
+
+def main(args):
+    configure_fakes(args)
+    servers = {}
+    urls = {}
+    for name, handler in (
+        ("openai", FakeOpenAIHandler),
+        ("pinecone", FakePineconeHandler),
+        ("web", FakeWebHandler),
+    ):
+        servers[name], urls[name] = start_server(handler)
+
+    workdir = tempfile.mkdtemp(prefix="offline-benchmark-")
+    app, base_url = start_app(args, workdir, urls)
+    try:
+        scenarios = asyncio.run(run(args, base_url, urls))
+    finally:
+        app.terminate()
+        app.wait()
+        for server in servers.values():
+            server.shutdown()
+
+    commit = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"],
+        cwd=REPO_DIR,
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+    results = {
+        "commit": commit or None,
+        "timestamp": time.time(),
+        "config": vars(args),
+        "scenarios": scenarios,
+        "fakes": {
+            "openai": FakeOpenAIHandler.stats(),
+            "pinecone": FakePineconeHandler.stats(),
+            "web": FakeWebHandler.stats(),
+        },
+    }
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nresults written to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+    if args.keep_workdir:
+        print(f"app working directory: {workdir}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--scenarios",
+        type=lambda value: value.split(","),
+        default=["ingest", "ingest-url", "crawl", "chat"],
+        help="comma separated subset of ingest,ingest-url,crawl,chat",
+    )
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--chat-requests", type=int, default=200)
+    parser.add_argument(
+        "--history", action="store_true", help="send a previous turn with each chat"
+    )
+    parser.add_argument(
+        "--questions",
+        type=int,
+        default=0,
+        help="cycle chat requests through this many questions, 0 makes all distinct",
+    )
+    parser.add_argument(
+        "--namespaces",
+        type=int,
+        default=1,
+        help="spread chat requests over this many namespaces (X-Namespace)",
+    )
+    parser.add_argument("--ingest-jobs", type=int, default=10)
+    parser.add_argument("--files-per-job", type=int, default=5)
+    parser.add_argument("--url-jobs", type=int, default=10)
+    parser.add_argument("--crawl-pages", type=int, default=200)
+    parser.add_argument("--doc-words", type=int, default=2000)
+    parser.add_argument(
+        "--vector-store", choices=["pinecone", "local"], default="pinecone"
+    )
+    parser.add_argument("--embedding-dim", type=int, default=1536)
+    parser.add_argument("--openai-latency", type=float, default=0.2)
+    parser.add_argument("--token-rate", type=float, default=50.0)
+    parser.add_argument("--answer-tokens", type=int, default=100)
+    parser.add_argument("--pinecone-latency", type=float, default=0.02)
+    parser.add_argument("--web-latency", type=float, default=0.05)
+    parser.add_argument("--connect-latency", type=float, default=0.05)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--failure-status", type=int, default=429)
+    parser.add_argument("--startup-timeout", type=float, default=60.0)
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--compare")
+    parser.add_argument("--keep-workdir", action="store_true")
+    main(parser.parse_args())
@@ -0,0 +1,106 @@
+"""
+Profile the imports of `backend.main` and fail when startup exceeds its budget.
+
+Runs `python -X importtime -c "import backend.main"` in a fresh interpreter,
+prints the slowest modules and the time per top-level package, and exits
+with status 1 when the cumulative import time is over `--budget-ms` or when
+a module that should only load on first use (remote clients, document
+parsers) was imported at startup.
+
+    python -m benchmarks.startup_budget --budget-ms 2000
+
+`tests/test_startup_budget.py` runs the same check under pytest.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+DEFAULT_BUDGET_MS = 2000
+
+# imported on first use or at lifespan startup, never by `import backend.main`
+DEFERRED_MODULES = [
+    "openai",
+    "httpx",
+    "pinecone",
+    "tiktoken",
+    "langchain.chat_models",
+    "langchain.embeddings",
+    "langchain.document_loaders",
+    "unstructured",
+    "pypdf",
+]
+
+
+def profile_imports(module: str) -> List[Tuple[str, int, int]]:
+    """Returns (module, self us, cumulative us) in import order"""
+    env = dict(os.environ)
+    env.setdefault("OPENAI_API_KEY", "startup-budget")
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        sys.exit(f"import {module} failed:\n{result.stderr}")
+
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        imports.append((name.strip(), int(self_us), int(cumulative_us)))
+    return imports
+
+
+def startup_failures(
+    imports: List[Tuple[str, int, int]], module: str, budget_ms: float
+) -> List[str]:
+    """Reasons the profiled imports of `module` break the startup budget"""
+    cumulative = {name: cumulative_us for name, _, cumulative_us in imports}
+    failures = []
+    total_ms = cumulative[module] / 1000
+    if total_ms > budget_ms:
+        failures.append(f"startup imports took {total_ms:.0f} ms")
+    for deferred in DEFERRED_MODULES:
+        if deferred in cumulative:
+            failures.append(f"{deferred} is imported at startup")
+    return failures
+
+
+def main(args):
+    imports = profile_imports(args.module)
+    cumulative = {name: cumulative_us for name, _, cumulative_us in imports}
+    total_ms = cumulative[args.module] / 1000
+
+    packages: Dict[str, int] = defaultdict(int)
+    for name, self_us, _ in imports:
+        packages[name.split(".")[0]] += self_us
+
+    print(f"import {args.module}: {total_ms:.0f} ms (budget {args.budget_ms} ms)\n")
+    print("slowest modules (self time):")
+    for name, self_us, cumulative_us in sorted(imports, key=lambda x: -x[1])[
+        : args.top
+    ]:
+        print(f"  {self_us / 1000:8.1f} ms  {name} ({cumulative_us / 1000:.1f} ms)")
+    print("\ntime per package:")
+    for package, self_us in sorted(packages.items(), key=lambda x: -x[1])[: args.top]:
+        print(f"  {self_us / 1000:8.1f} ms  {package}")
+
+    failures = startup_failures(imports, args.module, args.budget_ms)
+    if failures:
+        print("\nFAILED: " + "; ".join(failures))
+        sys.exit(1)
+    print("\nOK")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--module", default="backend.main")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS)
+    parser.add_argument("--top", type=int, default=15)
+    main(parser.parse_args())
@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+from backend.utils.coalesce import Flight, FlightLagged, SingleFlight
+
+
+def test_subscriber_too_far_behind_is_cut_off():
+    async def run():
+        flight = Flight("key", max_lag=4)
+        fast, slow = flight.stream(), flight.stream()
+        await flight.publish("0")
+        assert await slow.__anext__() == "0"
+        received = [await fast.__anext__()]
+        for i in range(1, 10):
+            await flight.publish(str(i))
+            received.append(await fast.__anext__())
+        await flight.finish()
+        assert received == [str(i) for i in range(10)]
+        # only the last 4 chunks are kept, the slow subscriber needs "1"
+        with pytest.raises(FlightLagged):
+            await slow.__anext__()
+
+    asyncio.run(run())
+
+
+def test_flight_is_joined_while_its_log_can_be_replayed():
+    async def run():
+        flights = SingleFlight(max_lag=2)
+        published, release = asyncio.Event(), asyncio.Event()
+
+        async def produce(flight, chunks):
+            for chunk in chunks:
+                await flight.publish(chunk)
+            published.set()
+            await release.wait()
+
+        first, coalesced = flights.join("key", lambda f: produce(f, "ab"))
+        await published.wait()
+        second, coalesced = flights.join("key", lambda f: produce(f, ""))
+        assert coalesced and second is first
+
+        published.clear()
+        await first.publish("c")
+        # "a" was dropped, later requests start a flight of their own
+        third, coalesced = flights.join("key", lambda f: produce(f, "abc"))
+        assert not coalesced and third is not first
+
+        release.set()
+        await asyncio.gather(first.task, third.task)
+        assert flights.stats()["coalesced"] == 1
+
+    asyncio.run(run())
@@ -0,0 +1,122 @@
+import hashlib
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+from backend.utils.crawler import PageCache, SiteCrawler
+from benchmarks.fakes import start_server
+
+# the index links one page deep and a chain of pages three links deep
+PAGES = {
+    "/": (
+        '<html lang="en"><head><title>Home</title>'
+        '<meta name="description" content="The home page"></head><body>'
+        '<p>Welcome home</p><a href="/a.html">a</a> <a href="/private/x.html">x</a>'
+        ' <a href="/logo.png">logo</a></body></html>'
+    ),
+    "/a.html": '<html><body><p>Page a</p><a href="/b.html">b</a></body></html>',
+    "/b.html": '<html><body><p>Page b</p><a href="/c.html">c</a></body></html>',
+    "/c.html": "<html><body><p>Page c</p></body></html>",
+    "/private/x.html": "<html><body><p>Private</p></body></html>",
+}
+ROBOTS = "User-agent: *\nDisallow: /private/\n"
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+    """Serves PAGES with ETags, answering If-None-Match with 304"""
+
+    requests = []
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get("If-None-Match")))
+        if self.path == "/robots.txt":
+            self._send(200, ROBOTS.encode("utf8"), "text/plain")
+        elif self.path in PAGES:
+            body = PAGES[self.path].encode("utf8")
+            etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+            if self.headers.get("If-None-Match") == etag:
+                self._send(304, b"", None, etag)
+            else:
+                self._send(200, body, "text/html; charset=utf-8", etag)
+        else:
+            self._send(404, b"not found", "text/plain")
+
+    def _send(self, status, body, content_type, etag=None):
+        self.send_response(status)
+        if content_type:
+            self.send_header("Content-Type", content_type)
+        if etag:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def site():
+    SiteHandler.requests = []
+    server, url = start_server(SiteHandler)
+    yield url
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return PageCache(str(tmp_path / "pages.sqlite"))
+
+
+def crawl(url, cache, **kwargs):
+    crawler = SiteCrawler(url, cache, **kwargs)
+    pages = {}
+    for page in crawler.iter_pages():
+        cache.record(page, [])
+        pages[page.url[len(url) :]] = page
+    return crawler, pages
+
+
+def test_single_page_keeps_web_loader_metadata(site, cache):
+    _, pages = crawl(site, cache)
+    assert pages.keys() == {"/"}
+    (document,) = pages["/"].documents
+    assert document.metadata == {
+        "source": site + "/",
+        "title": "Home",
+        "description": "The home page",
+        "language": "en",
+    }
+    assert document.page_content == "Welcome home\na x logo"
+
+
+def test_crawl_honours_robots_txt(site, cache):
+    crawler, pages = crawl(site, cache, crawl=True)
+    assert "/private/x.html" not in pages
+    assert crawler.counts["disallowed"] == 1
+    assert "/private/x.html" not in {path for path, _ in SiteHandler.requests}
+    # links to files that are not pages are not followed either
+    assert "/logo.png" not in {path for path, _ in SiteHandler.requests}
+
+
+def test_crawl_stops_at_max_depth(site, cache):
+    _, pages = crawl(site, cache, crawl=True, max_depth=2)
+    assert pages.keys() == {"/", "/a.html", "/b.html"}
+
+
+def test_crawl_stops_at_max_pages(site, cache):
+    _, pages = crawl(site, cache, crawl=True, max_pages=2)
+    assert pages.keys() == {"/", "/a.html"}
+
+
+def test_recrawl_skips_pages_unchanged_by_etag(site, cache):
+    _, pages = crawl(site, cache, crawl=True)
+    assert pages.keys() == {"/", "/a.html", "/b.html", "/c.html"}
+
+    SiteHandler.requests = []
+    crawler, pages = crawl(site, cache, crawl=True)
+    assert not pages
+    assert crawler.counts["unchanged"] == 4
+    conditional = {path for path, etag in SiteHandler.requests if etag}
+    assert conditional == {"/", "/a.html", "/b.html", "/c.html"}
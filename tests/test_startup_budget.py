@@ -0,0 +1,8 @@
+from benchmarks.startup_budget import (DEFAULT_BUDGET_MS, profile_imports,
+                                       startup_failures)
+
+
+def test_import_backend_main_within_budget():
+    # a fresh interpreter, modules imported by other tests do not count
+    imports = profile_imports("backend.main")
+    assert startup_failures(imports, "backend.main", DEFAULT_BUDGET_MS) == []